@@ -2,20 +2,488 @@
 Модуль для отправки уведомлений администраторам о важных событиях
 """
 
+import asyncio
+import logging
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
+from aiogram.types import LinkPreviewOptions
+from sqlalchemy import case, func, select
 
 import config
 from database import db, User, Payment, Service
 
+logger = logging.getLogger(__name__)
+
+# Настройки пакетной отправки уведомлений
+BATCH_MAX_SIZE = 20  # Максимальное количество событий в одной сводке
+BATCH_FLUSH_INTERVAL = 5  # Максимальное время накопления событий, секунды
+BATCH_QUEUE_SIZE = 1000  # Размер очереди событий
+MESSAGE_MAX_LENGTH = 4096  # Ограничение Telegram на длину сообщения
+
+SEND_MAX_TRIES = 3  # Количество попыток отправки сообщения администратору
+SEND_RETRY_DELAY = 1  # Базовая задержка между попытками при сетевых ошибках, секунды
+SHUTDOWN_FLUSH_TIMEOUT = 10  # Время на отправку оставшихся уведомлений при выключении, секунды
+
+DAILY_REPORT_CACHE_TTL = 60  # Время жизни кэша ежедневного отчета, секунды
+
+NEW_USER_NOTIFY_INTERVAL = 300  # Минимальный интервал между уведомлениями о пользователе, секунды
+NOTIFICATION_COMPACT_EVERY = 1000  # Очистка устаревших отметок каждые N вставок
+NOTIFICATION_CACHE_SIZE = 10000  # Максимальное количество хранимых отметок
+
+# Шаблоны уведомлений
+NEW_PAYMENT_TPL = (
+    "💰 *НОВЫЙ ПЛАТЕЖ*\n\n"
+    "*ID платежа:* `{payment_id}`\n"
+    "*Пользователь:* {first_name} {last_name}\n"
+    "*Username:* @{username}\n"
+    "*User ID:* `{user_id}`\n"
+    "*Telegram ID:* `{telegram_id}`\n"
+    "*Сумма:* {amount} {currency}\n"
+    "*Провайдер:* {provider}\n"
+    "*Время:* {time}\n"
+    "*Статус:* {status}"
+)
+
+LARGE_PAYMENT_TPL = (
+    "⚠️ *КРУПНЫЙ ПЛАТЕЖ*\n\n"
+    "*Сумма:* {amount} {currency}\n"
+    "*Пользователь:* {first_name} {last_name}\n"
+    "*User ID:* `{user_id}`\n"
+    "*Время:* {time}"
+)
+
+NEW_USER_TPL = (
+    "👤 *НОВЫЙ ПОЛЬЗОВАТЕЛЬ*\n\n"
+    "*Имя:* {first_name} {last_name}\n"
+    "*Username:* @{username}\n"
+    "*Telegram ID:* `{telegram_id}`\n"
+    "*Время регистрации:* {time}\n"
+    "*Реферал:* {referral}"
+)
+
+SUSPICIOUS_ACTIVITY_TPL = (
+    "🚨 *ПОДОЗРИТЕЛЬНАЯ АКТИВНОСТЬ*\n\n"
+    "*Тип:* {activity_type}\n"
+    "*Пользователь:* {first_name} {last_name}\n"
+    "*Username:* @{username}\n"
+    "*Telegram ID:* `{telegram_id}`\n"
+    "*Детали:* {details}"
+)
+
+DAILY_REPORT_TPL = (
+    "📊 *ЕЖЕДНЕВНЫЙ ОТЧЕТ \\({date}\\)*\n\n"
+    "*Новые пользователи:* {new_users}\n"
+    "*Новые платежи:* {new_payments}\n"
+    "*Успешные платежи:* {successful_payments}\n"
+    "*Общая выручка:* {revenue} RUB\n\n"
+    "*Топ\\-5 популярных услуг:*\n"
+)
+
+SERVICE_PURCHASED_TPL = (
+    "🛒 *ПОКУПКА УСЛУГИ*\n\n"
+    "*Услуга:* {service_name}\n"
+    "*Цена:* {price} {currency}\n"
+    "*Пользователь:* {first_name} {last_name}\n"
+    "*Username:* @{username}\n"
+    "*User ID:* `{user_id}`\n"
+    "*Время:* {time}"
+)
+
+
+# Символы, которые нужно экранировать в MarkdownV2
+_MD_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '\\_*[]()~`>#+-=|{}.!'})
+
+
+def _md(value) -> str:
+    """Экранирование значения для MarkdownV2
+
+    Args:
+        value: Значение для подстановки в сообщение
+
+    Returns:
+        str: Экранированная строка
+    """
+    return str(value).translate(_MD_ESCAPE_TABLE)
+
+
+@lru_cache(maxsize=2048)
+def _md_cached(value: str) -> str:
+    """Экранирование повторяющихся значений (названий услуг) для MarkdownV2 с кэшированием
+
+    Args:
+        value (str): Значение для подстановки в сообщение
+
+    Returns:
+        str: Экранированная строка
+    """
+    return _md(value)
+
+
+@lru_cache(maxsize=4096)
+def _fmt_minute(epoch_min: int) -> str:
+    """Форматирование времени с точностью до минуты (с кэшированием)
+
+    Args:
+        epoch_min (int): Количество минут с начала эпохи
+
+    Returns:
+        str: Время в формате ДД.ММ.ГГГГ ЧЧ:ММ
+    """
+    return datetime.fromtimestamp(epoch_min * 60).strftime('%d.%m.%Y %H:%M')
+
+
+def _fmt_datetime(dt: datetime) -> str:
+    """Форматирование даты и времени для уведомлений
+
+    Args:
+        dt (datetime): Дата и время
+
+    Returns:
+        str: Время в формате ДД.ММ.ГГГГ ЧЧ:ММ
+    """
+    return _fmt_minute(int(dt.timestamp()) // 60)
+
 
 class AdminNotifier:
     """Класс для управления уведомлениями администраторам"""
 
     def __init__(self, bot: Bot):
+        # Все уведомления отправляются через общую сессию бота: aiogram держит
+        # одну aiohttp.ClientSession с пулом keep-alive соединений, поэтому
+        # параллельные отправки не открывают новое TCP/TLS-соединение
         self.bot = bot
-        self.last_notification_time = {}
+        self._admins: tuple = tuple(config.Config.ADMINS or ())
+        # user.id -> время последнего уведомления (time.monotonic), ограниченный LRU
+        self.last_notification_time: OrderedDict = OrderedDict()
+        self._notification_inserts = 0
+        # Очереди уведомлений: критичные (крупные платежи, подозрительная активность)
+        # отправляются сразу и всегда раньше обычных событий, которые собираются в сводки
+        self._hi: asyncio.Queue = asyncio.Queue()
+        self._lo: asyncio.Queue = asyncio.Queue(maxsize=BATCH_QUEUE_SIZE)
+        self._wakeup = asyncio.Event()
+        self._worker_task = None
+        self._closing = False
+        self._daily_cache = None  # (время формирования, текст отчета)
+
+    def refresh_admins(self):
+        """Перечитывание списка администраторов из конфигурации"""
+        self._admins = tuple(config.Config.ADMINS or ())
+
+    async def aclose(self):
+        """Отправка оставшихся уведомлений и закрытие HTTP-сессии бота
+
+        Воркер отправляет накопленные события без ожидания сводки; если он не успел
+        за SHUTDOWN_FLUSH_TIMEOUT секунд, он отменяется.
+        """
+        self._closing = True
+        self._wakeup.set()
+
+        if self._worker_task is not None and not self._worker_task.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._worker_task), timeout=SHUTDOWN_FLUSH_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "Не все уведомления отправлены при выключении: осталось %s срочных и %s обычных",
+                    self._hi.qsize(), self._lo.qsize()
+                )
+                self._worker_task.cancel()
+                try:
+                    await self._worker_task
+                except asyncio.CancelledError:
+                    pass
+
+        await self.bot.session.close()
+
+    async def _broadcast(self, message: str):
+        """Параллельная отправка сообщения всем администраторам
+
+        Args:
+            message (str): Текст сообщения
+        """
+        admins = self._admins
+
+        # Параметры сообщения одинаковы для всех администраторов, собираем их один раз.
+        # Превью ссылок отключено: Telegram не загружает страницы из деталей и payload
+        payload = {
+            "text": message,
+            "parse_mode": "MarkdownV2",
+            "link_preview_options": LinkPreviewOptions(is_disabled=True),
+        }
+
+        # Каждый администратор обрабатывается независимо: ожидание retry_after
+        # для одного не задерживает отправку остальным
+        await asyncio.gather(*[self._safe_send(admin_id, payload) for admin_id in admins])
+
+    async def _safe_send(self, admin_id: int, payload: dict, tries: int = SEND_MAX_TRIES) -> bool:
+        """Отправка сообщения администратору с повторными попытками
+
+        Args:
+            admin_id (int): Telegram ID администратора
+            payload (dict): Параметры сообщения для send_message
+            tries (int, optional): Количество попыток. По умолчанию SEND_MAX_TRIES.
+
+        Returns:
+            bool: Успешность отправки
+        """
+        for attempt in range(1, tries + 1):
+            try:
+                await self.bot.send_message(admin_id, **payload)
+                return True
+            except TelegramRetryAfter as e:
+                # Превышен лимит Telegram: ждем столько, сколько просит API
+                if attempt == tries:
+                    logger.error("Лимит отправки сообщений админу %s не снят за %s попыток", admin_id, tries)
+                    return False
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest:
+                # Повтор некорректного запроса не поможет
+                logger.exception("Telegram отклонил уведомление админу %s", admin_id)
+                return False
+            except TelegramNetworkError:
+                if attempt == tries:
+                    logger.exception("Ошибка сети при отправке уведомления админу %s", admin_id)
+                    return False
+                await asyncio.sleep(SEND_RETRY_DELAY * 2 ** (attempt - 1))
+            except Exception:
+                logger.exception("Ошибка отправки уведомления админу %s", admin_id)
+                return False
+
+        return False
+
+    def _enqueue(self, event_type: str, message: str, urgent: bool = False):
+        """Постановка уведомления в очередь на отправку
+
+        Args:
+            event_type (str): Тип события
+            message (str): Текст уведомления
+            urgent (bool, optional): Критичное уведомление, отправляется вне сводок. По умолчанию False.
+        """
+        if urgent:
+            self._hi.put_nowait(message)
+        else:
+            # При переполнении очереди отбрасываем самое старое событие
+            if self._lo.full():
+                self._lo.get_nowait()
+
+            self._lo.put_nowait((event_type, message))
+
+        self._wakeup.set()
+
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.create_task(self._worker())
+
+    async def _worker(self):
+        """Фоновая задача отправки уведомлений
+
+        Критичные уведомления отправляются сразу по одному. Обычные накапливаются
+        и отправляются сводкой, когда набралось BATCH_MAX_SIZE событий или прошло
+        BATCH_FLUSH_INTERVAL секунд с первого события в сводке.
+        """
+        loop = asyncio.get_running_loop()
+        pending = []
+        deadline = None
+
+        while True:
+            self._wakeup.clear()
+
+            try:
+                while not self._hi.empty():
+                    await self._broadcast(self._hi.get_nowait())
+
+                while not self._lo.empty() and len(pending) < BATCH_MAX_SIZE:
+                    if not pending:
+                        deadline = loop.time() + BATCH_FLUSH_INTERVAL
+                    pending.append(self._lo.get_nowait())
+
+                # При выключении сводка отправляется сразу, не дожидаясь срока
+                if pending and (len(pending) >= BATCH_MAX_SIZE or loop.time() >= deadline or self._closing):
+                    batch, pending = pending, []
+                    for message in self._build_digest(batch):
+                        await self._broadcast(message)
+                    continue
+            except Exception:
+                logger.exception("Ошибка отправки уведомлений")
+                continue
+
+            if self._closing and not pending and self._hi.empty() and self._lo.empty():
+                return
+
+            # Ждем новых событий или истечения времени накопления сводки
+            timeout = max(deadline - loop.time(), 0) if pending else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def _build_digest(batch: list) -> list:
+        """Сборка сводки из накопленных уведомлений
+
+        Args:
+            batch (list): Список пар (тип события, текст уведомления)
+
+        Returns:
+            list: Список сообщений, не превышающих ограничение Telegram по длине
+        """
+        # Группируем уведомления по типу события, сохраняя порядок появления
+        sections = {}
+        for event_type, message in batch:
+            sections.setdefault(event_type, []).append(message)
+
+        messages = []
+        current = ""
+        for section in sections.values():
+            for message in section:
+                if current and len(current) + len(message) + 2 > MESSAGE_MAX_LENGTH:
+                    messages.append(current)
+                    current = ""
+                current = f"{current}\n\n{message}" if current else message
+
+        if current:
+            messages.append(current)
+
+        return messages
+
+    @staticmethod
+    def _build_new_payment_message(payment: Payment, user: User) -> str:
+        """Формирование уведомления о новом платеже
+
+        Args:
+            payment (Payment): Объект платежа
+            user (User): Объект пользователя
+
+        Returns:
+            str: Текст сообщения в формате MarkdownV2
+        """
+        return NEW_PAYMENT_TPL.format_map({
+            "payment_id": payment.id,
+            "first_name": _md(user.first_name),
+            "last_name": _md(user.last_name or ''),
+            "username": _md(user.username or 'нет'),
+            "user_id": user.id,
+            "telegram_id": user.telegram_id,
+            "amount": _md(f"{payment.amount:.2f}"),
+            "currency": _md(payment.currency),
+            "provider": _md(payment.payment_provider),
+            "time": _md(_fmt_datetime(payment.created_at)),
+            "status": _md(payment.status)
+        })
+
+    @staticmethod
+    def _build_large_payment_message(payment: Payment, user: User) -> str:
+        """Формирование уведомления о крупном платеже
+
+        Args:
+            payment (Payment): Объект платежа
+            user (User): Объект пользователя
+
+        Returns:
+            str: Текст сообщения в формате MarkdownV2
+        """
+        return LARGE_PAYMENT_TPL.format_map({
+            "amount": _md(f"{payment.amount:.2f}"),
+            "currency": _md(payment.currency),
+            "first_name": _md(user.first_name),
+            "last_name": _md(user.last_name or ''),
+            "user_id": user.id,
+            "time": _md(_fmt_datetime(payment.created_at))
+        })
+
+    @staticmethod
+    def _build_new_user_message(user: User) -> str:
+        """Формирование уведомления о новом пользователе
+
+        Args:
+            user (User): Объект пользователя
+
+        Returns:
+            str: Текст сообщения в формате MarkdownV2
+        """
+        return NEW_USER_TPL.format_map({
+            "first_name": _md(user.first_name),
+            "last_name": _md(user.last_name or ''),
+            "username": _md(user.username or 'нет'),
+            "telegram_id": user.telegram_id,
+            "time": _md(_fmt_datetime(user.created_at)),
+            "referral": 'Да' if user.referred_by else 'Нет'
+        })
+
+    @staticmethod
+    def _build_suspicious_activity_message(user: User, activity_type: str, details: str) -> str:
+        """Формирование уведомления о подозрительной активности
+
+        Args:
+            user (User): Объект пользователя
+            activity_type (str): Тип активности
+            details (str): Детали активности
+
+        Returns:
+            str: Текст сообщения в формате MarkdownV2
+        """
+        return SUSPICIOUS_ACTIVITY_TPL.format_map({
+            "activity_type": _md(activity_type),
+            "first_name": _md(user.first_name),
+            "last_name": _md(user.last_name or ''),
+            "username": _md(user.username or 'нет'),
+            "telegram_id": user.telegram_id,
+            "details": _md(details)
+        })
+
+    @staticmethod
+    def _build_report_message(data: dict) -> str:
+        """Формирование текста ежедневного отчета
+
+        Args:
+            data (dict): Статистика за последние 24 часа
+
+        Returns:
+            str: Текст сообщения в формате MarkdownV2
+        """
+        report_date = _fmt_datetime(datetime.now()).split(' ')[0]
+
+        message = DAILY_REPORT_TPL.format_map({
+            "date": _md(report_date),
+            "new_users": data["new_users"],
+            "new_payments": data["new_payments"],
+            "successful_payments": data["successful_payments"],
+            "revenue": _md(f"{data['revenue']:.2f}")
+        })
+
+        lines = [
+            f"{i}\\. {_md_cached(service_name)}: {count} покупок\n"
+            for i, (service_name, count) in enumerate(data["popular_services"], 1)
+        ]
+        message += "".join(lines)
+
+        return message
+
+    @staticmethod
+    def _build_service_purchased_message(payment: Payment, user: User, service: Service) -> str:
+        """Формирование уведомления о покупке услуги
+
+        Args:
+            payment (Payment): Объект платежа
+            user (User): Объект пользователя
+            service (Service): Объект услуги
+
+        Returns:
+            str: Текст сообщения в формате MarkdownV2
+        """
+        return SERVICE_PURCHASED_TPL.format_map({
+            "service_name": _md(service.name),
+            "price": _md(f"{service.price:.2f}"),
+            "currency": _md(service.currency),
+            "first_name": _md(user.first_name),
+            "last_name": _md(user.last_name or ''),
+            "username": _md(user.username or 'нет'),
+            "user_id": user.id,
+            "time": _md(_fmt_datetime(payment.created_at))
+        })
 
     async def notify_new_payment(self, payment: Payment, user: User):
         """Уведомление о новом платеже
@@ -24,29 +492,15 @@ class AdminNotifier:
             payment (Payment): Объект платежа
             user (User): Объект пользователя
         """
-        if not config.Config.ADMINS:
+        if not self._admins:
             return
 
-        payment_time = payment.created_at.strftime('%d.%m.%Y %H:%M')
-
-        message = (
-            "💰 *НОВЫЙ ПЛАТЕЖ*\n\n"
-            f"*ID платежа:* `{payment.id}`\n"
-            f"*Пользователь:* {user.first_name} {user.last_name or ''}\n"
-            f"*Username:* @{user.username or 'нет'}\n"
-            f"*User ID:* `{user.id}`\n"
-            f"*Telegram ID:* `{user.telegram_id}`\n"
-            f"*Сумма:* {payment.amount:.2f} {payment.currency}\n"
-            f"*Провайдер:* {payment.payment_provider}\n"
-            f"*Время:* {payment_time}\n"
-            f"*Статус:* {payment.status}"
-        )
-
-        for admin_id in config.Config.ADMINS:
-            try:
-                await self.bot.send_message(admin_id, message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        message = self._build_new_payment_message(payment, user)
+
+        # Новые данные делают закэшированный отчет неактуальным
+        self._daily_cache = None
+
+        self._enqueue("new_payment", message)
 
     async def notify_large_payment(self, payment: Payment, user: User, threshold: float = 5000):
         """Уведомление о крупном платеже
@@ -59,19 +513,12 @@ class AdminNotifier:
         if payment.amount < threshold:
             return
 
-        message = (
-            "⚠️ *КРУПНЫЙ ПЛАТЕЖ*\n\n"
-            f"*Сумма:* {payment.amount:.2f} {payment.currency}\n"
-            f"*Пользователь:* {user.first_name} {user.last_name or ''}\n"
-            f"*User ID:* `{user.id}`\n"
-            f"*Время:* {payment.created_at.strftime('%d.%m.%Y %H:%M')}"
-        )
+        if not self._admins:
+            return
 
-        for admin_id in config.Config.ADMINS:
-            try:
-                await self.bot.send_message(admin_id, message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        message = self._build_large_payment_message(payment, user)
+
+        self._enqueue("large_payment", message, urgent=True)
 
     async def notify_new_user(self, user: User):
         """Уведомление о новом пользователе
@@ -79,33 +526,37 @@ class AdminNotifier:
         Args:
             user (User): Объект пользователя
         """
-        if not config.Config.ADMINS:
+        if not self._admins:
             return
 
         # Проверяем, чтобы не спамить уведомлениями
-        user_key = f"new_user_{user.id}"
-        now = datetime.now()
+        now = time.monotonic()
+        last = self.last_notification_time.get(user.id)
 
-        if user_key in self.last_notification_time:
-            if now - self.last_notification_time[user_key] < timedelta(minutes=5):
+        if last is not None:
+            self.last_notification_time.move_to_end(user.id)
+            if now - last < NEW_USER_NOTIFY_INTERVAL:
                 return
 
-        self.last_notification_time[user_key] = now
+        self.last_notification_time[user.id] = now
+        self._notification_inserts += 1
 
-        message = (
-            "👤 *НОВЫЙ ПОЛЬЗОВАТЕЛЬ*\n\n"
-            f"*Имя:* {user.first_name} {user.last_name or ''}\n"
-            f"*Username:* @{user.username or 'нет'}\n"
-            f"*Telegram ID:* `{user.telegram_id}`\n"
-            f"*Время регистрации:* {user.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-            f"*Реферал:* {'Да' if user.referred_by else 'Нет'}"
-        )
+        while len(self.last_notification_time) > NOTIFICATION_CACHE_SIZE:
+            self.last_notification_time.popitem(last=False)
 
-        for admin_id in config.Config.ADMINS:
-            try:
-                await self.bot.send_message(admin_id, message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        # Периодически удаляем устаревшие отметки, чтобы словарь не рос вместе с базой пользователей
+        if self._notification_inserts % NOTIFICATION_COMPACT_EVERY == 0:
+            self.last_notification_time = OrderedDict(
+                (key, value) for key, value in self.last_notification_time.items()
+                if now - value < NEW_USER_NOTIFY_INTERVAL
+            )
+
+        message = self._build_new_user_message(user)
+
+        # Новые данные делают закэшированный отчет неактуальным
+        self._daily_cache = None
+
+        self._enqueue("new_user", message)
 
     async def notify_suspicious_activity(self, user: User, activity_type: str, details: str = ""):
         """Уведомление о подозрительной активности
@@ -115,77 +566,73 @@ class AdminNotifier:
             activity_type (str): Тип активности
             details (str): Детали активности
         """
-        message = (
-            "🚨 *ПОДОЗРИТЕЛЬНАЯ АКТИВНОСТЬ*\n\n"
-            f"*Тип:* {activity_type}\n"
-            f"*Пользователь:* {user.first_name} {user.last_name or ''}\n"
-            f"*Username:* @{user.username or 'нет'}\n"
-            f"*Telegram ID:* `{user.telegram_id}`\n"
-            f"*Детали:* {details}"
-        )
+        if not self._admins:
+            return
 
-        for admin_id in config.Config.ADMINS:
-            try:
-                await self.bot.send_message(admin_id, message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        message = self._build_suspicious_activity_message(user, activity_type, details)
+
+        self._enqueue("suspicious_activity", message, urgent=True)
+
+    @staticmethod
+    async def _collect_report_data() -> dict:
+        """Сбор данных для ежедневного отчета
+
+        Returns:
+            dict: Статистика за последние 24 часа
+        """
+        async with db.async_session() as session:
+            # Статистика за последние 24 часа
+            yesterday = datetime.now() - timedelta(days=1)
+
+            # Новые пользователи
+            new_users = await session.scalar(
+                select(func.count(User.id)).where(User.created_at >= yesterday)
+            )
+
+            # Новые платежи, успешные платежи и общая выручка одним запросом
+            is_completed = Payment.status == "completed"
+            result = await session.execute(
+                select(
+                    func.count(Payment.id),
+                    func.sum(case((is_completed, 1), else_=0)),
+                    func.sum(case((is_completed, Payment.amount), else_=0))
+                ).where(Payment.created_at >= yesterday)
+            )
+            new_payments, successful_payments, revenue = result.one()
+
+            # Популярные услуги: группировка по индексированному service_id
+            result = await session.execute(
+                select(
+                    Service.name,
+                    func.count(Payment.id).label('count')
+                ).join(Service, Service.id == Payment.service_id).where(
+                    Payment.created_at >= yesterday,
+                    Payment.status == "completed"
+                ).group_by(Service.id, Service.name).order_by(func.count(Payment.id).desc()).limit(5)
+            )
+            popular_services = result.all()
+
+        return {
+            "new_users": new_users,
+            "new_payments": new_payments,
+            "successful_payments": successful_payments or 0,
+            "revenue": revenue or 0,
+            "popular_services": popular_services
+        }
 
     async def send_daily_report(self):
         """Отправка ежедневного отчета администраторам"""
-        session = db.get_session()
-
-        # Статистика за последние 24 часа
-        yesterday = datetime.now() - timedelta(days=1)
-
-        # Новые пользователи
-        new_users = session.query(User).filter(User.created_at >= yesterday).count()
-
-        # Новые платежи
-        new_payments = session.query(Payment).filter(Payment.created_at >= yesterday).count()
-
-        # Успешные платежи
-        successful_payments = session.query(Payment).filter(
-            Payment.created_at >= yesterday,
-            Payment.status == "completed"
-        ).count()
-
-        # Общая выручка
-        revenue = session.query(db.func.sum(Payment.amount)).filter(
-            Payment.created_at >= yesterday,
-            Payment.status == "completed"
-        ).scalar() or 0
-
-        # Популярные услуги
-        from sqlalchemy import func
-        popular_services = session.query(
-            Payment.invoice_payload,
-            func.count(Payment.id).label('count')
-        ).filter(
-            Payment.created_at >= yesterday,
-            Payment.status == "completed"
-        ).group_by(Payment.invoice_payload).order_by(func.count(Payment.id).desc()).limit(5).all()
-
-        session.close()
-
-        report_date = datetime.now().strftime('%d.%m.%Y')
-
-        message = (
-            f"📊 *ЕЖЕДНЕВНЫЙ ОТЧЕТ ({report_date})*\n\n"
-            f"*Новые пользователи:* {new_users}\n"
-            f"*Новые платежи:* {new_payments}\n"
-            f"*Успешные платежи:* {successful_payments}\n"
-            f"*Общая выручка:* {revenue:.2f} RUB\n\n"
-            "*Топ-5 популярных услуг:*\n"
-        )
-
-        for i, (service_name, count) in enumerate(popular_services, 1):
-            message += f"{i}. {service_name}: {count} покупок\n"
-
-        for admin_id in config.Config.ADMINS:
-            try:
-                await self.bot.send_message(admin_id, message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Ошибка отправки отчета админу {admin_id}: {e}")
+        if self._daily_cache and time.monotonic() - self._daily_cache[0] < DAILY_REPORT_CACHE_TTL:
+            await self._broadcast(self._daily_cache[1])
+            return
+
+        data = await self._collect_report_data()
+
+        message = await asyncio.to_thread(self._build_report_message, data)
+
+        self._daily_cache = (time.monotonic(), message)
+
+        await self._broadcast(message)
 
     async def notify_service_purchased(self, payment: Payment, user: User, service: Service):
         """Уведомление о покупке услуги
@@ -195,18 +642,26 @@ class AdminNotifier:
             user (User): Объект пользователя
             service (Service): Объект услуги
         """
-        message = (
-            "🛒 *ПОКУПКА УСЛУГИ*\n\n"
-            f"*Услуга:* {service.name}\n"
-            f"*Цена:* {service.price:.2f} {service.currency}\n"
-            f"*Пользователь:* {user.first_name} {user.last_name or ''}\n"
-            f"*Username:* @{user.username or 'нет'}\n"
-            f"*User ID:* `{user.id}`\n"
-            f"*Время:* {payment.created_at.strftime('%d.%m.%Y %H:%M')}"
-        )
-
-        for admin_id in config.Config.ADMINS:
-            try:
-                await self.bot.send_message(admin_id, message, parse_mode="Markdown")
-            except Exception as e:
-                print(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        message = self._build_service_purchased_message(payment, user, service)
+
+        self._enqueue("service_purchased", message)
+
+
+_instance = None
+
+
+def get_notifier(bot: Bot) -> AdminNotifier:
+    """Получение единственного экземпляра AdminNotifier
+
+    Args:
+        bot (Bot): Объект бота
+
+    Returns:
+        AdminNotifier: Общий экземпляр уведомителя
+    """
+    global _instance
+
+    if _instance is None:
+        _instance = AdminNotifier(bot)
+
+    return _instance
@@ -1,51 +1,181 @@
+import asyncio
 import logging
-
-from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram.contrib.fsm_storage.redis import RedisStorage2
-from aiogram.dispatcher import FSMContext
-from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from aiogram.utils import executor
+import queue
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import nullcontext
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+import msgspec
+from aiogram import Bot, Dispatcher, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramAPIError
+from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import aiohttp
+from aiohttp import web
+from redis.exceptions import ConnectionError as RedisConnectionError
+from sqlalchemy import and_, func, insert, or_, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import contains_eager
 
 import config
-from admin_notifications import AdminNotifier
-from database import db, Service
+from admin_notifications import get_notifier
+from cache import acquire_once, cache_get, cache_set, redis_client
+from database import db, Service, User
+from db_middleware import DbSessionMiddleware
 from export_system import ExportSystem
 from keyboards import (
     get_referral_keyboard, get_currency_keyboard,
-    get_subscription_keyboard
+    get_subscription_keyboard, ReferralCallback, PromoCallback,
+    SubscriptionCallback, ExportCallback, EXPORT_KEYBOARD
 )
 from multi_currency import CurrencyConverter, SupportedCurrency
 from payment_system import PaymentManager
 from promo_system import PromoSystem
+from rate_limiter import RateLimitMiddleware
 from referral_system import ReferralSystem
-from subscription_system import SubscriptionSystem, SubscriptionStatus
+from subscription_system import SubscriptionSystem, SubscriptionStatus, SubscriptionPlan, UserSubscription
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+try:
+    import uvloop
+except ImportError:  # uvloop недоступен на Windows
+    uvloop = None
+
+# Настройка логирования: обработчики пишут в очередь, а вывод в поток выполняет
+# QueueListener в отдельном потоке, поэтому event loop не блокируется на записи логов
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener.start()
 logger = logging.getLogger(__name__)
 
 # Инициализация бота и диспетчера
-bot = Bot(token=config.Config.BOT_TOKEN)
+# Бот использует одну постоянную aiohttp-сессию с пулом keep-alive соединений,
+# ответы Bot API разбираются через msgspec
+bot_session = AiohttpSession(
+    limit=config.Config.BOT_CONNECTIONS_LIMIT,
+    json_loads=msgspec.json.decode,
+    json_dumps=lambda obj: msgspec.json.encode(obj).decode()
+)
+# Все запросы бота выдерживают лимиты Telegram на частоту отправки сообщений
+bot_session.middleware(RateLimitMiddleware())
+bot = Bot(token=config.Config.BOT_TOKEN, session=bot_session)
 
-# Используем Redis для хранения состояний, если он доступен
-try:
-    storage = RedisStorage2(config.Config.REDIS_URL)
-except:
+# Состояния FSM хранятся в Redis, чтобы их видели все процессы бота.
+# MemoryStorage используется только при явном FSM_STORAGE=memory
+if config.Config.FSM_STORAGE == "memory":
     storage = MemoryStorage()
+else:
+    storage = RedisStorage.from_url(
+        config.Config.REDIS_URL,
+        connection_kwargs={"max_connections": config.Config.REDIS_MAX_CONNECTIONS}
+    )
 
-dp = Dispatcher(bot, storage=storage)
+dp = Dispatcher(storage=storage)
+router = Router()
+# Обработчики получают одну сессию БД на обновление в аргументе session
+router.message.middleware(DbSessionMiddleware())
+router.callback_query.middleware(DbSessionMiddleware())
+dp.include_router(router)
 
 # Инициализация всех систем
 payment_manager = PaymentManager(bot)
-admin_notifier = AdminNotifier(bot)
+admin_notifier = get_notifier(bot)
 referral_system = ReferralSystem()
 promo_system = PromoSystem()
 subscription_system = SubscriptionSystem(bot)
 currency_converter = CurrencyConverter()
 export_system = ExportSystem()
 
+# Общая HTTP-сессия для запросов систем к внешним API (создается в on_startup)
+HTTP_CONNECTIONS_LIMIT = 200
+HTTP_DNS_CACHE_TTL = 300  # секунды
+http_session: Optional[aiohttp.ClientSession] = None
+
+# Статические тексты сообщений собираются один раз при импорте модуля
+PROMO_TEXT = (
+    "🎫 *Промокоды и скидки*\n\n"
+    "Введите промокод для получения скидки:\n"
+    "Или используйте команду /promo_apply [код]"
+)
+SUBSCRIPTION_CHOOSE_TEXT = "🛒 *Доступные подписки*\n\nВыберите план подписки:"
+SUBSCRIPTION_CANCELLED_TEXT = "✅ *Подписка отменена!*\n\nВы можете возобновить ее в любое время."
+REFERRAL_REWARD_TEXT = (
+    f"За каждого приглашенного друга вы получаете {config.Config.REFERRAL_REWARD_PERCENT}% от его первого платежа!"
+)
+REFERRAL_SHARE_TEXT = (
+    f"Поделитесь этой ссылкой с друзьями и получайте {config.Config.REFERRAL_REWARD_PERCENT}% от их первого платежа!"
+)
+STARTUP_TEXT = "✅ Бот запущен и готов к работе!"
+EXPORT_TEXT = "📤 *Экспорт данных*\n\nВыберите формат экспорта:"
+
+# Тестовые услуги, создаваемые при запуске
+SEED_SERVICES = [
+    {
+        "name": "Базовая подписка",
+        "description": "Доступ к базовым функциям на 30 дней",
+        "price": 299.0,
+        "currency": "RUB",
+    },
+    {
+        "name": "Премиум подписка",
+        "description": "Доступ ко всем функциям на 30 дней",
+        "price": 999.0,
+        "currency": "RUB",
+    },
+    {
+        "name": "Разовая консультация",
+        "description": "Консультация со специалистом (60 минут)",
+        "price": 1500.0,
+        "currency": "RUB",
+    },
+]
+
+# Долгие операции выполняются в фоне, чтобы не задерживать обработку других чатов:
+# в пределах чата по очереди, всего не более BACKGROUND_TASKS_LIMIT одновременно
+BACKGROUND_TASKS_LIMIT = 100
+chat_locks = weakref.WeakValueDictionary()
+background_semaphore = asyncio.Semaphore(BACKGROUND_TASKS_LIMIT)
+background_tasks = set()
+
+
+async def _run_chat_task(chat_id, coro):
+    """Выполнение фоновой операции с сохранением порядка внутри чата
+
+    Args:
+        chat_id (int): ID чата
+        coro (Coroutine): Корутина с операцией
+    """
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = chat_locks[chat_id] = asyncio.Lock()
+
+    async with lock, background_semaphore:
+        await coro
+
+
+def run_in_background(chat_id, coro):
+    """Запуск долгой операции в фоне, не блокируя обработчик
+
+    Args:
+        chat_id (int): ID чата
+        coro (Coroutine): Корутина с операцией
+    """
+    task = asyncio.create_task(_run_chat_task(chat_id, coro))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
 
 # Состояния FSM
 class PaymentStates(StatesGroup):
@@ -72,18 +202,134 @@ class ReferralStates(StatesGroup):
     waiting_for_referral_code = State()
 
 
+# Кэш пользователей: get_or_create_user вызывается почти в каждом обработчике.
+# Первый уровень - в памяти процесса, второй - в Redis, общий для всех процессов
+USER_CACHE_KEY = "user:{telegram_id}"
+USER_CACHE_TTL = 60  # секунды
+USER_CACHE_SIZE = 10000
+
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Данные пользователя, которые используют обработчики"""
+
+    id: int
+    telegram_id: int
+    username: Optional[str]
+    balance: float
+    is_admin: bool
+
+
+# Декодер сразу собирает CachedUser из JSON без промежуточного словаря
+user_decoder = msgspec.json.Decoder(CachedUser)
+
+# telegram_id -> (время истечения, данные пользователя)
+_user_cache = OrderedDict()
+
+
+def _remember_user(cached_user: CachedUser):
+    """Сохранение пользователя в кэше процесса
+
+    Args:
+        cached_user (CachedUser): Данные пользователя
+    """
+    _user_cache[cached_user.telegram_id] = (time.monotonic() + USER_CACHE_TTL, cached_user)
+    _user_cache.move_to_end(cached_user.telegram_id)
+    if len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+
+
+async def get_or_create_user(telegram_user: types.User, session: Optional[AsyncSession] = None) -> CachedUser:
+    """Получение пользователя из кэша, базы данных или его создание
+
+    Args:
+        telegram_user (types.User): Пользователь Telegram
+        session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
+
+    Returns:
+        CachedUser: Данные пользователя
+    """
+    entry = _user_cache.get(telegram_user.id)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+
+    cache_key = USER_CACHE_KEY.format(telegram_id=telegram_user.id)
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        cached_user = user_decoder.decode(cached)
+        _remember_user(cached_user)
+        return cached_user
+
+    async with nullcontext(session) if session is not None else db.async_session() as session:
+        result = await session.execute(select(User).where(User.telegram_id == telegram_user.id))
+        user = result.scalar_one_or_none()
+
+        if user is None:
+            user = User(
+                telegram_id=telegram_user.id,
+                username=telegram_user.username,
+                first_name=telegram_user.first_name,
+                last_name=telegram_user.last_name,
+                is_admin=telegram_user.id in config.Config.ADMINS
+            )
+            session.add(user)
+            try:
+                await session.commit()
+            except IntegrityError:
+                # Первые апдейты нового пользователя обработаны параллельно и другой
+                # обработчик уже создал его: берем созданную запись
+                await session.rollback()
+                result = await session.execute(select(User).where(User.telegram_id == telegram_user.id))
+                user = result.scalar_one()
+
+    cached_user = CachedUser(
+        id=user.id,
+        telegram_id=user.telegram_id,
+        username=user.username,
+        balance=user.balance or 0.0,
+        is_admin=bool(user.is_admin)
+    )
+    await cache_set(cache_key, msgspec.json.encode(cached_user), USER_CACHE_TTL)
+    _remember_user(cached_user)
+
+    return cached_user
+
+
+# Защита от повторной доставки колбэков с побочными эффектами: ключ - ID колбэка,
+# поэтому новое нажатие той же кнопки (например, повторная покупка) не блокируется
+CALLBACK_ONCE_KEY = "cb:{callback_id}"
+CALLBACK_ONCE_TTL = 60  # секунды
+
+
+async def is_duplicate_callback(callback_query: types.CallbackQuery) -> bool:
+    """Проверка, что этот колбэк уже обрабатывается
+
+    Args:
+        callback_query (types.CallbackQuery): Колбэк
+
+    Returns:
+        bool: True, если колбэк является дублем (пользователю уже отправлен ответ)
+    """
+    key = CALLBACK_ONCE_KEY.format(callback_id=callback_query.id)
+    if await acquire_once(key, CALLBACK_ONCE_TTL):
+        return False
+
+    await bot.answer_callback_query(callback_query.id, "Обрабатывается...")
+    return True
+
+
 # Новые обработчики команд для расширенной функциональности
 
-@dp.message_handler(commands=['referral'])
-async def cmd_referral(message: types.Message):
+@router.message(Command("referral"))
+async def cmd_referral(message: types.Message, session: AsyncSession):
     """Обработчик команды /referral"""
-    user = await get_or_create_user(message.from_user)
+    user = await get_or_create_user(message.from_user, session)
 
     # Получаем статистику рефералов
-    stats = referral_system.get_user_referral_stats(user.id)
+    stats = await referral_system.get_user_referral_stats(user.id, session)
 
     # Получаем реферальные ссылки
-    links = referral_system.get_referral_links(user.id)
+    links = await referral_system.get_referral_links(user.id, session)
 
     text = (
         f"👥 *Реферальная система*\n\n"
@@ -91,7 +337,7 @@ async def cmd_referral(message: types.Message):
         f"*Активных рефералов:* {stats['active_referrals']}\n"
         f"*Рефералов за 30 дней:* {stats['recent_referrals']}\n"
         f"*Общее вознаграждение:* {stats['total_reward']:.2f} RUB\n\n"
-        f"За каждого приглашенного друга вы получаете {config.Config.REFERRAL_REWARD_PERCENT}% от его первого платежа!"
+        f"{REFERRAL_REWARD_TEXT}"
     )
 
     keyboard = get_referral_keyboard(links)
@@ -99,38 +345,39 @@ async def cmd_referral(message: types.Message):
     await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
 
 
-@dp.message_handler(commands=['promo'])
-async def cmd_promo(message: types.Message):
+@router.message(Command("promo"))
+async def cmd_promo(message: types.Message, state: FSMContext, session: AsyncSession):
     """Обработчик команды /promo"""
-    user = await get_or_create_user(message.from_user)
-
-    text = (
-        "🎫 *Промокоды и скидки*\n\n"
-        "Введите промокод для получения скидки:\n"
-        "Или используйте команду /promo_apply [код]"
-    )
+    # Пользователь регистрируется при первом обращении
+    await get_or_create_user(message.from_user, session)
 
-    await message.answer(text, parse_mode="Markdown")
-    await PaymentStates.waiting_for_promo_code.set()
+    await message.answer(PROMO_TEXT, parse_mode="Markdown")
+    await state.set_state(PaymentStates.waiting_for_promo_code)
 
 
-@dp.message_handler(commands=['subscription'])
-async def cmd_subscription(message: types.Message):
+@router.message(Command("subscription"))
+async def cmd_subscription(message: types.Message, session: AsyncSession):
     """Обработчик команды /subscription"""
-    user = await get_or_create_user(message.from_user)
-
-    session = db.get_session()
-    plans = session.query(SubscriptionPlan).filter(
-        SubscriptionPlan.is_active == True
-    ).all()
-
-    # Проверяем текущую подписку пользователя
-    current_subscription = session.query(UserSubscription).filter(
-        UserSubscription.user_id == user.id,
-        UserSubscription.status == SubscriptionStatus.ACTIVE
-    ).first()
+    user = await get_or_create_user(message.from_user, session)
+
+    # Активные планы и текущая подписка пользователя одним запросом: к каждому плану
+    # присоединяется активная подписка пользователя на него (план подписки загружается сразу,
+    # ленивая загрузка после закрытия асинхронной сессии невозможна)
+    result = await session.execute(
+        select(SubscriptionPlan, UserSubscription)
+        .outerjoin(UserSubscription, and_(
+            UserSubscription.plan_id == SubscriptionPlan.id,
+            UserSubscription.user_id == user.id,
+            UserSubscription.status == SubscriptionStatus.ACTIVE
+        ))
+        .options(contains_eager(UserSubscription.plan))
+        .where(or_(SubscriptionPlan.is_active == True, UserSubscription.id.isnot(None)))
+        .order_by(SubscriptionPlan.id)
+    )
+    rows = result.all()
 
-    session.close()
+    plans = [plan for plan, _ in rows if plan.is_active]
+    current_subscription = next((subscription for _, subscription in rows if subscription is not None), None)
 
     if current_subscription:
         plan = current_subscription.plan
@@ -143,17 +390,18 @@ async def cmd_subscription(message: types.Message):
             f"*Автопродление:* {'Включено' if current_subscription.auto_renewal else 'Выключено'}"
         )
     else:
-        text = "🛒 *Доступные подписки*\n\nВыберите план подписки:"
+        text = SUBSCRIPTION_CHOOSE_TEXT
 
     keyboard = get_subscription_keyboard(plans, current_subscription)
 
     await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
 
 
-@dp.message_handler(commands=['currency'])
-async def cmd_currency(message: types.Message):
+@router.message(Command("currency"))
+async def cmd_currency(message: types.Message, session: AsyncSession):
     """Обработчик команды /currency"""
-    user = await get_or_create_user(message.from_user)
+    # Пользователь регистрируется при первом обращении
+    await get_or_create_user(message.from_user, session)
 
     currencies = await currency_converter.get_supported_currencies()
     default_currency = await currency_converter.get_default_currency()
@@ -169,174 +417,157 @@ async def cmd_currency(message: types.Message):
     await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
 
 
-@dp.message_handler(commands=['export'])
-async def cmd_export(message: types.Message):
+@router.message(Command("export"))
+async def cmd_export(message: types.Message, session: AsyncSession):
     """Обработчик команды /export (только для администраторов)"""
-    user = await get_or_create_user(message.from_user)
+    user = await get_or_create_user(message.from_user, session)
 
     if not user.is_admin:
         await message.answer("⛔ У вас нет доступа к этой команде.")
         return
 
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        InlineKeyboardButton("📊 CSV платежей", callback_data="export_payments_csv"),
-        InlineKeyboardButton("📊 Excel платежей", callback_data="export_payments_excel"),
-        InlineKeyboardButton("👥 CSV пользователей", callback_data="export_users_csv"),
-        InlineKeyboardButton("📈 JSON статистика", callback_data="export_statistics_json"),
-        InlineKeyboardButton("📋 Детальный отчет", callback_data="export_detailed_report"),
-        InlineKeyboardButton("❌ Отмена", callback_data="cancel_export")
-    )
-
-    await message.answer("📤 *Экспорт данных*\n\nВыберите формат экспорта:",
-                         parse_mode="Markdown", reply_markup=keyboard)
+    await message.answer(EXPORT_TEXT, parse_mode="Markdown", reply_markup=EXPORT_KEYBOARD)
 
 
 # Новые обработчики колбэков для расширенной функциональности
 
-@dp.callback_query_handler(lambda c: c.data.startswith('referral_'))
-async def process_referral_callback(callback_query: types.CallbackQuery):
-    """Обработчик колбэков реферальной системы"""
-    action = callback_query.data.split('_')[1]
-
-    if action == 'create':
-        # Создание новой реферальной ссылки
-        user = await get_or_create_user(callback_query.from_user)
-
-        try:
-            referral_link = referral_system.generate_referral_code(user.id)
-
-            await bot.answer_callback_query(callback_query.id)
-            await bot.send_message(
-                callback_query.from_user.id,
-                f"✅ *Новая реферальная ссылка создана!*\n\n"
-                f"*Код:* `{referral_link.code}`\n"
-                f"*Ссылка:* {referral_link.link}\n"
-                f"*Срок действия:* {referral_link.expires_at.strftime('%d.%m.%Y')}\n"
-                f"*Максимум использований:* {referral_link.max_uses or '∞'}\n\n"
-                f"Поделитесь этой ссылкой с друзьями и получайте {config.Config.REFERRAL_REWARD_PERCENT}% от их первого платежа!",
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            await bot.answer_callback_query(callback_query.id, "Ошибка создания ссылки")
-
-    elif action == 'stats':
-        # Показать статистику
-        user = await get_or_create_user(callback_query.from_user)
-        stats = referral_system.get_user_referral_stats(user.id)
-
-        text = (
-            f"📊 *Статистика рефералов*\n\n"
-            f"*Всего рефералов:* {stats['total_referrals']}\n"
-            f"*Активных рефералов:* {stats['active_referrals']}\n"
-            f"*Рефералов за 30 дней:* {stats['recent_referrals']}\n"
-            f"*Общее вознаграждение:* {stats['total_reward']:.2f} RUB"
-        )
-
-        await bot.answer_callback_query(callback_query.id)
-        await bot.send_message(callback_query.from_user.id, text, parse_mode="Markdown")
+async def referral_create(callback_query: types.CallbackQuery, callback_data: ReferralCallback,
+                          state: FSMContext, session: AsyncSession):
+    """Создание новой реферальной ссылки"""
+    if await is_duplicate_callback(callback_query):
+        return
 
+    user = await get_or_create_user(callback_query.from_user, session)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('promo_'))
-async def process_promo_callback(callback_query: types.CallbackQuery, state: FSMContext):
-    """Обработчик колбэков промокодов"""
-    action = callback_query.data.split('_')[1]
+    try:
+        referral_link = await referral_system.generate_referral_code(user.id, session=session)
 
-    if action == 'apply':
         await bot.answer_callback_query(callback_query.id)
         await bot.send_message(
             callback_query.from_user.id,
-            "Введите промокод:"
+            f"✅ *Новая реферальная ссылка создана!*\n\n"
+            f"*Код:* `{referral_link.code}`\n"
+            f"*Ссылка:* {referral_link.link}\n"
+            f"*Срок действия:* {referral_link.expires_at.strftime('%d.%m.%Y')}\n"
+            f"*Максимум использований:* {referral_link.max_uses or '∞'}\n\n"
+            f"{REFERRAL_SHARE_TEXT}",
+            parse_mode="Markdown"
         )
-        await PaymentStates.waiting_for_promo_code.set()
+    except Exception:
+        logger.exception("Ошибка создания реферальной ссылки")
+        await bot.answer_callback_query(callback_query.id, "Ошибка создания ссылки")
 
-    elif action == 'check':
-        # Проверка промокода (админ)
-        user = await get_or_create_user(callback_query.from_user)
 
-        if not user.is_admin:
-            await bot.answer_callback_query(callback_query.id, "Нет доступа")
-            return
-
-        await bot.answer_callback_query(callback_query.id)
-        await bot.send_message(
-            callback_query.from_user.id,
-            "Введите промокод для проверки:"
-        )
-        await AdminStates.waiting_for_promo_code.set()
+async def referral_stats(callback_query: types.CallbackQuery, callback_data: ReferralCallback,
+                         state: FSMContext, session: AsyncSession):
+    """Показ статистики рефералов"""
+    user = await get_or_create_user(callback_query.from_user, session)
+    stats = await referral_system.get_user_referral_stats(user.id, session)
 
+    text = (
+        f"📊 *Статистика рефералов*\n\n"
+        f"*Всего рефералов:* {stats['total_referrals']}\n"
+        f"*Активных рефералов:* {stats['active_referrals']}\n"
+        f"*Рефералов за 30 дней:* {stats['recent_referrals']}\n"
+        f"*Общее вознаграждение:* {stats['total_reward']:.2f} RUB"
+    )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('subscription_'))
-async def process_subscription_callback(callback_query: types.CallbackQuery):
-    """Обработчик колбэков подписок"""
-    data_parts = callback_query.data.split('_')
+    await bot.answer_callback_query(callback_query.id)
+    await bot.send_message(callback_query.from_user.id, text, parse_mode="Markdown")
 
-    if len(data_parts) < 2:
-        return
 
-    action = data_parts[1]
+async def promo_apply(callback_query: types.CallbackQuery, callback_data: PromoCallback,
+                      state: FSMContext, session: AsyncSession):
+    """Запрос промокода у пользователя"""
+    await bot.answer_callback_query(callback_query.id)
+    await bot.send_message(
+        callback_query.from_user.id,
+        "Введите промокод:"
+    )
+    await state.set_state(PaymentStates.waiting_for_promo_code)
 
-    if action == 'buy':
-        # Покупка подписки
-        if len(data_parts) < 3:
-            return
 
-        plan_id = int(data_parts[2])
-        user = await get_or_create_user(callback_query.from_user)
+async def promo_check(callback_query: types.CallbackQuery, callback_data: PromoCallback,
+                      state: FSMContext, session: AsyncSession):
+    """Проверка промокода (админ)"""
+    user = await get_or_create_user(callback_query.from_user, session)
 
-        subscription = subscription_system.subscribe_user(user.id, plan_id)
+    if not user.is_admin:
+        await bot.answer_callback_query(callback_query.id, "Нет доступа")
+        return
 
-        if subscription:
-            await bot.answer_callback_query(callback_query.id)
-            await bot.send_message(
-                callback_query.from_user.id,
-                f"✅ *Подписка оформлена!*\n\n"
-                f"Следующий платеж: {subscription.next_billing_date.strftime('%d.%m.%Y')}\n"
-                f"Сумма: {subscription.plan.price:.2f} {subscription.plan.currency}",
-                parse_mode="Markdown"
-            )
-        else:
-            await bot.answer_callback_query(callback_query.id, "Ошибка оформления подписки")
+    await bot.answer_callback_query(callback_query.id)
+    await bot.send_message(
+        callback_query.from_user.id,
+        "Введите промокод для проверки:"
+    )
+    await state.set_state(AdminStates.waiting_for_promo_code)
 
-    elif action == 'cancel':
-        # Отмена подписки
-        if len(data_parts) < 3:
-            return
 
-        subscription_id = int(data_parts[2])
-        user = await get_or_create_user(callback_query.from_user)
+async def subscription_buy(callback_query: types.CallbackQuery, callback_data: SubscriptionCallback,
+                           state: FSMContext, session: AsyncSession):
+    """Покупка подписки"""
+    if await is_duplicate_callback(callback_query):
+        return
 
-        success = subscription_system.cancel_subscription(user.id, subscription_id)
+    user = await get_or_create_user(callback_query.from_user, session)
 
-        if success:
-            await bot.answer_callback_query(callback_query.id)
-            await bot.send_message(
-                callback_query.from_user.id,
-                "✅ *Подписка отменена!*\n\nВы можете возобновить ее в любое время."
-            )
-        else:
-            await bot.answer_callback_query(callback_query.id, "Ошибка отмены подписки")
+    subscription = await subscription_system.subscribe_user(user.id, callback_data.id, session=session)
 
+    if subscription:
+        await subscription_system.schedule_alarms([
+            (subscription.id, subscription.next_billing_date),
+            (subscription.id, subscription.end_date)
+        ])
+        await bot.answer_callback_query(callback_query.id)
+        await bot.send_message(
+            callback_query.from_user.id,
+            f"✅ *Подписка оформлена!*\n\n"
+            f"Следующий платеж: {subscription.next_billing_date.strftime('%d.%m.%Y')}\n"
+            f"Сумма: {subscription.plan.price:.2f} {subscription.plan.currency}",
+            parse_mode="Markdown"
+        )
+    else:
+        await bot.answer_callback_query(callback_query.id, "Ошибка оформления подписки")
 
-@dp.callback_query_handler(lambda c: c.data.startswith('export_'))
-async def process_export_callback(callback_query: types.CallbackQuery):
-    """Обработчик колбэков экспорта"""
-    data_parts = callback_query.data.split('_')
 
-    if len(data_parts) < 2:
+async def subscription_cancel(callback_query: types.CallbackQuery, callback_data: SubscriptionCallback,
+                              state: FSMContext, session: AsyncSession):
+    """Отмена подписки"""
+    if await is_duplicate_callback(callback_query):
         return
 
-    export_type = data_parts[1]
+    user = await get_or_create_user(callback_query.from_user, session)
+
+    success = await subscription_system.cancel_subscription(user.id, callback_data.id, session)
 
-    if export_type == 'cancel':
+    if success:
         await bot.answer_callback_query(callback_query.id)
         await bot.send_message(
             callback_query.from_user.id,
-            "Экспорт отменен."
+            SUBSCRIPTION_CANCELLED_TEXT
         )
+    else:
+        await bot.answer_callback_query(callback_query.id, "Ошибка отмены подписки")
+
+
+async def export_cancel(callback_query: types.CallbackQuery, callback_data: ExportCallback,
+                        state: FSMContext, session: AsyncSession):
+    """Отмена экспорта"""
+    await bot.answer_callback_query(callback_query.id)
+    await bot.send_message(
+        callback_query.from_user.id,
+        "Экспорт отменен."
+    )
+
+
+async def process_export_callback(callback_query: types.CallbackQuery, callback_data: ExportCallback,
+                                  state: FSMContext, session: AsyncSession):
+    """Обработчик колбэков экспорта"""
+    if await is_duplicate_callback(callback_query):
         return
 
-    user = await get_or_create_user(callback_query.from_user)
+    user = await get_or_create_user(callback_query.from_user, session)
 
     if not user.is_admin:
         await bot.answer_callback_query(callback_query.id, "Нет доступа")
@@ -344,43 +575,104 @@ async def process_export_callback(callback_query: types.CallbackQuery):
 
     await bot.answer_callback_query(callback_query.id, "Готовлю файл...")
 
-    try:
-        if export_type == 'payments_csv':
-            file = await export_system.export_payments_csv()
-            await bot.send_document(callback_query.from_user.id, file)
+    # Формирование файла может занять время, поэтому не держим обработчик
+    chat_id = callback_query.from_user.id
+    run_in_background(chat_id, send_export(chat_id, callback_data.type))
 
-        elif export_type == 'payments_excel':
-            file = await export_system.export_payments_excel()
-            await bot.send_document(callback_query.from_user.id, file)
 
-        elif export_type == 'users_csv':
-            file = await export_system.export_users_csv()
-            await bot.send_document(callback_query.from_user.id, file)
+# Тип экспорта -> метод, формирующий файл
+EXPORTERS = {
+    "payments_csv": export_system.export_payments_csv,
+    "payments_excel": export_system.export_payments_excel,
+    "users_csv": export_system.export_users_csv,
+    "statistics_json": export_system.export_statistics_json,
+    "detailed_report": export_system.export_detailed_report,
+}
 
-        elif export_type == 'statistics_json':
-            file = await export_system.export_statistics_json()
-            await bot.send_document(callback_query.from_user.id, file)
 
-        elif export_type == 'detailed_report':
-            file = await export_system.export_detailed_report()
-            await bot.send_document(callback_query.from_user.id, file)
+async def send_export(chat_id, export_type):
+    """Формирование и отправка файла экспорта
+
+    Args:
+        chat_id (int): ID чата
+        export_type (str): Тип экспорта
+    """
+    exporter = EXPORTERS.get(export_type)
+    if exporter is None:
+        return
+
+    try:
+        file = await exporter()
+        await bot.send_document(chat_id, file)
 
     except Exception as e:
         logger.error(f"Ошибка экспорта: {e}")
         await bot.send_message(
-            callback_query.from_user.id,
+            chat_id,
             f"❌ Ошибка при экспорте: {str(e)}"
         )
 
 
+# Таблица маршрутов колбэков: "префикс:действие" -> (класс данных колбэка, обработчик).
+# Один обработчик находит действие поиском в словаре вместо перебора фильтров и цепочек elif
+CALLBACK_ROUTES = {
+    "ref:create": (ReferralCallback, referral_create),
+    "ref:stats": (ReferralCallback, referral_stats),
+    "promo:apply": (PromoCallback, promo_apply),
+    "promo:check": (PromoCallback, promo_check),
+    "sub:buy": (SubscriptionCallback, subscription_buy),
+    "sub:cancel": (SubscriptionCallback, subscription_cancel),
+    "export:cancel": (ExportCallback, export_cancel),
+    **{f"export:{export_type}": (ExportCallback, process_export_callback) for export_type in EXPORTERS},
+}
+
+
+@router.callback_query()
+async def dispatch_callback(callback_query: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    """Маршрутизация колбэков по таблице CALLBACK_ROUTES"""
+    data = callback_query.data or ""
+    prefix, _, rest = data.partition(":")
+    route = CALLBACK_ROUTES.get(f"{prefix}:{rest.partition(':')[0]}")
+    if route is None:
+        return
+
+    callback_class, handler = route
+    await handler(callback_query, callback_class.unpack(data), state, session)
+
+
 # Обновленная функция запуска бота
-async def on_startup(dp):
+async def on_startup():
     """Функция, выполняемая при запуске бота"""
     logger.info("Бот запущен")
 
-    # Создаем таблицы в базе данных
-    from database import Base
-    Base.metadata.create_all(db.engine)
+    # Без Redis состояния пользователей потеряются между процессами, поэтому не стартуем молча
+    if config.Config.FSM_STORAGE != "memory":
+        try:
+            await redis_client.ping()
+        except RedisConnectionError as e:
+            logger.critical(f"Redis недоступен ({config.Config.REDIS_URL}): {e}")
+            raise
+
+    # Создаем таблицы и добавляем в существующие новые колонки и индексы:
+    # без миграции запросы к платежам падают, поэтому при ошибке не стартуем
+    try:
+        await db.init_models()
+    except SQLAlchemyError as e:
+        logger.critical(f"Не удалось подготовить схему базы данных: {e}")
+        raise
+
+    # Старые платежи за услуги получают service_id, записанный раньше только в invoice_payload
+    backfilled = await db.backfill_payment_services()
+    if backfilled:
+        logger.info(f"Заполнен service_id у {backfilled} платежей")
+
+    # Одна HTTP-сессия на все системы: соединения с внешними API переиспользуются
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=HTTP_CONNECTIONS_LIMIT, ttl_dns_cache=HTTP_DNS_CACHE_TTL)
+    )
+    payment_manager.set_http_session(http_session)
+    currency_converter.set_http_session(http_session)
 
     # Инициализируем поддерживаемые валюты
     await init_currencies()
@@ -391,122 +683,129 @@ async def on_startup(dp):
     # Запускаем фоновые задачи
     await subscription_system.start_background_tasks()
 
-    # Отправляем уведомление админам о запуске
-    for admin_id in config.Config.ADMINS:
-        try:
-            await bot.send_message(
-                admin_id,
-                "✅ Бот запущен и готов к работе!"
-            )
-        except:
-            pass
+    # Накопившиеся за время простоя обновления пропускаем
+    if config.Config.WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{config.Config.WEBHOOK_URL}{config.Config.WEBHOOK_PATH}",
+            secret_token=config.Config.WEBHOOK_SECRET,
+            drop_pending_updates=True
+        )
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+
+    # Отправляем уведомление админам о запуске параллельно
+    await asyncio.gather(*(notify_admin_started(admin_id) for admin_id in config.Config.ADMINS))
 
 
-async def on_shutdown(dp):
+async def notify_admin_started(admin_id):
+    """Уведомление администратора о запуске бота
+
+    Args:
+        admin_id (int): Telegram ID администратора
+    """
+    try:
+        await bot.send_message(admin_id, STARTUP_TEXT)
+    except TelegramAPIError as e:
+        logger.warning(f"Не удалось уведомить администратора {admin_id} о запуске: {e}")
+
+
+async def on_shutdown():
     """Функция, выполняемая при выключении бота"""
     logger.info("Бот выключается")
 
     # Останавливаем фоновые задачи
-    if subscription_system._task:
-        subscription_system._task.cancel()
+    subscription_system.stop_background_tasks()
 
     await dp.storage.close()
-    await dp.storage.wait_closed()
 
+    if http_session is not None:
+        await http_session.close()
+    await currency_converter.close()
+    await payment_manager.close()
 
-async def init_currencies():
-    """Инициализация поддерживаемых валют"""
-    session = db.get_session()
-
-    # Проверяем, есть ли уже валюты
-    if session.query(SupportedCurrency).count() == 0:
-        currencies = [
-            ("RUB", "Российский рубль", "₽", 2, True),
-            ("USD", "Доллар США", "$", 2, False),
-            ("EUR", "Евро", "€", 2, False),
-            ("KZT", "Казахстанский тенге", "₸", 2, False),
-            ("UAH", "Украинская гривна", "₴", 2, False)
-        ]
-
-        for code, name, symbol, decimal_places, is_default in currencies:
-            currency = SupportedCurrency(
-                code=code,
-                name=name,
-                symbol=symbol,
-                decimal_places=decimal_places,
-                is_default=is_default
-            )
-            session.add(currency)
+    # Закрываем общую HTTP-сессию бота
+    await admin_notifier.aclose()
 
-        session.commit()
-        logger.info("Инициализированы поддерживаемые валюты")
+    await redis_client.aclose()
 
-    session.close()
+    # Дописываем оставшиеся в очереди записи логов
+    log_listener.stop()
 
 
-async def create_sample_data():
-    """Создание тестовых данных"""
-    session = db.get_session()
-
-    # Создаем тестовые услуги
-    if session.query(Service).count() == 0:
-        services = [
-            Service(
-                name="Базовая подписка",
-                description="Доступ к базовым функциям на 30 дней",
-                price=299.0,
-                currency="RUB"
-            ),
-            Service(
-                name="Премиум подписка",
-                description="Доступ ко всем функциям на 30 дней",
-                price=999.0,
-                currency="RUB"
-            ),
-            Service(
-                name="Разовая консультация",
-                description="Консультация со специалистом (60 минут)",
-                price=1500.0,
-                currency="RUB"
-            )
-        ]
-        for service in services:
-            session.add(service)
-
-        session.commit()
-        logger.info("Созданы тестовые услуги")
-
-    # Создаем тестовые планы подписок
-    if session.query(SubscriptionPlan).count() == 0:
-        from subscription_system import SubscriptionPlan
-
-        plans = [
-            SubscriptionPlan(
-                name="Месячная подписка",
-                description="Полный доступ ко всем функциям на 30 дней",
-                price=990.0,
-                currency="RUB",
-                billing_cycle_days=30,
-                trial_period_days=7,
-                features=json.dumps(["Доступ к базовым функциям", "Техническая поддержка", "Обновления"])
-            ),
-            SubscriptionPlan(
-                name="Годовая подписка",
-                description="Полный доступ ко всем функциям на 365 дней (экономия 20%)",
-                price=9500.0,
-                currency="RUB",
-                billing_cycle_days=365,
-                features=json.dumps(
-                    ["Доступ ко всем функциям", "Приоритетная поддержка", "Ранний доступ к новым функциям"])
-            )
-        ]
-        for plan in plans:
-            session.add(plan)
+async def init_currencies():
+    """Инициализация поддерживаемых валют"""
+    async with db.async_session() as session:
+        # Проверяем, есть ли уже валюты
+        count = await session.scalar(select(func.count()).select_from(SupportedCurrency))
+        if count == 0:
+            currencies = [
+                ("RUB", "Российский рубль", "₽", 2, True),
+                ("USD", "Доллар США", "$", 2, False),
+                ("EUR", "Евро", "€", 2, False),
+                ("KZT", "Казахстанский тенге", "₸", 2, False),
+                ("UAH", "Украинская гривна", "₴", 2, False)
+            ]
+
+            # Один INSERT с набором параметров (executemany) вместо вставки по строке
+            await session.execute(insert(SupportedCurrency), [
+                {
+                    "code": code,
+                    "name": name,
+                    "symbol": symbol,
+                    "decimal_places": decimal_places,
+                    "is_default": is_default
+                }
+                for code, name, symbol, decimal_places, is_default in currencies
+            ])
+            await session.commit()
+            logger.info("Инициализированы поддерживаемые валюты")
 
-        session.commit()
-        logger.info("Созданы тестовые планы подписок")
 
-    session.close()
+async def create_sample_data():
+    """Создание тестовых данных"""
+    async with db.async_session() as session:
+        # Создаем отсутствующие тестовые услуги. ON CONFLICT не используется: в базах,
+        # созданных до UNIQUE на services.name, ограничения нет и запрос падает
+        seed_names = [service["name"] for service in SEED_SERVICES]
+        existing = set(await session.scalars(select(Service.name).where(Service.name.in_(seed_names))))
+        missing = [service for service in SEED_SERVICES if service["name"] not in existing]
+        if missing:
+            try:
+                await session.execute(insert(Service), missing)
+                await session.commit()
+                logger.info("Созданы тестовые услуги")
+            except IntegrityError:
+                # Услуги одновременно создал другой процесс
+                await session.rollback()
+
+        # Создаем тестовые планы подписок
+        count = await session.scalar(select(func.count()).select_from(SubscriptionPlan))
+        if count == 0:
+            plans = [
+                {
+                    "name": "Месячная подписка",
+                    "description": "Полный доступ ко всем функциям на 30 дней",
+                    "price": 990.0,
+                    "currency": "RUB",
+                    "billing_cycle_days": 30,
+                    "trial_period_days": 7,
+                    "features": msgspec.json.encode(
+                        ["Доступ к базовым функциям", "Техническая поддержка", "Обновления"]).decode()
+                },
+                {
+                    "name": "Годовая подписка",
+                    "description": "Полный доступ ко всем функциям на 365 дней (экономия 20%)",
+                    "price": 9500.0,
+                    "currency": "RUB",
+                    "billing_cycle_days": 365,
+                    "trial_period_days": 0,
+                    "features": msgspec.json.encode(
+                        ["Доступ ко всем функциям", "Приоритетная поддержка", "Ранний доступ к новым функциям"]).decode()
+                }
+            ]
+            await session.execute(insert(SubscriptionPlan), plans)
+            await session.commit()
+            logger.info("Созданы тестовые планы подписок")
 
 
 if __name__ == '__main__':
@@ -517,10 +816,21 @@ if __name__ == '__main__':
         logger.error(str(e))
         exit(1)
 
-    # Запуск бота
-    executor.start_polling(
-        dp,
-        skip_updates=True,
-        on_startup=on_startup,
-        on_shutdown=on_shutdown
-    )
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Запуск бота: через вебхук, если задан публичный адрес, иначе через long polling
+    if config.Config.WEBHOOK_URL:
+        app = web.Application()
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=config.Config.WEBHOOK_SECRET
+        ).register(app, path=config.Config.WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+        web.run_app(app, host=config.Config.WEBAPP_HOST, port=config.Config.WEBAPP_PORT)
+    else:
+        asyncio.run(dp.start_polling(bot))
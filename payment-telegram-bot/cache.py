@@ -0,0 +1,75 @@
+import logging
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Общий клиент Redis для кэшей приложения (пул соединений создается один раз на процесс)
+redis_client = redis.from_url(
+    config.Config.REDIS_URL,
+    decode_responses=True,
+    max_connections=config.Config.REDIS_MAX_CONNECTIONS
+)
+
+
+async def cache_get(key):
+    """Получение значения из кэша
+
+    Args:
+        key (str): Ключ кэша
+
+    Returns:
+        str: Значение или None, если ключа нет или Redis недоступен
+    """
+    try:
+        return await redis_client.get(key)
+    except RedisError as e:
+        logger.warning(f"Ошибка чтения кэша {key}: {e}")
+        return None
+
+
+async def cache_set(key, value, ttl):
+    """Сохранение значения в кэш
+
+    Args:
+        key (str): Ключ кэша
+        value (str): Значение
+        ttl (int): Время жизни ключа в секундах
+    """
+    try:
+        await redis_client.set(key, value, ex=ttl)
+    except RedisError as e:
+        logger.warning(f"Ошибка записи кэша {key}: {e}")
+
+
+async def cache_delete(*keys):
+    """Удаление значений из кэша
+
+    Args:
+        *keys (str): Ключи кэша
+    """
+    try:
+        await redis_client.delete(*keys)
+    except RedisError as e:
+        logger.warning(f"Ошибка удаления кэша {keys}: {e}")
+
+
+async def acquire_once(key, ttl):
+    """Атомарная отметка однократного действия (SET NX)
+
+    Args:
+        key (str): Ключ действия
+        ttl (int): Время, в течение которого повтор считается дублем, в секундах
+
+    Returns:
+        bool: True, если действие выполняется впервые. При недоступности Redis
+        также возвращается True, чтобы не блокировать пользователей.
+    """
+    try:
+        return bool(await redis_client.set(key, "1", ex=ttl, nx=True))
+    except RedisError as e:
+        logger.warning(f"Ошибка записи кэша {key}: {e}")
+        return True
@@ -11,6 +11,16 @@ class Config:
     # Токен бота от @BotFather
     BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+    # Размер пула HTTP-соединений с Telegram Bot API
+    BOT_CONNECTIONS_LIMIT = int(os.getenv("BOT_CONNECTIONS_LIMIT", "100"))
+
+    # Настройки вебхука: если WEBHOOK_URL не задан, бот работает через long polling
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://example.com
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+    WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+    WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8000"))
+
     # Настройки платежной системы
     PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN")  # Токен от BotFather для платежей
 
@@ -20,12 +30,19 @@ class Config:
 
     # Настройки базы данных
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///payments.db")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "50"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "50"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # секунды
+    DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))  # секунды ожидания свободного соединения
 
     # Настройки Redis для хранения состояний (опционально)
     REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))  # Размер пула соединений на клиента
+    # Хранилище состояний FSM: redis (общее для всех процессов) или memory (только для разработки)
+    FSM_STORAGE = os.getenv("FSM_STORAGE", "redis").lower()
 
-    # Админы бота
-    ADMINS = list(map(int, os.getenv("ADMINS", "").split(','))) if os.getenv("ADMINS") else []
+    # Админы бота (множество, чтобы проверка принадлежности не перебирала список)
+    ADMINS = frozenset(int(admin_id) for admin_id in os.getenv("ADMINS", "").split(',') if admin_id.strip())
 
     # Настройки реферальной системы
     REFERRAL_REWARD_PERCENT = float(os.getenv("REFERRAL_REWARD_PERCENT", "10.0"))
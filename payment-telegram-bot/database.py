@@ -1,6 +1,13 @@
+from contextlib import contextmanager
 from datetime import datetime
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, Text
+from sqlalchemy import (
+    create_engine, event, func, inspect, literal, select, update, Column, Integer, String, Float, DateTime, Boolean,
+    Text, ForeignKey, Index, text
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -8,6 +15,140 @@ import config
 
 Base = declarative_base()
 
+# INSERT с поддержкой ON CONFLICT для поддерживаемых СУБД
+DIALECT_INSERTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+# Асинхронные драйверы для поддерживаемых СУБД
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+# Символ экранирования % и _ в шаблонах LIKE
+LIKE_ESCAPE = "/"
+
+# Размер кэша подготовленных выражений asyncpg: горячие запросы отличаются только параметрами
+PREPARED_STATEMENT_CACHE_SIZE = 256
+
+# WAL позволяет читать параллельно с записью, а synchronous=NORMAL убирает fsync на каждую транзакцию
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+)
+
+
+def is_sqlite_file(db_url):
+    """Проверка, что URL указывает на файловую базу SQLite
+
+    Args:
+        db_url (str): URL подключения к БД
+
+    Returns:
+        bool: True для SQLite в файле, False для SQLite в памяти и других СУБД
+    """
+    url = make_url(db_url)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Настройка нового соединения SQLite
+
+    Args:
+        dbapi_connection: Соединение DBAPI
+        connection_record: Запись пула соединений
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def get_async_url(db_url):
+    """Преобразование URL базы данных в URL с асинхронным драйвером
+
+    Args:
+        db_url (str): URL подключения к БД
+
+    Returns:
+        URL: URL подключения для асинхронного движка
+    """
+    url = make_url(db_url)
+    backend = url.get_backend_name()
+    if backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    if url.get_driver_name() == "asyncpg" and "prepared_statement_cache_size" not in url.query:
+        url = url.update_query_dict({"prepared_statement_cache_size": str(PREPARED_STATEMENT_CACHE_SIZE)})
+    return url
+
+
+def get_pool_options(db_url):
+    """Параметры пула соединений для движка базы данных
+
+    Пул один на процесс и рассчитан на одновременные нажатия кнопок
+    множеством пользователей, а не на стандартные 5 + 10 соединений.
+
+    Args:
+        db_url (str): URL подключения к БД
+
+    Returns:
+        dict: Аргументы пула для create_engine / create_async_engine
+    """
+    url = make_url(db_url)
+    # SQLite в памяти использует однопоточный пул без настроек размера
+    if url.get_backend_name() == "sqlite" and not is_sqlite_file(db_url):
+        return {}
+
+    return {
+        "pool_size": config.Config.DB_POOL_SIZE,
+        "max_overflow": config.Config.DB_MAX_OVERFLOW,
+        "pool_pre_ping": True,
+        "pool_recycle": config.Config.DB_POOL_RECYCLE,
+        # При исчерпании пула запрос быстро получает ошибку вместо 30-секундного ожидания
+        "pool_timeout": config.Config.DB_POOL_TIMEOUT,
+    }
+
+
+def migrate_schema(connection):
+    """Приведение существующих таблиц к текущим моделям
+
+    create_all создает только отсутствующие таблицы, поэтому колонки и индексы,
+    добавленные в модели позже, досоздаются здесь. Колонки добавляются допускающими
+    NULL: у существующих строк значение заполняется отдельно (см. backfill_payment_services).
+    Уникальные индексы (например, uq_active_sub) не создаются, если данные их нарушают:
+    ошибка прерывает миграцию, и такие строки нужно исправить вручную.
+
+    Args:
+        connection (Connection): Соединение в открытой транзакции
+    """
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            ddl = (
+                f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} "
+                f"{column.type.compile(dialect=connection.dialect)}"
+            )
+            for foreign_key in column.foreign_keys:
+                ddl += (
+                    f" REFERENCES {preparer.format_table(foreign_key.column.table)} "
+                    f"({preparer.format_column(foreign_key.column)})"
+                )
+            connection.execute(text(ddl))
+
+        # Ограничения, на которые опирается код (uq_active_sub), должны существовать и в старых базах
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(connection)
+
 
 class User(Base):
     """Модель пользователя"""
@@ -28,6 +169,22 @@ class Payment(Base):
     """Модель платежа"""
 
     __tablename__ = 'payments'
+    __table_args__ = (
+        # Отчеты фильтруют платежи по периоду и статусу
+        Index('ix_payments_created_status', 'created_at', 'status'),
+        # История платежей пользователя, отсортированная по дате
+        Index('ix_payment_user_created', 'user_id', 'created_at'),
+        # Платежи пользователя с определенным статусом (статистика, проверка оплат)
+        Index('ix_payments_user_status', 'user_id', 'status'),
+        # Суммы завершенных платежей
+        Index(
+            'ix_payment_completed', 'amount',
+            postgresql_where=text("status = 'completed'"),
+            sqlite_where=text("status = 'completed'")
+        ),
+        # Поиск платежа по payload инвойса после оплаты
+        Index('ix_payment_payload', 'invoice_payload'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
@@ -37,6 +194,7 @@ class Payment(Base):
     payment_provider = Column(String(50))  # telegram, yookassa, etc.
     provider_payment_id = Column(String(100))  # ID платежа в платежной системе
     invoice_payload = Column(Text)  # Дополнительные данные
+    service_id = Column(Integer, ForeignKey('services.id'), nullable=True, index=True)  # Купленная услуга
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
 
@@ -45,9 +203,13 @@ class Service(Base):
     """Модель услуги"""
 
     __tablename__ = 'services'
+    __table_args__ = (
+        # Каталог показывает только активные услуги
+        Index('ix_service_active', 'is_active'),
+    )
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(200), nullable=False)
+    name = Column(String(200), nullable=False, unique=True)
     description = Column(Text)
     price = Column(Float, nullable=False)
     currency = Column(String(10), default="RUB")
@@ -65,12 +227,68 @@ class Database:
             db_url (str, optional): URL подключения к БД. По умолчанию берется из config.
         """
         self.db_url = db_url or config.Config.DATABASE_URL
-        self.engine = create_engine(self.db_url)
-        self.SessionLocal = sessionmaker(bind=self.engine)
+        pool_options = get_pool_options(self.db_url)
+        connect_args = {}
+        if is_sqlite_file(self.db_url):
+            # Соединения пула используются из разных потоков (например, в asyncio.to_thread)
+            connect_args["check_same_thread"] = False
+
+        self.engine = create_engine(self.db_url, connect_args=connect_args, **pool_options)
+        # Объекты остаются доступными после commit и закрытия сессии, как и в асинхронных сессиях
+        self.SessionLocal = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+        # Асинхронный движок для обработчиков бота, чтобы запросы не блокировали event loop
+        self.async_engine = create_async_engine(get_async_url(self.db_url), **pool_options)
+        self.AsyncSessionLocal = async_sessionmaker(self.async_engine, expire_on_commit=False)
+
+        if is_sqlite_file(self.db_url):
+            event.listen(self.engine, "connect", set_sqlite_pragmas)
+            event.listen(self.async_engine.sync_engine, "connect", set_sqlite_pragmas)
 
     def init_db(self):
-        """Создание таблиц в базе данных"""
-        Base.metadata.create_all(self.engine)
+        """Создание таблиц и миграция существующей схемы"""
+        with self.engine.begin() as conn:
+            Base.metadata.create_all(conn)
+            migrate_schema(conn)
+
+    async def init_models(self):
+        """Создание таблиц и миграция существующей схемы через асинхронный движок"""
+        async with self.async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(migrate_schema)
+
+    async def backfill_payment_services(self):
+        """Заполнение service_id у старых платежей по названию услуги в invoice_payload
+
+        Выполняется одним UPDATE на стороне БД и затрагивает только платежи без service_id,
+        после заполнения отчеты считают покупки по индексу service_id без LIKE.
+        Название ищется как отдельный фрагмент, ограниченный началом или концом payload,
+        пробелом или двоеточием. Если подходит несколько услуг (название одной входит
+        в название другой), выбирается услуга с самым длинным названием. Символы % и _
+        в названии экранируются и не работают как шаблоны LIKE.
+
+        Returns:
+            int: Количество обновленных платежей
+        """
+        padded_payload = literal(" ") + func.replace(Payment.invoice_payload, ":", " ") + literal(" ")
+        # autoescape работает только со строковыми литералами, поэтому название экранируется в SQL
+        escaped_name = func.replace(
+            func.replace(func.replace(Service.name, LIKE_ESCAPE, LIKE_ESCAPE * 2), "%", f"{LIKE_ESCAPE}%"),
+            "_", f"{LIKE_ESCAPE}_"
+        )
+        matched_services = select(Service.id).where(
+            padded_payload.contains(literal(" ") + escaped_name + literal(" "), escape=LIKE_ESCAPE)
+        )
+
+        async with self.async_engine.begin() as conn:
+            result = await conn.execute(
+                update(Payment)
+                .where(Payment.service_id.is_(None), matched_services.exists())
+                .values(service_id=matched_services.order_by(
+                    func.length(Service.name).desc(), Service.id
+                ).limit(1).scalar_subquery())
+            )
+        return result.rowcount
 
     def get_session(self):
         """Получение сессии базы данных
@@ -80,7 +298,49 @@ class Database:
         """
         return self.SessionLocal()
 
+    @contextmanager
+    def session_scope(self):
+        """Сессия на одну логическую операцию
+
+        Фиксирует транзакцию при успешном завершении, откатывает при исключении
+        и всегда возвращает соединение в пул:
+        ``with db.session_scope() as session: ...``
+
+        Yields:
+            Session: Сессия SQLAlchemy
+        """
+        session = self.SessionLocal()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def insert(self, model):
+        """Создание INSERT с поддержкой ON CONFLICT для используемой СУБД
+
+        Args:
+            model: Модель или таблица SQLAlchemy
+
+        Returns:
+            Insert: Конструкция INSERT диалекта базы данных
+        """
+        return DIALECT_INSERTS[self.engine.dialect.name](model)
+
+    def async_session(self):
+        """Получение асинхронной сессии базы данных
+
+        Используется как асинхронный контекстный менеджер:
+        ``async with db.async_session() as session: ...``
+
+        Returns:
+            AsyncSession: Асинхронная сессия SQLAlchemy
+        """
+        return self.AsyncSessionLocal()
+
 
-# Инициализация базы данных
+# Инициализация базы данных (таблицы создаются при запуске бота, см. Database.init_models)
 db = Database()
-db.init_db()
@@ -0,0 +1,32 @@
+"""
+Модуль middleware, открывающей одну сессию базы данных на обновление
+"""
+
+from aiogram import BaseMiddleware
+
+from database import db
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Middleware, передающая обработчику асинхронную сессию БД
+
+    Сессия открывается один раз на обновление и доступна обработчику
+    как аргумент ``session``. Соединение из пула берется только при первом
+    запросе, а после обработки сессия закрывается, незакоммиченные
+    изменения откатываются.
+    """
+
+    async def __call__(self, handler, event, data):
+        """Обработка события с открытой сессией
+
+        Args:
+            handler: Следующий обработчик в цепочке
+            event: Событие Telegram
+            data (dict): Данные, передаваемые обработчику
+
+        Returns:
+            Результат обработчика
+        """
+        async with db.async_session() as session:
+            data["session"] = session
+            return await handler(event, data)
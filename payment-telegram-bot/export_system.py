@@ -2,16 +2,137 @@
 Модуль для экспорта статистики в различные форматы
 """
 
+import asyncio
 import csv
 import io
-import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+import msgspec
 import pandas as pd
-from aiogram.types import InputFile
+from aiogram.types import BufferedInputFile
+from sqlalchemy import and_, case, func, select
 
+import config
 from database import db, User, Payment, Service
 
+# Максимальная ширина колонки в Excel-выгрузках
+MAX_COLUMN_WIDTH = 50
+
+# Количество строк, загружаемых из БД за один раз при потоковой выгрузке
+FETCH_BATCH_SIZE = 10000
+
+# Выгрузки выполняются в отдельном пуле потоков: одновременно строится не больше
+# EXPORT_WORKERS файлов, и тяжелые отчеты не занимают пул цикла событий по умолчанию
+EXPORT_WORKERS = 2
+_EXPORT_POOL = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Заголовок колонки выгрузки платежей -> колонка таблицы
+PAYMENT_EXPORT_COLUMNS = {
+    'ID': Payment.id,
+    'User ID': Payment.user_id,
+    'Amount': Payment.amount,
+    'Currency': Payment.currency,
+    'Status': Payment.status,
+    'Payment Provider': Payment.payment_provider,
+    'Provider Payment ID': Payment.provider_payment_id,
+    'Created At': Payment.created_at,
+    'Completed At': Payment.completed_at,
+    'Invoice Payload': Payment.invoice_payload,
+}
+
+PAYMENT_DATE_COLUMNS = ['Created At', 'Completed At']
+
+USER_CSV_HEADER = [
+    'ID', 'Telegram ID', 'Username', 'First Name', 'Last Name',
+    'Balance', 'Is Admin', 'Created At'
+]
+
+
+def format_datetime(value):
+    """Форматирование даты для выгрузки
+
+    isoformat с точностью до секунд дает тот же результат, что и
+    strftime(DATETIME_FORMAT), но не разбирает строку формата на каждой строке.
+
+    Args:
+        value (datetime): Дата или None
+
+    Returns:
+        str: Дата в формате "ГГГГ-ММ-ДД ЧЧ:ММ:СС" или пустая строка
+    """
+    return value.isoformat(' ', 'seconds') if value else ''
+
+
+def format_datetime_column(column):
+    """Форматирование колонки дат DataFrame одной векторной операцией
+
+    Args:
+        column (pd.Series): Колонка с датами
+
+    Returns:
+        pd.Series: Колонка строк, пустые значения заменены пустой строкой
+    """
+    return pd.to_datetime(column).dt.strftime(DATETIME_FORMAT).fillna('')
+
+
+async def run_export(builder, *args):
+    """Запуск построения выгрузки в пуле потоков выгрузок
+
+    Args:
+        builder (callable): Синхронная функция построения файла
+        *args: Аргументы функции
+
+    Returns:
+        BufferedInputFile: Результат функции построения
+    """
+    return await asyncio.get_running_loop().run_in_executor(_EXPORT_POOL, builder, *args)
+
+
+def column_widths(df):
+    """Ширина колонок Excel по самому длинному значению в каждой колонке
+
+    Длины считаются векторно по DataFrame, без обхода ячеек листа.
+
+    Args:
+        df (pd.DataFrame): Выгружаемые данные
+
+    Returns:
+        list: Ширина каждой колонки с учетом заголовка
+    """
+    widths = []
+    for name in df.columns:
+        max_length = max(int(df[name].astype(str).str.len().max()) if len(df) else 0, len(str(name)))
+        widths.append(min(max_length + 2, MAX_COLUMN_WIDTH))
+    return widths
+
+
+def write_csv(header, rows):
+    """Запись строк в CSV сразу в байтовый буфер
+
+    Строки пишутся по мере получения и кодируются в UTF-8 при записи,
+    поэтому в памяти не собирается ни список строк, ни отдельная
+    текстовая копия выгрузки.
+
+    Args:
+        header (list): Заголовки колонок
+        rows (iterable): Генератор строк
+
+    Returns:
+        bytes: Содержимое CSV в кодировке UTF-8
+    """
+    buffer = io.BytesIO()
+    wrapper = io.TextIOWrapper(buffer, encoding='utf-8', newline='', write_through=True)
+    writer = csv.writer(wrapper)
+    writer.writerow(header)
+    writer.writerows(rows)
+    wrapper.flush()
+    # Отсоединяем обертку, чтобы она не закрыла буфер
+    wrapper.detach()
+    return buffer.getvalue()
+
 
 class ExportSystem:
     """Класс для экспорта статистики"""
@@ -19,184 +140,167 @@ class ExportSystem:
     def __init__(self):
         self.db = db
 
-    async def export_payments_csv(self, start_date: datetime = None, end_date: datetime = None) -> InputFile:
-        """Экспорт платежей в CSV
+    def _payments_statement(self, start_date=None, end_date=None):
+        """SELECT платежей за период с колонками выгрузки
 
         Args:
             start_date (datetime, optional): Начальная дата. По умолчанию None.
             end_date (datetime, optional): Конечная дата. По умолчанию None.
 
         Returns:
-            InputFile: Файл CSV
+            Select: Запрос с колонками, подписанными заголовками выгрузки
         """
-        session = self.db.get_session()
-
-        # Формируем запрос
-        query = session.query(Payment)
+        statement = select(*(column.label(name) for name, column in PAYMENT_EXPORT_COLUMNS.items()))
 
         if start_date:
-            query = query.filter(Payment.created_at >= start_date)
+            statement = statement.where(Payment.created_at >= start_date)
 
         if end_date:
-            query = query.filter(Payment.created_at <= end_date)
-
-        payments = query.order_by(Payment.created_at.desc()).all()
-
-        # Создаем CSV в памяти
-        output = io.StringIO()
-        writer = csv.writer(output)
-
-        # Заголовки
-        writer.writerow([
-            'ID', 'User ID', 'Amount', 'Currency', 'Status',
-            'Payment Provider', 'Provider Payment ID', 'Created At',
-            'Completed At', 'Invoice Payload'
-        ])
-
-        # Данные
-        for payment in payments:
-            writer.writerow([
-                payment.id,
-                payment.user_id,
-                payment.amount,
-                payment.currency,
-                payment.status,
-                payment.payment_provider,
-                payment.provider_payment_id or '',
-                payment.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                payment.completed_at.strftime('%Y-%m-%d %H:%M:%S') if payment.completed_at else '',
-                payment.invoice_payload or ''
-            ])
+            statement = statement.where(Payment.created_at <= end_date)
 
-        session.close()
+        return statement.order_by(Payment.created_at.desc()).limit(config.Config.EXPORT_MAX_ROWS)
 
-        # Создаем файл для отправки
-        csv_data = output.getvalue().encode('utf-8')
-        file_obj = io.BytesIO(csv_data)
+    def _payments_frame(self, start_date=None, end_date=None):
+        """Загрузка платежей за период в DataFrame
 
-        filename = f"payments_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        Args:
+            start_date (datetime, optional): Начальная дата. По умолчанию None.
+            end_date (datetime, optional): Конечная дата. По умолчанию None.
 
-        return InputFile(file_obj, filename=filename)
+        Returns:
+            pd.DataFrame: Платежи с отформатированными датами
+        """
+        df = pd.read_sql(
+            self._payments_statement(start_date, end_date), self.db.engine, parse_dates=PAYMENT_DATE_COLUMNS
+        )
 
-    async def export_payments_excel(self, start_date: datetime = None, end_date: datetime = None) -> InputFile:
-        """Экспорт платежей в Excel
+        for column in PAYMENT_DATE_COLUMNS:
+            df[column] = format_datetime_column(df[column])
+        df[['Provider Payment ID', 'Invoice Payload']] = df[['Provider Payment ID', 'Invoice Payload']].fillna('')
+
+        return df
+
+    def _build_payments_csv(self, start_date=None, end_date=None):
+        """Формирование CSV с платежами (выполняется в отдельном потоке)
 
         Args:
             start_date (datetime, optional): Начальная дата. По умолчанию None.
             end_date (datetime, optional): Конечная дата. По умолчанию None.
 
         Returns:
-            InputFile: Файл Excel
+            BufferedInputFile: Файл CSV
         """
-        session = self.db.get_session()
+        # Тот же DataFrame, что и для Excel, записывается в CSV за один проход на стороне C
+        output = io.BytesIO()
+        self._payments_frame(start_date, end_date).to_csv(output, index=False, encoding='utf-8')
 
-        # Формируем запрос
-        query = session.query(Payment)
+        filename = f"payments_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
 
-        if start_date:
-            query = query.filter(Payment.created_at >= start_date)
+        return BufferedInputFile(output.getvalue(), filename=filename)
 
-        if end_date:
-            query = query.filter(Payment.created_at <= end_date)
-
-        payments = query.order_by(Payment.created_at.desc()).all()
-
-        # Подготавливаем данные
-        data = []
-        for payment in payments:
-            data.append({
-                'ID': payment.id,
-                'User ID': payment.user_id,
-                'Amount': payment.amount,
-                'Currency': payment.currency,
-                'Status': payment.status,
-                'Payment Provider': payment.payment_provider,
-                'Provider Payment ID': payment.provider_payment_id or '',
-                'Created At': payment.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                'Completed At': payment.completed_at.strftime('%Y-%m-%d %H:%M:%S') if payment.completed_at else '',
-                'Invoice Payload': payment.invoice_payload or ''
-            })
+    async def export_payments_csv(self, start_date: datetime = None, end_date: datetime = None) -> BufferedInputFile:
+        """Экспорт платежей в CSV
 
-        session.close()
+        Args:
+            start_date (datetime, optional): Начальная дата. По умолчанию None.
+            end_date (datetime, optional): Конечная дата. По умолчанию None.
+
+        Returns:
+            BufferedInputFile: Файл CSV
+        """
+        return await run_export(self._build_payments_csv, start_date, end_date)
+
+    def _build_payments_excel(self, start_date=None, end_date=None):
+        """Формирование Excel с платежами (выполняется в отдельном потоке)
+
+        Args:
+            start_date (datetime, optional): Начальная дата. По умолчанию None.
+            end_date (datetime, optional): Конечная дата. По умолчанию None.
 
-        # Создаем DataFrame
-        df = pd.DataFrame(data)
+        Returns:
+            BufferedInputFile: Файл Excel
+        """
+        # Платежи загружаются сразу в DataFrame, даты форматируются для всей колонки
+        df = self._payments_frame(start_date, end_date)
 
         # Создаем Excel файл в памяти
         output = io.BytesIO()
 
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        # xlsxwriter пишет XML листа напрямую, без построения всей книги в виде дерева объектов
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
             df.to_excel(writer, sheet_name='Payments', index=False)
 
             # Автоматически подгоняем ширину колонок
             worksheet = writer.sheets['Payments']
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+            for index, width in enumerate(column_widths(df)):
+                worksheet.set_column(index, index, width)
 
         filename = f"payments_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
 
-        return InputFile(io.BytesIO(output.getvalue()), filename=filename)
+        return BufferedInputFile(output.getvalue(), filename=filename)
 
-    async def export_users_csv(self) -> InputFile:
-        """Экспорт пользователей в CSV
+    async def export_payments_excel(self, start_date: datetime = None, end_date: datetime = None) -> BufferedInputFile:
+        """Экспорт платежей в Excel
+
+        Args:
+            start_date (datetime, optional): Начальная дата. По умолчанию None.
+            end_date (datetime, optional): Конечная дата. По умолчанию None.
 
         Returns:
-            InputFile: Файл CSV
+            BufferedInputFile: Файл Excel
         """
-        session = self.db.get_session()
+        return await run_export(self._build_payments_excel, start_date, end_date)
 
-        users = session.query(User).order_by(User.created_at.desc()).all()
-
-        # Создаем CSV в памяти
-        output = io.StringIO()
-        writer = csv.writer(output)
-
-        # Заголовки
-        writer.writerow([
-            'ID', 'Telegram ID', 'Username', 'First Name', 'Last Name',
-            'Balance', 'Is Admin', 'Created At'
-        ])
-
-        # Данные
-        for user in users:
-            writer.writerow([
-                user.id,
-                user.telegram_id,
-                user.username or '',
-                user.first_name or '',
-                user.last_name or '',
-                user.balance,
-                'Yes' if user.is_admin else 'No',
-                user.created_at.strftime('%Y-%m-%d %H:%M:%S')
-            ])
+    def _iter_user_rows(self):
+        """Генератор строк CSV с пользователями
 
-        session.close()
-
-        # Создаем файл для отправки
-        csv_data = output.getvalue().encode('utf-8')
-        file_obj = io.BytesIO(csv_data)
+        Yields:
+            list: Строка CSV
+        """
+        session = self.db.get_session()
+        try:
+            query = session.query(User).order_by(User.created_at.desc()).limit(config.Config.EXPORT_MAX_ROWS)
+            for user in query.yield_per(FETCH_BATCH_SIZE):
+                yield [
+                    user.id,
+                    user.telegram_id,
+                    user.username or '',
+                    user.first_name or '',
+                    user.last_name or '',
+                    user.balance,
+                    'Yes' if user.is_admin else 'No',
+                    format_datetime(user.created_at)
+                ]
+        finally:
+            session.close()
+
+    def _build_users_csv(self):
+        """Формирование CSV с пользователями (выполняется в отдельном потоке)
 
+        Returns:
+            BufferedInputFile: Файл CSV
+        """
+        csv_data = write_csv(USER_CSV_HEADER, self._iter_user_rows())
         filename = f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
 
-        return InputFile(file_obj, filename=filename)
+        return BufferedInputFile(csv_data, filename=filename)
 
-    async def export_statistics_json(self, days: int = 30) -> InputFile:
-        """Экспорт статистики в JSON
+    async def export_users_csv(self) -> BufferedInputFile:
+        """Экспорт пользователей в CSV
+
+        Returns:
+            BufferedInputFile: Файл CSV
+        """
+        return await run_export(self._build_users_csv)
+
+    def _build_statistics_json(self, days=30):
+        """Формирование JSON со статистикой (выполняется в отдельном потоке)
 
         Args:
             days (int, optional): Количество дней для статистики. По умолчанию 30.
 
         Returns:
-            InputFile: Файл JSON
+            BufferedInputFile: Файл JSON
         """
         session = self.db.get_session()
 
@@ -205,58 +309,56 @@ class ExportSystem:
         # Собираем статистику
         stats = {}
 
-        # Общая статистика
-        total_users = session.query(User).count()
-        total_payments = session.query(Payment).count()
-        total_revenue = session.query(db.func.sum(Payment.amount)).filter(
-            Payment.status == "completed"
-        ).scalar() or 0
-
-        # Статистика за период
-        recent_payments = session.query(Payment).filter(
-            Payment.created_at >= start_date
-        ).count()
-
-        recent_revenue = session.query(db.func.sum(Payment.amount)).filter(
-            Payment.created_at >= start_date,
-            Payment.status == "completed"
-        ).scalar() or 0
-
-        # Новые пользователи за период
-        new_users = session.query(User).filter(
-            User.created_at >= start_date
-        ).count()
+        # Общая статистика и статистика за период: по одному запросу
+        # с условными агрегатами на таблицу вместо отдельного запроса на каждое число
+        total_users, new_users = session.query(
+            func.count(User.id),
+            func.count(case((User.created_at >= start_date, User.id)))
+        ).one()
+
+        total_payments, total_revenue, recent_payments, recent_revenue = session.query(
+            func.count(Payment.id),
+            func.sum(case((Payment.status == "completed", Payment.amount))),
+            func.count(case((Payment.created_at >= start_date, Payment.id))),
+            func.sum(case((and_(Payment.created_at >= start_date, Payment.status == "completed"), Payment.amount)))
+        ).one()
+        total_revenue = total_revenue or 0
+        recent_revenue = recent_revenue or 0
 
         # Статистика по провайдерам платежей
         provider_stats = {}
         providers = session.query(
             Payment.payment_provider,
-            db.func.count(Payment.id).label('count'),
-            db.func.sum(Payment.amount).label('total')
+            func.count(Payment.id).label('count'),
+            func.sum(Payment.amount).label('total')
         ).filter(
             Payment.status == "completed"
         ).group_by(Payment.payment_provider).all()
 
         for provider in providers:
-            provider_stats[provider.payment_provider] = {
+            # Ключи JSON должны быть строками, платеж без провайдера записывается как "null"
+            provider_stats[provider.payment_provider or 'null'] = {
                 'count': provider.count,
                 'total': float(provider.total or 0)
             }
 
-        # Статистика по услугам
+        # Статистика по услугам одним сгруппированным запросом по service_id
         service_stats = {}
-        services = session.query(Service).all()
+        services = session.query(
+            Service.name,
+            Service.price,
+            func.count(Payment.id).label('purchases'),
+            func.sum(Payment.amount).label('revenue')
+        ).outerjoin(Payment, and_(
+            Payment.service_id == Service.id,
+            Payment.status == "completed"
+        )).group_by(Service.id, Service.name, Service.price).all()
 
         for service in services:
-            service_payments = session.query(Payment).filter(
-                Payment.invoice_payload.like(f"%{service.name}%"),
-                Payment.status == "completed"
-            ).all()
-
             service_stats[service.name] = {
                 'price': service.price,
-                'purchases': len(service_payments),
-                'revenue': sum(p.amount for p in service_payments)
+                'purchases': service.purchases,
+                'revenue': float(service.revenue or 0)
             }
 
         session.close()
@@ -282,21 +384,32 @@ class ExportSystem:
         }
 
         # Создаем JSON файл
-        json_data = json.dumps(stats, ensure_ascii=False, indent=2)
-        file_obj = io.BytesIO(json_data.encode('utf-8'))
+        # msgspec сразу кодирует в UTF-8 байты, отступы добавляются отдельным проходом по буферу
+        json_data = msgspec.json.format(msgspec.json.encode(stats), indent=2)
 
         filename = f"statistics_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
 
-        return InputFile(file_obj, filename=filename)
+        return BufferedInputFile(json_data, filename=filename)
 
-    async def export_detailed_report(self, report_type: str = "daily") -> InputFile:
-        """Экспорт детализированного отчета
+    async def export_statistics_json(self, days: int = 30) -> BufferedInputFile:
+        """Экспорт статистики в JSON
+
+        Args:
+            days (int, optional): Количество дней для статистики. По умолчанию 30.
+
+        Returns:
+            BufferedInputFile: Файл JSON
+        """
+        return await run_export(self._build_statistics_json, days)
+
+    def _build_detailed_report(self, report_type="daily"):
+        """Формирование детализированного отчета (выполняется в отдельном потоке)
 
         Args:
             report_type (str, optional): Тип отчета (daily, weekly, monthly). По умолчанию "daily".
 
         Returns:
-            InputFile: Файл отчета
+            BufferedInputFile: Файл отчета
         """
         session = self.db.get_session()
 
@@ -316,42 +429,46 @@ class ExportSystem:
             start_date = now - timedelta(days=1)
             date_format = "%Y-%m-%d"
 
-        # Собираем данные по дням
+        # Собираем данные по дням: по одному сгруппированному запросу на таблицу вместо запросов на каждый день.
+        # SQLite возвращает дату строкой, PostgreSQL - объектом date, поэтому ключи приводятся к строке
+        user_day = func.date(User.created_at)
+        users_by_day = {
+            str(day): count
+            for day, count in session.query(user_day, func.count(User.id)).filter(
+                User.created_at >= start_date
+            ).group_by(user_day).all()
+        }
+
+        payment_day = func.date(Payment.created_at)
+        payments_by_day = {
+            str(day): (count, revenue)
+            for day, count, revenue in session.query(
+                payment_day,
+                func.count(Payment.id),
+                func.sum(case((Payment.status == "completed", Payment.amount), else_=0))
+            ).filter(
+                Payment.created_at >= start_date
+            ).group_by(payment_day).all()
+        }
+
+        session.close()
+
+        # Дни без событий заполняем нулями
         daily_stats = []
 
-        current_date = start_date
-        while current_date <= now:
-            next_date = current_date + timedelta(days=1)
-
-            # Пользователи за день
-            daily_users = session.query(User).filter(
-                User.created_at >= current_date,
-                User.created_at < next_date
-            ).count()
-
-            # Платежи за день
-            daily_payments = session.query(Payment).filter(
-                Payment.created_at >= current_date,
-                Payment.created_at < next_date
-            ).count()
-
-            # Выручка за день
-            daily_revenue = session.query(db.func.sum(Payment.amount)).filter(
-                Payment.created_at >= current_date,
-                Payment.created_at < next_date,
-                Payment.status == "completed"
-            ).scalar() or 0
+        current_date = start_date.date()
+        while current_date <= now.date():
+            day_key = current_date.isoformat()
+            daily_payments, daily_revenue = payments_by_day.get(day_key, (0, 0))
 
             daily_stats.append({
                 'date': current_date.strftime(date_format),
-                'users': daily_users,
+                'users': users_by_day.get(day_key, 0),
                 'payments': daily_payments,
-                'revenue': float(daily_revenue)
+                'revenue': float(daily_revenue or 0)
             })
 
-            current_date = next_date
-
-        session.close()
+            current_date += timedelta(days=1)
 
         # Создаем Excel отчет
         df = pd.DataFrame(daily_stats)
@@ -370,33 +487,43 @@ class ExportSystem:
         # Создаем Excel файл
         output = io.BytesIO()
 
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
             df.to_excel(writer, sheet_name='Report', index=False)
 
             # Добавляем график
             if len(daily_stats) > 1:
-                from openpyxl.chart import LineChart, Reference
-
                 workbook = writer.book
                 worksheet = writer.sheets['Report']
 
                 # Создаем график
-                chart = LineChart()
-                chart.title = f"{report_type.capitalize()} Revenue Trend"
-                chart.style = 13
-                chart.y_axis.title = 'Revenue'
-                chart.x_axis.title = 'Date'
-
-                # Данные для графика
-                data = Reference(worksheet, min_col=4, min_row=2, max_row=len(daily_stats) + 1)
-                categories = Reference(worksheet, min_col=1, min_row=2, max_row=len(daily_stats) + 1)
-
-                chart.add_data(data, titles_from_data=True)
-                chart.set_categories(categories)
+                chart = workbook.add_chart({'type': 'line'})
+                chart.set_title({'name': f"{report_type.capitalize()} Revenue Trend"})
+                chart.set_style(13)
+                chart.set_y_axis({'name': 'Revenue'})
+                chart.set_x_axis({'name': 'Date'})
+
+                # Данные для графика: строки по дням без итоговой строки (нумерация с нуля, 0 - заголовок)
+                last_row = len(daily_stats)
+                chart.add_series({
+                    'name': 'Revenue',
+                    'categories': ['Report', 1, 0, last_row, 0],
+                    'values': ['Report', 1, 3, last_row, 3],
+                })
 
                 # Добавляем график на лист
-                worksheet.add_chart(chart, "F2")
+                worksheet.insert_chart("F2", chart)
 
         filename = f"{report_type}_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
 
-        return InputFile(io.BytesIO(output.getvalue()), filename=filename)
+        return BufferedInputFile(output.getvalue(), filename=filename)
+
+    async def export_detailed_report(self, report_type: str = "daily") -> BufferedInputFile:
+        """Экспорт детализированного отчета
+
+        Args:
+            report_type (str, optional): Тип отчета (daily, weekly, monthly). По умолчанию "daily".
+
+        Returns:
+            BufferedInputFile: Файл отчета
+        """
+        return await run_export(self._build_detailed_report, report_type)
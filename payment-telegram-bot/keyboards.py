@@ -1,4 +1,43 @@
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from functools import lru_cache
+
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+
+
+# Данные колбэков: клавиатуры формируют их, обработчики фильтруют и разбирают по ним
+class PayCallback(CallbackData, prefix="pay"):
+    amount: int
+
+
+class PaymentMethodCallback(CallbackData, prefix="pm"):
+    provider: str
+    amount: float
+
+
+class ServiceCallback(CallbackData, prefix="svc"):
+    id: int
+
+
+class ReferralCallback(CallbackData, prefix="ref"):
+    action: str
+
+
+class PromoCallback(CallbackData, prefix="promo"):
+    action: str
+
+
+class SubscriptionCallback(CallbackData, prefix="sub"):
+    action: str
+    id: int
+
+
+class CurrencyCallback(CallbackData, prefix="cur"):
+    code: str
+
+
+class ExportCallback(CallbackData, prefix="export"):
+    type: str
 
 
 def get_main_keyboard():
@@ -7,11 +46,18 @@ def get_main_keyboard():
     Returns:
         ReplyKeyboardMarkup: Основная клавиатура
     """
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(KeyboardButton("💳 Пополнить баланс"))
-    keyboard.add(KeyboardButton("🛒 Услуги"), KeyboardButton("💰 Мой баланс"))
-    keyboard.add(KeyboardButton("📊 История платежей"), KeyboardButton("🆘 Помощь"))
-    return keyboard
+    builder = ReplyKeyboardBuilder()
+    builder.button(text="💳 Пополнить баланс")
+    builder.button(text="🛒 Услуги")
+    builder.button(text="💰 Мой баланс")
+    builder.button(text="📊 История платежей")
+    builder.button(text="🆘 Помощь")
+    builder.adjust(1, 2, 2)
+    return builder.as_markup(resize_keyboard=True)
+
+
+# Статические клавиатуры строятся один раз при импорте
+MAIN_KEYBOARD = get_main_keyboard()
 
 
 def get_admin_keyboard():
@@ -20,11 +66,17 @@ def get_admin_keyboard():
     Returns:
         ReplyKeyboardMarkup: Клавиатура администратора
     """
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
-    keyboard.add(KeyboardButton("📊 Статистика"))
-    keyboard.add(KeyboardButton("👥 Пользователи"), KeyboardButton("💼 Управление услугами"))
-    keyboard.add(KeyboardButton("💳 Платежи"), KeyboardButton("🔙 В меню"))
-    return keyboard
+    builder = ReplyKeyboardBuilder()
+    builder.button(text="📊 Статистика")
+    builder.button(text="👥 Пользователи")
+    builder.button(text="💼 Управление услугами")
+    builder.button(text="💳 Платежи")
+    builder.button(text="🔙 В меню")
+    builder.adjust(1, 2, 2)
+    return builder.as_markup(resize_keyboard=True)
+
+
+ADMIN_KEYBOARD = get_admin_keyboard()
 
 
 def get_payment_amount_keyboard():
@@ -33,13 +85,17 @@ def get_payment_amount_keyboard():
     Returns:
         InlineKeyboardMarkup: Клавиатура с суммами
     """
-    keyboard = InlineKeyboardMarkup(row_width=3)
+    builder = InlineKeyboardBuilder()
     amounts = [100, 200, 500, 1000, 2000, 5000]
     for amount in amounts:
-        keyboard.insert(InlineKeyboardButton(f"{amount} RUB", callback_data=f"pay_{amount}"))
-    keyboard.add(InlineKeyboardButton("💳 Другая сумма", callback_data="custom_amount"))
-    keyboard.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    return keyboard
+        builder.button(text=f"{amount} RUB", callback_data=PayCallback(amount=amount))
+    builder.button(text="💳 Другая сумма", callback_data="custom_amount")
+    builder.button(text="❌ Отмена", callback_data="cancel")
+    builder.adjust(3, 3, 1, 1)
+    return builder.as_markup()
+
+
+PAYMENT_AMOUNT_KEYBOARD = get_payment_amount_keyboard()
 
 
 def get_payment_method_keyboard(amount):
@@ -51,13 +107,26 @@ def get_payment_method_keyboard(amount):
     Returns:
         InlineKeyboardMarkup: Клавиатура с методами оплаты
     """
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("💳 Telegram Payments",
-                                      callback_data=f"payment_method_telegram_{amount}"))
-    keyboard.add(InlineKeyboardButton("💳 ЮKassa",
-                                      callback_data=f"payment_method_yookassa_{amount}"))
-    keyboard.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    return keyboard
+    builder = InlineKeyboardBuilder()
+    builder.button(text="💳 Telegram Payments",
+                   callback_data=PaymentMethodCallback(provider="telegram", amount=amount))
+    builder.button(text="💳 ЮKassa",
+                   callback_data=PaymentMethodCallback(provider="yookassa", amount=amount))
+    builder.button(text="❌ Отмена", callback_data="cancel")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def services_signature(services):
+    """Ключ кэша клавиатур услуг: поля, которые отображаются на кнопках
+
+    Args:
+        services (list): Список услуг
+
+    Returns:
+        tuple: Кортеж (id, name, price, is_active) для каждой услуги
+    """
+    return tuple((service.id, service.name, service.price, service.is_active) for service in services)
 
 
 def get_services_keyboard(services):
@@ -69,14 +138,28 @@ def get_services_keyboard(services):
     Returns:
         InlineKeyboardMarkup: Клавиатура с услугами
     """
-    keyboard = InlineKeyboardMarkup()
-    for service in services:
-        keyboard.add(InlineKeyboardButton(
-            f"{service.name} - {service.price} RUB",
-            callback_data=f"service_{service.id}"
-        ))
-    keyboard.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    return keyboard
+    return _build_services_keyboard(services_signature(services))
+
+
+@lru_cache(maxsize=64)
+def _build_services_keyboard(signature):
+    """Построение клавиатуры услуг, одинаковые списки услуг используют одну клавиатуру
+
+    Args:
+        signature (tuple): Ключ из services_signature
+
+    Returns:
+        InlineKeyboardMarkup: Клавиатура с услугами
+    """
+    builder = InlineKeyboardBuilder()
+    for service_id, name, price, _ in signature:
+        builder.button(
+            text=f"{name} - {price} RUB",
+            callback_data=ServiceCallback(id=service_id)
+        )
+    builder.button(text="❌ Отмена", callback_data="cancel")
+    builder.adjust(1)
+    return builder.as_markup()
 
 
 def get_admin_services_keyboard(services):
@@ -88,13 +171,113 @@ def get_admin_services_keyboard(services):
     Returns:
         InlineKeyboardMarkup: Клавиатура с действиями над услугами
     """
-    keyboard = InlineKeyboardMarkup()
-    for service in services:
-        status = "✅" if service.is_active else "❌"
-        keyboard.add(InlineKeyboardButton(
-            f"{status} {service.name} - {service.price} RUB",
-            callback_data=f"admin_service_{service.id}"
-        ))
-    keyboard.add(InlineKeyboardButton("➕ Добавить услугу", callback_data="add_service"))
-    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
-    return keyboard
+    return _build_admin_services_keyboard(services_signature(services))
+
+
+@lru_cache(maxsize=64)
+def _build_admin_services_keyboard(signature):
+    """Построение клавиатуры управления услугами по ключу из services_signature
+
+    Args:
+        signature (tuple): Ключ из services_signature
+
+    Returns:
+        InlineKeyboardMarkup: Клавиатура с действиями над услугами
+    """
+    builder = InlineKeyboardBuilder()
+    for service_id, name, price, is_active in signature:
+        status = "✅" if is_active else "❌"
+        builder.button(
+            text=f"{status} {name} - {price} RUB",
+            callback_data=f"admin_service_{service_id}"
+        )
+    builder.button(text="➕ Добавить услугу", callback_data="add_service")
+    builder.button(text="🔙 Назад", callback_data="admin_back")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+# Постоянные кнопки реферальной клавиатуры создаются один раз
+REFERRAL_ACTION_ROWS = [
+    [InlineKeyboardButton(text="➕ Создать ссылку", callback_data=ReferralCallback(action="create").pack())],
+    [InlineKeyboardButton(text="📊 Статистика", callback_data=ReferralCallback(action="stats").pack())],
+]
+
+
+def get_referral_keyboard(links):
+    """Клавиатура реферальной системы
+
+    Args:
+        links (list): Список реферальных ссылок пользователя
+
+    Returns:
+        InlineKeyboardMarkup: Клавиатура с реферальными ссылками и действиями
+    """
+    rows = [[InlineKeyboardButton(text=f"🔗 {link.code}", url=link.link)] for link in links]
+    return InlineKeyboardMarkup(inline_keyboard=rows + REFERRAL_ACTION_ROWS)
+
+
+def get_export_keyboard():
+    """Клавиатура для выбора формата экспорта
+
+    Returns:
+        InlineKeyboardMarkup: Клавиатура с форматами экспорта
+    """
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📊 CSV платежей", callback_data=ExportCallback(type="payments_csv"))
+    builder.button(text="📊 Excel платежей", callback_data=ExportCallback(type="payments_excel"))
+    builder.button(text="👥 CSV пользователей", callback_data=ExportCallback(type="users_csv"))
+    builder.button(text="📈 JSON статистика", callback_data=ExportCallback(type="statistics_json"))
+    builder.button(text="📋 Детальный отчет", callback_data=ExportCallback(type="detailed_report"))
+    builder.button(text="❌ Отмена", callback_data=ExportCallback(type="cancel"))
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+# Клавиатура экспорта не зависит от данных, поэтому строится один раз при импорте
+EXPORT_KEYBOARD = get_export_keyboard()
+
+
+def get_subscription_keyboard(plans, current_subscription=None):
+    """Клавиатура подписок
+
+    Args:
+        plans (list): Список доступных планов подписки
+        current_subscription (UserSubscription, optional): Текущая подписка пользователя. По умолчанию None.
+
+    Returns:
+        InlineKeyboardMarkup: Клавиатура с планами или управлением текущей подпиской
+    """
+    builder = InlineKeyboardBuilder()
+    if current_subscription:
+        builder.button(
+            text="❌ Отменить подписку",
+            callback_data=SubscriptionCallback(action="cancel", id=current_subscription.id)
+        )
+    else:
+        for plan in plans:
+            builder.button(
+                text=f"{plan.name} - {plan.price:.2f} {plan.currency}",
+                callback_data=SubscriptionCallback(action="buy", id=plan.id)
+            )
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def get_currency_keyboard(currencies):
+    """Клавиатура для выбора валюты
+
+    Args:
+        currencies (list): Список поддерживаемых валют
+
+    Returns:
+        InlineKeyboardMarkup: Клавиатура с валютами
+    """
+    builder = InlineKeyboardBuilder()
+    for currency in currencies:
+        builder.button(
+            text=f"{currency.symbol} {currency.code}".strip(),
+            callback_data=CurrencyCallback(code=currency.code)
+        )
+    builder.adjust(3)
+    return builder.as_markup()
@@ -2,14 +2,29 @@
 Модуль для поддержки нескольких валют
 """
 
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Optional
 
 import aiohttp
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean
+from sqlalchemy import DDL, Column, Integer, String, Float, DateTime, Boolean, Index, event, select, update
+from sqlalchemy.exc import SQLAlchemyError
 
 from database import db, Base
 
+logger = logging.getLogger(__name__)
+
+CURRENCIES_CACHE_TTL = 600  # Время жизни кэша списка валют, секунды
+RATES_CACHE_SIZE = 1024  # Максимальное количество валютных пар в кэше курсов
+
+RATES_API_TIMEOUT = aiohttp.ClientTimeout(total=5)  # Ограничение времени запроса к API курсов
+RATES_API_CONNECTIONS_LIMIT = 20
+RATES_API_DNS_CACHE_TTL = 300  # секунды
+
 
 class CurrencyRate(Base):
     """Модель курса валюты"""
@@ -24,6 +39,20 @@ class CurrencyRate(Base):
     is_active = Column(Boolean, default=True)
 
 
+# Одна запись на валютную пару, используется для UPSERT курса. Уникальный индекс, а не
+# ограничение таблицы, чтобы migrate_schema мог создать его и в существующей базе
+uq_currency_rate_pair = Index(
+    'uq_currency_rate_pair', CurrencyRate.base_currency, CurrencyRate.target_currency, unique=True
+)
+
+# Старая схема допускала несколько записей одной пары: перед созданием индекса
+# остается только последняя, курсы все равно обновляются из API
+event.listen(uq_currency_rate_pair, "before_create", DDL(
+    "DELETE FROM currency_rates WHERE id NOT IN "
+    "(SELECT MAX(id) FROM currency_rates GROUP BY base_currency, target_currency)"
+))
+
+
 class SupportedCurrency(Base):
     """Модель поддерживаемой валюты"""
 
@@ -44,9 +73,90 @@ class CurrencyConverter:
 
     def __init__(self):
         self.db = db
-        self.cache: Dict[str, float] = {}
+        # (базовая валюта, целевая валюта) -> (курс, время сохранения по time.monotonic())
+        self.cache: OrderedDict = OrderedDict()
         self.cache_timeout = 3600  # 1 час в секундах
 
+        # Блокировки по валютной паре: при промахе кэша курс запрашивается один раз,
+        # остальные корутины ждут результат
+        self._rate_locks = weakref.WeakValueDictionary()
+
+        # Список валют меняется только через add_supported_currency: (время истечения, значение)
+        self._currencies_cache = None
+        self._default_currency_cache = None
+        # Код -> активная валюта, строится вместе с кэшем списка валют
+        self._currency_map = {}
+
+        # Общая HTTP-сессия приложения, передается при запуске бота.
+        # Без нее конвертер создает и переиспользует собственную сессию
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        self._owns_session = False
+
+    def set_http_session(self, session: aiohttp.ClientSession):
+        """Установка общей HTTP-сессии для запросов к API курсов
+
+        Args:
+            session (aiohttp.ClientSession): Сессия с общим пулом соединений
+        """
+        self.http_session = session
+        self._owns_session = False
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """Сессия для запросов к API курсов
+
+        Returns:
+            aiohttp.ClientSession: Общая сессия или собственная сессия конвертера
+        """
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=RATES_API_CONNECTIONS_LIMIT, ttl_dns_cache=RATES_API_DNS_CACHE_TTL
+                ),
+                timeout=RATES_API_TIMEOUT
+            )
+            self._owns_session = True
+        return self.http_session
+
+    async def close(self):
+        """Закрытие собственной HTTP-сессии конвертера (общую сессию закрывает бот)"""
+        if self._owns_session and self.http_session is not None:
+            await self.http_session.close()
+        self.http_session = None
+        self._owns_session = False
+
+    def _invalidate_currencies(self):
+        """Сброс кэша списка валют и валюты по умолчанию"""
+        self._currencies_cache = None
+        self._default_currency_cache = None
+
+    def _get_cached_rate(self, cache_key) -> Optional[float]:
+        """Получение актуального курса из кэша
+
+        Args:
+            cache_key (tuple): Валютная пара
+
+        Returns:
+            Optional[float]: Курс или None, если его нет в кэше или он устарел
+        """
+        entry = self.cache.get(cache_key)
+        if entry is None or time.monotonic() - entry[1] >= self.cache_timeout:
+            return None
+
+        self.cache.move_to_end(cache_key)
+        return entry[0]
+
+    def _cache_rate(self, cache_key, rate: float):
+        """Сохранение курса в кэш с вытеснением самых старых пар
+
+        Args:
+            cache_key (tuple): Валютная пара
+            rate (float): Курс обмена
+        """
+        self.cache[cache_key] = (rate, time.monotonic())
+        self.cache.move_to_end(cache_key)
+        if len(self.cache) > RATES_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
     async def get_exchange_rate(self, base_currency: str, target_currency: str) -> Optional[float]:
         """Получение курса обмена валют
 
@@ -60,40 +170,48 @@ class CurrencyConverter:
         if base_currency == target_currency:
             return 1.0
 
-        cache_key = f"{base_currency}_{target_currency}"
+        cache_key = (base_currency, target_currency)
 
         # Проверяем кэш
-        if cache_key in self.cache:
-            rate, timestamp = self.cache[cache_key]
-            if (datetime.utcnow() - timestamp).seconds < self.cache_timeout:
+        rate = self._get_cached_rate(cache_key)
+        if rate is not None:
+            return rate
+
+        lock = self._rate_locks.get(cache_key)
+        if lock is None:
+            lock = self._rate_locks[cache_key] = asyncio.Lock()
+
+        async with lock:
+            # Пока ждали блокировку, курс мог получить другой запрос
+            rate = self._get_cached_rate(cache_key)
+            if rate is not None:
                 return rate
 
-        # Проверяем базу данных
-        session = self.db.get_session()
-        currency_rate = session.query(CurrencyRate).filter(
-            CurrencyRate.base_currency == base_currency,
-            CurrencyRate.target_currency == target_currency,
-            CurrencyRate.is_active == True
-        ).first()
-
-        if currency_rate and (datetime.utcnow() - currency_rate.last_updated).seconds < self.cache_timeout:
-            self.cache[cache_key] = (currency_rate.rate, datetime.utcnow())
-            session.close()
-            return currency_rate.rate
+            # Проверяем базу данных
+            async with self.db.async_session() as session:
+                result = await session.execute(select(CurrencyRate).where(
+                    CurrencyRate.base_currency == base_currency,
+                    CurrencyRate.target_currency == target_currency,
+                    CurrencyRate.is_active == True
+                ))
+                currency_rate = result.scalars().first()
 
-        session.close()
+            if currency_rate and (
+                    datetime.utcnow() - currency_rate.last_updated).total_seconds() < self.cache_timeout:
+                self._cache_rate(cache_key, currency_rate.rate)
+                return currency_rate.rate
 
-        # Получаем курс из внешнего API
-        rate = await self._fetch_exchange_rate(base_currency, target_currency)
+            # Получаем курс из внешнего API
+            rate = await self._fetch_exchange_rate(base_currency, target_currency)
 
-        if rate:
-            # Сохраняем в кэш
-            self.cache[cache_key] = (rate, datetime.utcnow())
+            if rate:
+                # Сохраняем в кэш
+                self._cache_rate(cache_key, rate)
 
-            # Сохраняем в базу данных
-            await self._save_exchange_rate(base_currency, target_currency, rate)
+                # Сохраняем в базу данных
+                await self._save_exchange_rate(base_currency, target_currency, rate)
 
-        return rate
+            return rate
 
     async def _fetch_exchange_rate(self, base_currency: str, target_currency: str) -> Optional[float]:
         """Получение курса обмена из внешнего API
@@ -105,60 +223,79 @@ class CurrencyConverter:
         Returns:
             Optional[float]: Курс обмена или None в случае ошибки
         """
+        urls = [
+            # Бесплатный API exchangerate-api.com
+            f"https://api.exchangerate-api.com/v4/latest/{base_currency}",
+            # Альтернативный API
+            f"https://api.exchangerate.host/latest?base={base_currency}&symbols={target_currency}",
+        ]
+
+        # Оба API опрашиваются одновременно, используется первый успешный ответ
+        tasks = [asyncio.create_task(self._probe_exchange_rate(url, target_currency)) for url in urls]
         try:
-            # Используем бесплатный API exchangerate-api.com
-            url = f"https://api.exchangerate-api.com/v4/latest/{base_currency}"
+            for next_result in asyncio.as_completed(tasks):
+                rate = await next_result
+                if rate is not None:
+                    return rate
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
 
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        rates = data.get('rates', {})
-                        return rates.get(target_currency)
+    async def _probe_exchange_rate(self, url: str, target_currency: str) -> Optional[float]:
+        """Запрос курса у одного API
 
-            # Альтернативный API
-            url = f"https://api.exchangerate.host/latest?base={base_currency}&symbols={target_currency}"
+        Args:
+            url (str): Адрес API
+            target_currency (str): Целевая валюта
 
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        rates = data.get('rates', {})
-                        return rates.get(target_currency)
+        Returns:
+            Optional[float]: Курс обмена или None в случае ошибки
+        """
+        try:
+            session = self._get_http_session()
 
-        except Exception as e:
-            print(f"Ошибка получения курса валют: {e}")
-            return None
+            async with session.get(url, timeout=RATES_API_TIMEOUT) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    rates = data.get('rates', {})
+                    return rates.get(target_currency)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"Ошибка получения курса валют {url}: {e}")
+
+        return None
 
     async def _save_exchange_rate(self, base_currency: str, target_currency: str, rate: float):
         """Сохранение курса обмена в базу данных
 
+        Ошибка записи только логируется: курс уже получен и закэширован,
+        и конвертация не должна из-за нее завершаться исключением.
+
         Args:
             base_currency (str): Базовая валюта
             target_currency (str): Целевая валюта
             rate (float): Курс обмена
         """
-        session = self.db.get_session()
-
-        # Ищем существующую запись
-        currency_rate = session.query(CurrencyRate).filter(
-            CurrencyRate.base_currency == base_currency,
-            CurrencyRate.target_currency == target_currency
-        ).first()
-
-        if currency_rate:
-            currency_rate.rate = rate
-            currency_rate.last_updated = datetime.utcnow()
-        else:
-            currency_rate = CurrencyRate(
-                base_currency=base_currency,
-                target_currency=target_currency,
-                rate=rate
-            )
-            session.add(currency_rate)
+        now = datetime.utcnow()
+        # Один INSERT ... ON CONFLICT DO UPDATE вместо SELECT и последующего UPDATE/INSERT
+        stmt = self.db.insert(CurrencyRate).values(
+            base_currency=base_currency,
+            target_currency=target_currency,
+            rate=rate,
+            last_updated=now
+        ).on_conflict_do_update(
+            index_elements=['base_currency', 'target_currency'],
+            set_={'rate': rate, 'last_updated': now}
+        )
 
-        session.commit()
-        session.close()
+        async with self.db.async_session() as session:
+            try:
+                await session.execute(stmt)
+                await session.commit()
+            except SQLAlchemyError:
+                await session.rollback()
+                logger.exception(f"Ошибка сохранения курса {base_currency}/{target_currency}")
 
     async def convert_amount(self, amount: float, from_currency: str, to_currency: str) -> Optional[float]:
         """Конвертация суммы из одной валюты в другую
@@ -188,18 +325,13 @@ class CurrencyConverter:
         Returns:
             str: Отформатированная сумма
         """
-        session = self.db.get_session()
-
-        currency = session.query(SupportedCurrency).filter(
-            SupportedCurrency.code == currency_code,
-            SupportedCurrency.is_active == True
-        ).first()
-
-        session.close()
+        # Справочник валют берется из кэша списка поддерживаемых валют
+        await self.get_supported_currencies()
+        currency = self._currency_map.get(currency_code)
 
         if currency and currency.symbol:
             # Форматирование с символом валюты
-            if currency.symbol.startswith('$') or currency.symbol.startswith('€') or currency.symbol.startswith('£'):
+            if currency.symbol[0] in '$€£':
                 return f"{currency.symbol}{amount:.{currency.decimal_places}f}"
             else:
                 return f"{amount:.{currency.decimal_places}f} {currency.symbol}"
@@ -213,13 +345,19 @@ class CurrencyConverter:
         Returns:
             list: Список поддерживаемых валют
         """
-        session = self.db.get_session()
-
-        currencies = session.query(SupportedCurrency).filter(
-            SupportedCurrency.is_active == True
-        ).order_by(SupportedCurrency.code).all()
+        if self._currencies_cache is not None and self._currencies_cache[0] > time.monotonic():
+            return self._currencies_cache[1]
+
+        async with self.db.async_session() as session:
+            result = await session.execute(
+                select(SupportedCurrency)
+                .where(SupportedCurrency.is_active == True)
+                .order_by(SupportedCurrency.code)
+            )
+            currencies = result.scalars().all()
 
-        session.close()
+        self._currencies_cache = (time.monotonic() + CURRENCIES_CACHE_TTL, currencies)
+        self._currency_map = {currency.code: currency for currency in currencies}
 
         return currencies
 
@@ -237,33 +375,29 @@ class CurrencyConverter:
         Returns:
             bool: Успешность добавления
         """
-        session = self.db.get_session()
-
-        # Проверяем, существует ли уже валюта
-        existing = session.query(SupportedCurrency).filter(
-            SupportedCurrency.code == code
-        ).first()
-
-        if existing:
-            session.close()
-            return False
-
-        # Если это валюта по умолчанию, сбрасываем флаг у других валют
-        if is_default:
-            session.query(SupportedCurrency).update({SupportedCurrency.is_default: False})
-
-        # Добавляем валюту
-        currency = SupportedCurrency(
-            code=code,
-            name=name,
-            symbol=symbol,
-            decimal_places=decimal_places,
-            is_default=is_default
-        )
+        async with self.db.async_session() as session:
+            # Проверяем, существует ли уже валюта
+            result = await session.execute(select(SupportedCurrency.id).where(SupportedCurrency.code == code))
+            if result.first() is not None:
+                return False
+
+            # Если это валюта по умолчанию, сбрасываем флаг у других валют
+            if is_default:
+                await session.execute(update(SupportedCurrency).values(is_default=False))
+
+            # Добавляем валюту
+            currency = SupportedCurrency(
+                code=code,
+                name=name,
+                symbol=symbol,
+                decimal_places=decimal_places,
+                is_default=is_default
+            )
+
+            session.add(currency)
+            await session.commit()
 
-        session.add(currency)
-        session.commit()
-        session.close()
+        self._invalidate_currencies()
 
         return True
 
@@ -273,13 +407,16 @@ class CurrencyConverter:
         Returns:
             Optional[SupportedCurrency]: Валюта по умолчанию или None
         """
-        session = self.db.get_session()
+        if self._default_currency_cache is not None and self._default_currency_cache[0] > time.monotonic():
+            return self._default_currency_cache[1]
 
-        currency = session.query(SupportedCurrency).filter(
-            SupportedCurrency.is_default == True,
-            SupportedCurrency.is_active == True
-        ).first()
+        async with self.db.async_session() as session:
+            result = await session.execute(select(SupportedCurrency).where(
+                SupportedCurrency.is_default == True,
+                SupportedCurrency.is_active == True
+            ))
+            currency = result.scalars().first()
 
-        session.close()
+        self._default_currency_cache = (time.monotonic() + CURRENCIES_CACHE_TTL, currency)
 
         return currency
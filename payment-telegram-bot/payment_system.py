@@ -1,10 +1,76 @@
-import uuid
+import asyncio
+import base64
+import logging
+import secrets
+from decimal import Decimal, ROUND_HALF_EVEN
+from functools import lru_cache
+from typing import Optional
 
 import aiohttp
+import msgspec
+from sqlalchemy import insert, update
+from sqlalchemy.exc import SQLAlchemyError
 
 import config
 from database import db, Payment
 
+logger = logging.getLogger(__name__)
+
+# Пул соединений сессии PaymentManager, если общая сессия бота не передана
+PAYMENT_HTTP_CONNECTIONS_LIMIT = 100
+PAYMENT_HTTP_CONNECTIONS_PER_HOST = 32
+PAYMENT_HTTP_KEEPALIVE_TIMEOUT = 75  # секунды
+PAYMENT_HTTP_DNS_CACHE_TTL = 300  # секунды
+
+# Повтор запросов к ЮKassa при временных ошибках сети и шлюза
+YOOKASSA_RETRY_ATTEMPTS = 3
+YOOKASSA_RETRY_BASE_DELAY = 0.2  # секунды, удваивается с каждой попыткой
+YOOKASSA_RETRY_STATUSES = frozenset({502, 503, 504})
+YOOKASSA_RETRY_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError, asyncio.TimeoutError)
+
+# Ошибки запроса к ЮKassa, после которых платеж считается несозданным; остальные исключения пробрасываются
+YOOKASSA_REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, msgspec.DecodeError)
+
+
+def to_minor_units(amount) -> int:
+    """Перевод суммы в копейки/центы без ошибок округления float
+
+    Сумма переводится в Decimal через строку, поэтому 1.15 дает 115, а не 114.
+
+    Args:
+        amount (float): Сумма в основных единицах валюты
+
+    Returns:
+        int: Сумма в минимальных единицах валюты
+    """
+    return int((Decimal(str(amount)) * 100).to_integral_value(ROUND_HALF_EVEN))
+
+
+def format_minor_units(minor_units: int) -> str:
+    """Форматирование суммы в минимальных единицах для API ("123.45")
+
+    Args:
+        minor_units (int): Сумма в копейках/центах
+
+    Returns:
+        str: Сумма с двумя знаками после точки
+    """
+    return f"{minor_units // 100}.{minor_units % 100:02d}"
+
+
+@lru_cache(maxsize=256)
+def build_invoice_prices(label: str, minor_units: int) -> tuple:
+    """Позиции инвойса Telegram, одинаковые для повторяющихся сумм и описаний
+
+    Args:
+        label (str): Название позиции
+        minor_units (int): Сумма в копейках/центах
+
+    Returns:
+        tuple: Позиции инвойса
+    """
+    return ({"label": label, "amount": minor_units},)
+
 
 class PaymentSystem:
     """Базовый класс для платежных систем"""
@@ -12,7 +78,7 @@ class PaymentSystem:
     def __init__(self):
         self.provider_name = "base"
 
-    async def create_payment(self, user_id, amount, currency="RUB", description=""):
+    async def create_payment(self, user_id, amount, currency="RUB", description="", service_id=None):
         """Создание платежа
 
         Args:
@@ -20,6 +86,7 @@ class PaymentSystem:
             amount (float): Сумма платежа
             currency (str, optional): Валюта. По умолчанию "RUB".
             description (str, optional): Описание платежа. По умолчанию "".
+            service_id (int, optional): ID покупаемой услуги. По умолчанию None.
 
         Returns:
             dict: Данные для оплаты или None в случае ошибки
@@ -46,7 +113,7 @@ class TelegramPaymentSystem(PaymentSystem):
         self.provider_name = "telegram"
         self.bot = bot
 
-    async def create_payment(self, user_id, amount, currency="RUB", description="Пополнение баланса"):
+    async def create_payment(self, user_id, amount, currency="RUB", description="Пополнение баланса", service_id=None):
         """Создание платежа через Telegram Payments
 
         Args:
@@ -54,33 +121,31 @@ class TelegramPaymentSystem(PaymentSystem):
             amount (float): Сумма платежа
             currency (str, optional): Валюта. По умолчанию "RUB".
             description (str, optional): Описание платежа. По умолчанию "Пополнение баланса".
+            service_id (int, optional): ID покупаемой услуги. По умолчанию None.
 
         Returns:
             dict: Данные для отправки инвойса или None в случае ошибки
         """
         try:
             # Генерируем уникальный ID для платежа
-            invoice_payload = str(uuid.uuid4())
-
-            # Создаем платеж в базе данных
-            session = db.get_session()
-            payment = Payment(
-                user_id=user_id,
-                amount=amount,
-                currency=currency,
-                payment_provider=self.provider_name,
-                invoice_payload=invoice_payload
-            )
-            session.add(payment)
-            session.commit()
-            payment_id = payment.id
-            session.close()
-
-            # Формируем данные для инвойса
-            prices = [{
-                "label": description,
-                "amount": int(amount * 100)  # Сумма в копейках/центах
-            }]
+            invoice_payload = secrets.token_hex(16)
+
+            # Создаем платеж в базе данных: объект не нужен, достаточно ID из RETURNING
+            async with db.async_session() as session:
+                payment_id = (await session.execute(
+                    insert(Payment).values(
+                        user_id=user_id,
+                        amount=amount,
+                        currency=currency,
+                        payment_provider=self.provider_name,
+                        invoice_payload=invoice_payload,
+                        service_id=service_id
+                    ).returning(Payment.id)
+                )).scalar_one()
+                await session.commit()
+
+            # Формируем данные для инвойса: сумма в копейках/центах
+            prices = build_invoice_prices(description, to_minor_units(amount))
 
             return {
                 "title": "Пополнение баланса",
@@ -88,12 +153,12 @@ class TelegramPaymentSystem(PaymentSystem):
                 "payload": invoice_payload,
                 "provider_token": config.Config.PAYMENT_PROVIDER_TOKEN,
                 "currency": currency,
-                "prices": prices,
+                "prices": list(prices),
                 "payment_id": payment_id
             }
 
-        except Exception as e:
-            print(f"Ошибка создания платежа Telegram: {e}")
+        except SQLAlchemyError:
+            logger.exception("Ошибка создания платежа Telegram")
             return None
 
     async def check_payment(self, payment_id):
@@ -112,43 +177,62 @@ class TelegramPaymentSystem(PaymentSystem):
 class YooKassaPaymentSystem(PaymentSystem):
     """Платежная система ЮKassa"""
 
-    def __init__(self):
+    def __init__(self, get_http_session):
         super().__init__()
         self.provider_name = "yookassa"
         self.base_url = "https://api.yookassa.ru/v3"
 
-    async def _make_request(self, method, endpoint, data=None):
+        # Функция, возвращающая HTTP-сессию: сессией и ее закрытием владеет PaymentManager
+        self._get_http_session = get_http_session
+
+        # Заголовок Basic-авторизации кодируется один раз, а не при каждом запросе
+        credentials = f"{config.Config.YOOKASSA_SHOP_ID}:{config.Config.YOOKASSA_SECRET_KEY}"
+        self._auth_header = "Basic " + base64.b64encode(credentials.encode()).decode()
+
+    async def _make_request(self, method, endpoint, data=None, idempotence_key=None):
         """Выполнение запроса к API ЮKassa
 
+        При ответах 502/503/504 и сетевых ошибках запрос повторяется с экспоненциальной
+        задержкой. Все попытки отправляются с одним Idempotence-Key, поэтому ЮKassa
+        не создаст повторный платеж.
+
         Args:
             method (str): HTTP метод
             endpoint (str): Эндпоинт API
             data (dict, optional): Данные для запроса. По умолчанию None.
+            idempotence_key (str, optional): Ключ идемпотентности. По умолчанию новый случайный ключ.
 
         Returns:
             dict: Ответ API
         """
-        auth = aiohttp.BasicAuth(
-            login=config.Config.YOOKASSA_SHOP_ID,
-            password=config.Config.YOOKASSA_SECRET_KEY
-        )
-
         headers = {
-            "Idempotence-Key": str(uuid.uuid4()),
+            "Authorization": self._auth_header,
+            "Idempotence-Key": idempotence_key or secrets.token_urlsafe(18),
             "Content-Type": "application/json"
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                    method,
-                    f"{self.base_url}/{endpoint}",
-                    auth=auth,
-                    headers=headers,
-                    json=data
-            ) as response:
-                return await response.json()
-
-    async def create_payment(self, user_id, amount, currency="RUB", description="Пополнение баланса"):
+        # Тело кодируется и разбирается через msgspec, а не через stdlib json
+        body = msgspec.json.encode(data) if data is not None else None
+
+        session = self._get_http_session()
+        last_attempt = YOOKASSA_RETRY_ATTEMPTS - 1
+        for attempt in range(YOOKASSA_RETRY_ATTEMPTS):
+            try:
+                async with session.request(
+                        method,
+                        f"{self.base_url}/{endpoint}",
+                        headers=headers,
+                        data=body
+                ) as response:
+                    if response.status not in YOOKASSA_RETRY_STATUSES or attempt == last_attempt:
+                        return msgspec.json.decode(await response.read())
+            except YOOKASSA_RETRY_ERRORS:
+                if attempt == last_attempt:
+                    raise
+
+            await asyncio.sleep(YOOKASSA_RETRY_BASE_DELAY * 2 ** attempt)
+
+    async def create_payment(self, user_id, amount, currency="RUB", description="Пополнение баланса", service_id=None):
         """Создание платежа через ЮKassa
 
         Args:
@@ -156,28 +240,29 @@ class YooKassaPaymentSystem(PaymentSystem):
             amount (float): Сумма платежа
             currency (str, optional): Валюта. По умолчанию "RUB".
             description (str, optional): Описание платежа. По умолчанию "Пополнение баланса".
+            service_id (int, optional): ID покупаемой услуги. По умолчанию None.
 
         Returns:
             dict: Данные для оплаты или None в случае ошибки
         """
         try:
-            # Создаем платеж в базе данных
-            session = db.get_session()
-            payment = Payment(
-                user_id=user_id,
-                amount=amount,
-                currency=currency,
-                payment_provider=self.provider_name
-            )
-            session.add(payment)
-            session.commit()
-            payment_id = payment.id
-            session.close()
+            # Транзакция не держится открытой во время запроса к ЮKassa
+            async with db.async_session() as session:
+                payment_id = (await session.execute(
+                    insert(Payment).values(
+                        user_id=user_id,
+                        amount=amount,
+                        currency=currency,
+                        payment_provider=self.provider_name,
+                        service_id=service_id
+                    ).returning(Payment.id)
+                )).scalar_one()
+                await session.commit()
 
             # Создаем платеж в ЮKassa
             payment_data = {
                 "amount": {
-                    "value": str(amount),
+                    "value": format_minor_units(to_minor_units(amount)),
                     "currency": currency
                 },
                 "payment_method_data": {
@@ -194,27 +279,30 @@ class YooKassaPaymentSystem(PaymentSystem):
                 }
             }
 
-            response = await self._make_request("POST", "payments", payment_data)
-
-            if "id" in response:
-                # Обновляем платеж в базе данных
-                session = db.get_session()
-                payment = session.query(Payment).filter(Payment.id == payment_id).first()
-                if payment:
-                    payment.provider_payment_id = response["id"]
-                    session.commit()
-                session.close()
-
-                return {
-                    "payment_id": payment_id,
-                    "confirmation_url": response["confirmation"]["confirmation_url"],
-                    "yookassa_payment_id": response["id"]
-                }
-            else:
+            # Ключ создается один раз на платеж и переиспользуется при повторах запроса
+            response = await self._make_request(
+                "POST", "payments", payment_data, idempotence_key=secrets.token_urlsafe(18)
+            )
+
+            if "id" not in response:
                 return None
 
-        except Exception as e:
-            print(f"Ошибка создания платежа ЮKassa: {e}")
+            # Обновляем платеж в базе данных одним UPDATE, без повторного SELECT
+            async with db.async_session() as session:
+                await session.execute(
+                    update(Payment).where(Payment.id == payment_id).values(provider_payment_id=response["id"])
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+
+            return {
+                "payment_id": payment_id,
+                "confirmation_url": response["confirmation"]["confirmation_url"],
+                "yookassa_payment_id": response["id"]
+            }
+
+        except (*YOOKASSA_REQUEST_ERRORS, SQLAlchemyError):
+            logger.exception("Ошибка создания платежа ЮKassa")
             return None
 
     async def check_payment(self, payment_id):
@@ -229,8 +317,8 @@ class YooKassaPaymentSystem(PaymentSystem):
         try:
             response = await self._make_request("GET", f"payments/{payment_id}")
             return {"status": response.get("status", "unknown")}
-        except Exception as e:
-            print(f"Ошибка проверки платежа ЮKassa: {e}")
+        except YOOKASSA_REQUEST_ERRORS:
+            logger.exception("Ошибка проверки платежа ЮKassa")
             return {"status": "unknown"}
 
 
@@ -241,14 +329,56 @@ class PaymentManager:
         self.systems = {}
         self.bot = bot
 
+        # Одна HTTP-сессия на все платежные системы: общая сессия бота
+        # или собственная сессия менеджера, созданная при первом запросе
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        self._owns_session = False
+
         # Инициализация платежных систем
         if config.Config.PAYMENT_PROVIDER_TOKEN:
             self.systems["telegram"] = TelegramPaymentSystem(bot)
 
         if config.Config.YOOKASSA_SHOP_ID and config.Config.YOOKASSA_SECRET_KEY:
-            self.systems["yookassa"] = YooKassaPaymentSystem()
+            self.systems["yookassa"] = YooKassaPaymentSystem(self._get_http_session)
+
+        # Набор провайдеров фиксируется при запуске, поэтому список вычисляется один раз
+        self._providers = tuple(self.systems)
+
+    def set_http_session(self, session: aiohttp.ClientSession):
+        """Установка общей HTTP-сессии для платежных систем, которые обращаются к внешним API
+
+        Args:
+            session (aiohttp.ClientSession): Сессия с общим пулом соединений
+        """
+        self.http_session = session
+        self._owns_session = False
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """Сессия для запросов платежных систем
+
+        Returns:
+            aiohttp.ClientSession: Общая сессия или собственная сессия менеджера
+        """
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=PAYMENT_HTTP_CONNECTIONS_LIMIT,
+                    limit_per_host=PAYMENT_HTTP_CONNECTIONS_PER_HOST,
+                    keepalive_timeout=PAYMENT_HTTP_KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=PAYMENT_HTTP_DNS_CACHE_TTL
+                )
+            )
+            self._owns_session = True
+        return self.http_session
+
+    async def close(self):
+        """Закрытие собственной HTTP-сессии менеджера (общую сессию закрывает бот)"""
+        if self._owns_session and self.http_session is not None:
+            await self.http_session.close()
+        self.http_session = None
+        self._owns_session = False
 
-    async def create_payment(self, provider, user_id, amount, currency="RUB", description=""):
+    async def create_payment(self, provider, user_id, amount, currency="RUB", description="", service_id=None):
         """Создание платежа через выбранного провайдера
 
         Args:
@@ -257,6 +387,7 @@ class PaymentManager:
             amount (float): Сумма платежа
             currency (str, optional): Валюта. По умолчанию "RUB".
             description (str, optional): Описание платежа. По умолчанию "".
+            service_id (int, optional): ID покупаемой услуги. По умолчанию None.
 
         Returns:
             dict: Результат создания платежа или None
@@ -265,7 +396,7 @@ class PaymentManager:
             return None
 
         return await self.systems[provider].create_payment(
-            user_id, amount, currency, description
+            user_id, amount, currency, description, service_id
         )
 
     async def check_payment(self, provider, payment_id):
@@ -287,6 +418,6 @@ class PaymentManager:
         """Получение списка доступных платежных систем
 
         Returns:
-            list: Список доступных платежных систем
+            tuple: Список доступных платежных систем
         """
-        return list(self.systems.keys())
+        return self._providers
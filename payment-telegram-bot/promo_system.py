@@ -2,13 +2,22 @@
 Модуль для реализации системы промокодов и скидок
 """
 
+import time
+from collections import Counter, OrderedDict
 from datetime import datetime
 from enum import Enum
 
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Enum as SQLEnum
+from sqlalchemy import (
+    Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Index, Enum as SQLEnum,
+    and_, bindparam, case, func, insert, or_, select, update
+)
+from sqlalchemy.exc import IntegrityError
 
 from database import db, Base
 
+PROMO_CACHE_TTL = 30  # Время жизни кэша промокодов, секунды
+PROMO_CACHE_SIZE = 1024  # Максимальное количество кодов в кэше
+
 
 class PromoCodeType(Enum):
     """Типы промокодов"""
@@ -42,6 +51,11 @@ class PromoCodeUsage(Base):
     """Модель использования промокода"""
 
     __tablename__ = 'promo_code_usages'
+    __table_args__ = (
+        # Один пользователь применяет промокод один раз; индекс также служит проверке
+        # повторного использования и подсчету уникальных пользователей
+        Index('ix_promo_usage_code_user', 'promo_code_id', 'user_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     promo_code_id = Column(Integer, ForeignKey('promo_codes.id'), nullable=False)
@@ -52,12 +66,60 @@ class PromoCodeUsage(Base):
     payment_id = Column(Integer, ForeignKey('payments.id'), nullable=True)
 
 
+# Запросы проверки промокода строятся один раз: при каждом вызове меняются только
+# параметры, а скомпилированный SQL берется из кэша запросов SQLAlchemy
+ACTIVE_PROMO_CODE_QUERY = select(PromoCode).where(
+    PromoCode.code == bindparam("code"),
+    PromoCode.is_active == True
+)
+PROMO_CODE_USED_QUERY = select(1).where(
+    PromoCodeUsage.promo_code_id == bindparam("promo_code_id"),
+    PromoCodeUsage.user_id == bindparam("user_id")
+).limit(1)
+
+
 class PromoSystem:
     """Класс для управления промокодами"""
 
     def __init__(self):
         self.db = db
 
+        # Код -> (время истечения по time.monotonic(), активный промокод или None).
+        # Во время акции один код проверяют многие пользователи, строка промокода меняется редко
+        self._promo_cache: OrderedDict = OrderedDict()
+
+    def _get_active_promo_code(self, code: str):
+        """Получение активного промокода по коду с кэшированием
+
+        Args:
+            code (str): Код промокода в верхнем регистре
+
+        Returns:
+            PromoCode: Промокод или None, если активного промокода с таким кодом нет
+        """
+        entry = self._promo_cache.get(code)
+        if entry is not None and entry[0] > time.monotonic():
+            self._promo_cache.move_to_end(code)
+            return entry[1]
+
+        with self.db.session_scope() as session:
+            promo_code = session.execute(ACTIVE_PROMO_CODE_QUERY, {"code": code}).scalar_one_or_none()
+
+        self._promo_cache[code] = (time.monotonic() + PROMO_CACHE_TTL, promo_code)
+        self._promo_cache.move_to_end(code)
+        if len(self._promo_cache) > PROMO_CACHE_SIZE:
+            self._promo_cache.popitem(last=False)
+
+        return promo_code
+
+    def _invalidate_promo_code(self, code: str):
+        """Сброс кэша промокода
+
+        Args:
+            code (str): Код промокода
+        """
+        self._promo_cache.pop(code.upper(), None)
+
     def create_promo_code(self, code: str, promo_type: PromoCodeType, discount_value: float,
                           valid_to: datetime = None, max_uses: int = None,
                           max_discount: float = None, min_order_amount: float = 0.0,
@@ -78,32 +140,33 @@ class PromoSystem:
         Returns:
             PromoCode: Объект промокода
         """
-        session = self.db.get_session()
-
-        # Проверяем, не существует ли уже такой код
-        existing = session.query(PromoCode).filter(PromoCode.code == code).first()
-
-        if existing:
-            session.close()
-            raise ValueError("Промокод с таким кодом уже существует")
-
-        # Создаем промокод
-        promo_code = PromoCode(
-            code=code.upper(),
-            promo_type=promo_type,
-            discount_value=discount_value,
-            valid_to=valid_to,
-            max_uses=max_uses,
-            max_discount=max_discount,
-            min_order_amount=min_order_amount,
-            service_id=service_id,
-            description=description
-        )
-
-        session.add(promo_code)
-        session.commit()
-        session.refresh(promo_code)
-        session.close()
+        with self.db.session_scope() as session:
+            # Проверяем, не существует ли уже такой код
+            existing = session.query(PromoCode).filter(PromoCode.code == code).first()
+
+            if existing:
+                raise ValueError("Промокод с таким кодом уже существует")
+
+            # Создаем промокод
+            promo_code = PromoCode(
+                code=code.upper(),
+                promo_type=promo_type,
+                discount_value=discount_value,
+                valid_to=valid_to,
+                max_uses=max_uses,
+                max_discount=max_discount,
+                min_order_amount=min_order_amount,
+                service_id=service_id,
+                description=description
+            )
+
+            # ID и значения по умолчанию заполняются при flush, commit выполнит session_scope;
+            # атрибуты не сбрасываются после commit (expire_on_commit=False)
+            session.add(promo_code)
+            session.flush()
+
+        # Код мог быть закэширован как несуществующий
+        self._invalidate_promo_code(promo_code.code)
 
         return promo_code
 
@@ -118,15 +181,9 @@ class PromoSystem:
         Returns:
             dict: Результат валидации
         """
-        session = self.db.get_session()
-
-        promo_code = session.query(PromoCode).filter(
-            PromoCode.code == code.upper(),
-            PromoCode.is_active == True
-        ).first()
+        promo_code = self._get_active_promo_code(code.upper())
 
         if not promo_code:
-            session.close()
             return {
                 "valid": False,
                 "message": "Промокод не найден"
@@ -135,14 +192,12 @@ class PromoSystem:
         # Проверяем срок действия
         now = datetime.utcnow()
         if promo_code.valid_from and promo_code.valid_from > now:
-            session.close()
             return {
                 "valid": False,
                 "message": "Промокод еще не активен"
             }
 
         if promo_code.valid_to and promo_code.valid_to < now:
-            session.close()
             return {
                 "valid": False,
                 "message": "Срок действия промокода истек"
@@ -150,7 +205,6 @@ class PromoSystem:
 
         # Проверяем лимит использований
         if promo_code.max_uses and promo_code.current_uses >= promo_code.max_uses:
-            session.close()
             return {
                 "valid": False,
                 "message": "Лимит использований промокода исчерпан"
@@ -158,20 +212,18 @@ class PromoSystem:
 
         # Проверяем минимальную сумму заказа
         if order_amount < promo_code.min_order_amount:
-            session.close()
             return {
                 "valid": False,
                 "message": f"Минимальная сумма заказа для этого промокода: {promo_code.min_order_amount:.2f} RUB"
             }
 
         # Проверяем, не использовал ли пользователь уже этот промокод
-        existing_usage = session.query(PromoCodeUsage).filter(
-            PromoCodeUsage.promo_code_id == promo_code.id,
-            PromoCodeUsage.user_id == user_id
-        ).first()
+        with self.db.session_scope() as session:
+            existing_usage = session.execute(
+                PROMO_CODE_USED_QUERY, {"promo_code_id": promo_code.id, "user_id": user_id}
+            ).scalar()
 
         if existing_usage:
-            session.close()
             return {
                 "valid": False,
                 "message": "Вы уже использовали этот промокод"
@@ -180,8 +232,6 @@ class PromoSystem:
         # Рассчитываем скидку
         discount_info = self._calculate_discount(promo_code, order_amount)
 
-        session.close()
-
         return {
             "valid": True,
             "promo_code": promo_code,
@@ -247,40 +297,57 @@ class PromoSystem:
         Returns:
             dict: Результат применения промокода
         """
-        session = self.db.get_session()
-
-        promo_code = session.query(PromoCode).filter(PromoCode.id == promo_code_id).first()
-
-        if not promo_code:
-            session.close()
+        try:
+            with self.db.session_scope() as session:
+                # Счетчик увеличивается одним условным UPDATE: одновременные применения
+                # не могут превысить лимит, а последнее использование сразу деактивирует промокод
+                promo_code = session.execute(
+                    update(PromoCode)
+                    .where(
+                        PromoCode.id == promo_code_id,
+                        or_(
+                            PromoCode.max_uses.is_(None),
+                            PromoCode.max_uses == 0,
+                            PromoCode.current_uses < PromoCode.max_uses
+                        )
+                    )
+                    .values(
+                        current_uses=PromoCode.current_uses + 1,
+                        is_active=case(
+                            (and_(PromoCode.max_uses > 0, PromoCode.current_uses + 1 >= PromoCode.max_uses), False),
+                            else_=PromoCode.is_active
+                        )
+                    )
+                    .returning(PromoCode.code, PromoCode.promo_type, PromoCode.discount_value, PromoCode.max_discount)
+                ).first()
+
+                if not promo_code:
+                    return {
+                        "success": False,
+                        "message": "Промокод не найден или лимит использований исчерпан"
+                    }
+
+                # Рассчитываем скидку
+                discount_info = self._calculate_discount(promo_code, order_amount)
+
+                # Создаем запись об использовании одним INSERT, без объекта в сессии
+                session.execute(insert(PromoCodeUsage).values(
+                    promo_code_id=promo_code_id,
+                    user_id=user_id,
+                    order_amount=order_amount,
+                    discount_applied=discount_info["discount_amount"],
+                    payment_id=payment_id
+                ))
+        except IntegrityError:
+            # Уникальный индекс (promo_code_id, user_id): повторное применение откатывает
+            # и увеличение счетчика
             return {
                 "success": False,
-                "message": "Промокод не найден"
+                "message": "Вы уже использовали этот промокод"
             }
 
-        # Рассчитываем скидку
-        discount_info = self._calculate_discount(promo_code, order_amount)
-
-        # Создаем запись об использовании
-        usage = PromoCodeUsage(
-            promo_code_id=promo_code_id,
-            user_id=user_id,
-            order_amount=order_amount,
-            discount_applied=discount_info["discount_amount"],
-            payment_id=payment_id
-        )
-
-        session.add(usage)
-
-        # Увеличиваем счетчик использований
-        promo_code.current_uses += 1
-
-        # Если достигнут лимит использований, деактивируем промокод
-        if promo_code.max_uses and promo_code.current_uses >= promo_code.max_uses:
-            promo_code.is_active = False
-
-        session.commit()
-        session.close()
+        # Счетчик использований изменился, кэшированная копия устарела
+        self._invalidate_promo_code(promo_code.code)
 
         return {
             "success": True,
@@ -289,6 +356,67 @@ class PromoSystem:
             "message": discount_info["message"]
         }
 
+    def apply_promo_codes_bulk(self, usages: list) -> int:
+        """Пакетная запись использований промокодов
+
+        Счетчики увеличиваются одним условным UPDATE, как в apply_promo_code: промокод,
+        у которого не хватает оставшихся использований на все его строки в пачке,
+        пропускается целиком. Использования остальных промокодов вставляются одним
+        executemany INSERT. Скидки должны быть уже рассчитаны (например, через
+        validate_promo_code).
+
+        Args:
+            usages (list): Словари с ключами promo_code_id, user_id, order_amount,
+                discount_applied и, при необходимости, payment_id
+
+        Returns:
+            int: Количество записанных использований; 0, если пачка отклонена
+        """
+        if not usages:
+            return 0
+
+        uses_by_promo = Counter(usage["promo_code_id"] for usage in usages)
+        added_uses = case(uses_by_promo, value=PromoCode.id, else_=0)
+
+        try:
+            with self.db.session_scope() as session:
+                applied_codes = dict(session.execute(
+                    update(PromoCode)
+                    .where(
+                        PromoCode.id.in_(uses_by_promo),
+                        or_(
+                            PromoCode.max_uses.is_(None),
+                            PromoCode.max_uses == 0,
+                            PromoCode.current_uses + added_uses <= PromoCode.max_uses
+                        )
+                    )
+                    .values(
+                        current_uses=PromoCode.current_uses + added_uses,
+                        is_active=case(
+                            (and_(PromoCode.max_uses > 0, PromoCode.current_uses + added_uses >= PromoCode.max_uses),
+                             False),
+                            else_=PromoCode.is_active
+                        )
+                    )
+                    .returning(PromoCode.id, PromoCode.code)
+                ).all())
+
+                usage_rows = [
+                    {"payment_id": None, **usage} for usage in usages if usage["promo_code_id"] in applied_codes
+                ]
+                if usage_rows:
+                    session.execute(insert(PromoCodeUsage), usage_rows)
+        except IntegrityError:
+            # Уникальный индекс (promo_code_id, user_id): повторное применение кем-либо
+            # из пачки откатывает всю пачку вместе с увеличением счетчиков
+            return 0
+
+        # Счетчики использований изменились, кэшированные копии устарели
+        for code in applied_codes.values():
+            self._invalidate_promo_code(code)
+
+        return len(usage_rows)
+
     def get_promo_code_stats(self, promo_code_id: int) -> dict:
         """Получение статистики по промокоду
 
@@ -298,27 +426,21 @@ class PromoSystem:
         Returns:
             dict: Статистика промокода
         """
-        session = self.db.get_session()
-
-        promo_code = session.query(PromoCode).filter(PromoCode.id == promo_code_id).first()
-
-        if not promo_code:
-            session.close()
-            return {}
-
-        # Получаем статистику использований
-        usages = session.query(PromoCodeUsage).filter(
-            PromoCodeUsage.promo_code_id == promo_code_id
-        ).all()
-
-        total_uses = len(usages)
-        total_discount = sum(usage.discount_applied for usage in usages)
-        total_orders = sum(usage.order_amount for usage in usages)
-
-        # Уникальные пользователи
-        unique_users = len(set(usage.user_id for usage in usages))
-
-        session.close()
+        with self.db.session_scope() as session:
+            promo_code = session.get(PromoCode, promo_code_id)
+
+            if not promo_code:
+                return {}
+
+            # Статистика использований считается в БД одним запросом
+            total_uses, total_discount, total_orders, unique_users = session.query(
+                func.count(PromoCodeUsage.id),
+                func.coalesce(func.sum(PromoCodeUsage.discount_applied), 0),
+                func.coalesce(func.sum(PromoCodeUsage.order_amount), 0),
+                func.count(func.distinct(PromoCodeUsage.user_id))
+            ).filter(
+                PromoCodeUsage.promo_code_id == promo_code_id
+            ).one()
 
         return {
             "code": promo_code.code,
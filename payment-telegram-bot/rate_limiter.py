@@ -0,0 +1,64 @@
+"""
+Модуль для ограничения частоты исходящих запросов к Telegram Bot API
+"""
+
+from collections import OrderedDict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import AnswerCallbackQuery, SendDocument, SendInvoice, SendMessage
+from aiolimiter import AsyncLimiter
+
+# Telegram допускает около 30 сообщений в секунду на бота, оставляем небольшой запас
+GLOBAL_RATE_LIMIT = 28
+# И не более одного сообщения в секунду в один чат
+CHAT_RATE_LIMIT = 1
+# Количество чатов, для которых хранятся ограничители
+CHAT_LIMITERS_SIZE = 10000
+
+# Методы, отправляющие сообщения в чат
+CHAT_METHODS = (SendMessage, SendDocument, SendInvoice)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота, которая выдерживает лимиты Telegram на отправку сообщений
+
+    Вместо получения 429 Too Many Requests и повторных попыток запросы
+    ожидают свободного места в общем и в початовом ограничителе.
+    Работает для всех вызовов, включая message.answer().
+    """
+
+    def __init__(self):
+        self._global_limiter = AsyncLimiter(GLOBAL_RATE_LIMIT, 1)
+        self._chat_limiters = OrderedDict()
+
+    def _get_chat_limiter(self, chat_id):
+        """Получение ограничителя для чата
+
+        Args:
+            chat_id (int): ID чата
+
+        Returns:
+            AsyncLimiter: Ограничитель частоты для чата
+        """
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = AsyncLimiter(CHAT_RATE_LIMIT, 1)
+            # Давно неактивные чаты вытесняются: их ограничитель все равно полностью восстановлен
+            if len(self._chat_limiters) > CHAT_LIMITERS_SIZE:
+                self._chat_limiters.popitem(last=False)
+        else:
+            self._chat_limiters.move_to_end(chat_id)
+        return limiter
+
+    async def __call__(self, make_request, bot, method):
+        """Ожидание лимитов перед выполнением запроса
+
+        Ответ на колбэк не является сообщением в чат и ограничивается только общим лимитом.
+        """
+        if isinstance(method, CHAT_METHODS):
+            await self._get_chat_limiter(method.chat_id).acquire()
+            await self._global_limiter.acquire()
+        elif isinstance(method, AnswerCallbackQuery):
+            await self._global_limiter.acquire()
+
+        return await make_request(bot, method)
@@ -2,21 +2,50 @@
 Модуль для реализации реферальной системы
 """
 
-import uuid
+import secrets
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
 from datetime import datetime, timedelta
+from typing import Optional
 
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean
+from sqlalchemy import (
+    Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Index, case, func, insert, or_, select, update
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from database import db, Base
 
+# Количество попыток вставить ссылку со случайным кодом при совпадении с существующим
+REFERRAL_CODE_ATTEMPTS = 5
+
+REWARD_SETTINGS_CACHE_TTL = 300  # Время жизни кэша настроек вознаграждения ссылок, секунды
+REWARD_SETTINGS_CACHE_SIZE = 2048  # Максимальное количество ссылок в кэше
+
+
+def generate_code() -> str:
+    """Случайный реферальный код из 8 шестнадцатеричных символов
+
+    Формат тот же, что у прежнего префикса uuid4, но без построения UUID и его строки.
+
+    Returns:
+        str: Код в верхнем регистре
+    """
+    return secrets.token_hex(4).upper()
+
 
 class ReferralLink(Base):
     """Модель реферальной ссылки"""
 
     __tablename__ = 'referral_links'
+    __table_args__ = (
+        # Ссылки пользователя, отсортированные по дате создания
+        Index('ix_referral_link_user_created', 'user_id', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
     code = Column(String(50), unique=True, nullable=False)
     link = Column(String(500))
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -32,9 +61,13 @@ class Referral(Base):
     """Модель реферала"""
 
     __tablename__ = 'referrals'
+    __table_args__ = (
+        # Рефералы пользователя: список по дате регистрации и статистика за период
+        Index('ix_referral_referrer_registered', 'referrer_id', 'registered_at'),
+    )
 
     id = Column(Integer, primary_key=True)
-    referrer_id = Column(Integer, nullable=False, index=True)  # Тот, кто пригласил
+    referrer_id = Column(Integer, nullable=False)  # Тот, кто пригласил
     referred_id = Column(Integer, nullable=False, index=True)  # Тот, кого пригласили
     referral_link_id = Column(Integer, ForeignKey('referral_links.id'), nullable=True)
     registered_at = Column(DateTime, default=datetime.utcnow)
@@ -48,54 +81,81 @@ class ReferralSystem:
     def __init__(self):
         self.db = db
 
-    def generate_referral_code(self, user_id: int, custom_code: str = None) -> ReferralLink:
+        # ID ссылки -> (время истечения по time.monotonic(), (процент, сумма) или None).
+        # Настройки вознаграждения ссылки после создания не меняются
+        self._reward_settings_cache: OrderedDict = OrderedDict()
+
+    def _get_reward_settings(self, referral_link_id: int):
+        """Получение настроек вознаграждения реферальной ссылки с кэшированием
+
+        Args:
+            referral_link_id (int): ID реферальной ссылки
+
+        Returns:
+            tuple: Процент и сумма вознаграждения или None, если ссылка не найдена
+        """
+        entry = self._reward_settings_cache.get(referral_link_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._reward_settings_cache.move_to_end(referral_link_id)
+            return entry[1]
+
+        with self.db.session_scope() as session:
+            settings = session.query(
+                ReferralLink.reward_percent, ReferralLink.reward_amount
+            ).filter(ReferralLink.id == referral_link_id).first()
+
+        settings = tuple(settings) if settings else None
+        self._reward_settings_cache[referral_link_id] = (time.monotonic() + REWARD_SETTINGS_CACHE_TTL, settings)
+        self._reward_settings_cache.move_to_end(referral_link_id)
+        if len(self._reward_settings_cache) > REWARD_SETTINGS_CACHE_SIZE:
+            self._reward_settings_cache.popitem(last=False)
+
+        return settings
+
+    async def generate_referral_code(self, user_id: int, custom_code: str = None,
+                                     session: Optional[AsyncSession] = None) -> ReferralLink:
         """Генерация реферального кода
 
         Args:
             user_id (int): ID пользователя
             custom_code (str, optional): Пользовательский код. По умолчанию None.
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
         Returns:
             ReferralLink: Объект реферальной ссылки
         """
-        session = self.db.get_session()
+        # Уникальность кода проверяет UNIQUE-ограничение: ссылка сразу вставляется,
+        # а при совпадении кода случайный код генерируется заново
+        attempts = 1 if custom_code else REFERRAL_CODE_ATTEMPTS
+
+        async with nullcontext(session) if session is not None else self.db.async_session() as session:
+            for _ in range(attempts):
+                code = custom_code or generate_code()
+
+                # Создаем реферальную ссылку
+                link = f"https://t.me/your_bot?start=ref_{code}"  # Замените на имя вашего бота
+
+                referral_link = ReferralLink(
+                    user_id=user_id,
+                    code=code,
+                    link=link,
+                    expires_at=datetime.utcnow() + timedelta(days=30),  # Срок действия 30 дней
+                    max_uses=100  # Максимальное количество использований
+                )
+
+                session.add(referral_link)
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    await session.rollback()
+                    continue
+
+                # Атрибуты не сбрасываются после commit (expire_on_commit=False), повторный SELECT не нужен
+                return referral_link
 
         if custom_code:
-            # Проверяем, не занят ли пользовательский код
-            existing = session.query(ReferralLink).filter(
-                ReferralLink.code == custom_code
-            ).first()
-
-            if existing:
-                session.close()
-                raise ValueError("Этот код уже занят")
-
-            code = custom_code
-        else:
-            # Генерируем уникальный код
-            code = str(uuid.uuid4())[:8].upper()
-
-            # Проверяем на уникальность
-            while session.query(ReferralLink).filter(ReferralLink.code == code).first():
-                code = str(uuid.uuid4())[:8].upper()
-
-        # Создаем реферальную ссылку
-        link = f"https://t.me/your_bot?start=ref_{code}"  # Замените на имя вашего бота
-
-        referral_link = ReferralLink(
-            user_id=user_id,
-            code=code,
-            link=link,
-            expires_at=datetime.utcnow() + timedelta(days=30),  # Срок действия 30 дней
-            max_uses=100  # Максимальное количество использований
-        )
-
-        session.add(referral_link)
-        session.commit()
-        session.refresh(referral_link)
-        session.close()
-
-        return referral_link
+            raise ValueError("Этот код уже занят")
+        raise ValueError("Не удалось сгенерировать уникальный реферальный код")
 
     def register_referral(self, referrer_id: int, referred_id: int, referral_code: str = None) -> bool:
         """Регистрация реферала
@@ -108,48 +168,51 @@ class ReferralSystem:
         Returns:
             bool: Успешность регистрации
         """
-        session = self.db.get_session()
-
-        # Проверяем, не зарегистрирован ли уже этот реферал
-        existing = session.query(Referral).filter(
-            Referral.referred_id == referred_id
-        ).first()
-
-        if existing:
-            session.close()
-            return False
-
-        # Если передан код, находим ссылку
-        referral_link_id = None
-        if referral_code:
-            referral_link = session.query(ReferralLink).filter(
-                ReferralLink.code == referral_code,
-                ReferralLink.is_active == True,
-                ReferralLink.user_id == referrer_id
+        with self.db.session_scope() as session:
+            # Проверяем, не зарегистрирован ли уже этот реферал
+            existing = session.query(Referral).filter(
+                Referral.referred_id == referred_id
             ).first()
 
-            if referral_link:
-                referral_link_id = referral_link.id
-
-                # Проверяем лимит использований
-                if referral_link.max_uses and referral_link.current_uses >= referral_link.max_uses:
-                    session.close()
-                    return False
-
-                # Увеличиваем счетчик использований
-                referral_link.current_uses += 1
-                session.commit()
-
-        # Создаем запись о реферале
-        referral = Referral(
-            referrer_id=referrer_id,
-            referred_id=referred_id,
-            referral_link_id=referral_link_id
-        )
-
-        session.add(referral)
-        session.commit()
-        session.close()
+            if existing:
+                return False
+
+            # Если передан код, находим ссылку
+            referral_link_id = None
+            if referral_code:
+                referral_link = session.query(ReferralLink).filter(
+                    ReferralLink.code == referral_code,
+                    ReferralLink.is_active == True,
+                    ReferralLink.user_id == referrer_id
+                ).first()
+
+                if referral_link:
+                    referral_link_id = referral_link.id
+
+                    # Счетчик увеличивается только если лимит не исчерпан, проверка и
+                    # увеличение выполняются одним UPDATE без гонки между запросами
+                    updated = session.execute(
+                        update(ReferralLink)
+                        .where(
+                            ReferralLink.id == referral_link_id,
+                            or_(
+                                ReferralLink.max_uses.is_(None),
+                                ReferralLink.max_uses == 0,
+                                ReferralLink.current_uses < ReferralLink.max_uses
+                            )
+                        )
+                        .values(current_uses=ReferralLink.current_uses + 1)
+                    ).rowcount
+
+                    if not updated:
+                        return False
+
+            # Создаем запись о реферале; счетчик ссылки и реферал фиксируются одной транзакцией
+            session.execute(insert(Referral).values(
+                referrer_id=referrer_id,
+                referred_id=referred_id,
+                referral_link_id=referral_link_id
+            ))
 
         return True
 
@@ -163,30 +226,49 @@ class ReferralSystem:
         Returns:
             float: Сумма вознаграждения
         """
-        session = self.db.get_session()
+        # Без реферальной ссылки используем стандартные настройки (10%), не обращаясь к БД
+        if not referral.referral_link_id:
+            return payment_amount * 0.1
 
-        # Получаем настройки реферальной ссылки, если она есть
-        if referral.referral_link_id:
-            referral_link = session.query(ReferralLink).filter(
-                ReferralLink.id == referral.referral_link_id
-            ).first()
+        settings = self._get_reward_settings(referral.referral_link_id)
 
-            if referral_link:
-                # Используем настройки из ссылки
-                if referral_link.reward_percent > 0:
-                    reward = payment_amount * (referral_link.reward_percent / 100)
-                else:
-                    reward = referral_link.reward_amount
-            else:
-                # Используем стандартные настройки (10%)
-                reward = payment_amount * 0.1
-        else:
+        if not settings:
             # Используем стандартные настройки (10%)
-            reward = payment_amount * 0.1
+            return payment_amount * 0.1
+
+        # Используем настройки из ссылки
+        reward_percent, reward_amount = settings
+        if reward_percent > 0:
+            return payment_amount * (reward_percent / 100)
+
+        return reward_amount
 
-        session.close()
+    def distribute_rewards(self, referral_rewards: list) -> int:
+        """Начисление вознаграждений нескольким рефералам одним UPDATE
+
+        Args:
+            referral_rewards (list): Пары (ID реферала, сумма вознаграждения)
 
-        return reward
+        Returns:
+            int: Количество обновленных рефералов
+        """
+        if not referral_rewards:
+            return 0
+
+        rewards = {}
+        for referral_id, reward in referral_rewards:
+            rewards[referral_id] = rewards.get(referral_id, 0) + reward
+
+        with self.db.session_scope() as session:
+            return session.execute(
+                update(Referral)
+                .where(Referral.id.in_(rewards))
+                .values(
+                    total_referral_reward=Referral.total_referral_reward + case(rewards, value=Referral.id, else_=0),
+                    has_made_payment=True
+                )
+                .execution_options(synchronize_session=False)
+            ).rowcount
 
     def get_user_referrals(self, user_id: int) -> list:
         """Получение списка рефералов пользователя
@@ -197,51 +279,36 @@ class ReferralSystem:
         Returns:
             list: Список рефералов
         """
-        session = self.db.get_session()
-
-        referrals = session.query(Referral).filter(
-            Referral.referrer_id == user_id
-        ).order_by(Referral.registered_at.desc()).all()
-
-        session.close()
+        with self.db.session_scope() as session:
+            referrals = session.query(Referral).filter(
+                Referral.referrer_id == user_id
+            ).order_by(Referral.registered_at.desc()).all()
 
         return referrals
 
-    def get_user_referral_stats(self, user_id: int) -> dict:
+    async def get_user_referral_stats(self, user_id: int, session: Optional[AsyncSession] = None) -> dict:
         """Получение статистики рефералов пользователя
 
         Args:
             user_id (int): ID пользователя
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
         Returns:
             dict: Статистика рефералов
         """
-        session = self.db.get_session()
-
-        # Общее количество рефералов
-        total_referrals = session.query(Referral).filter(
-            Referral.referrer_id == user_id
-        ).count()
-
-        # Количество активных рефералов (совершивших платеж)
-        active_referrals = session.query(Referral).filter(
-            Referral.referrer_id == user_id,
-            Referral.has_made_payment == True
-        ).count()
-
-        # Общее вознаграждение
-        total_reward = session.query(db.func.sum(Referral.total_referral_reward)).filter(
-            Referral.referrer_id == user_id
-        ).scalar() or 0
-
-        # Рефералы за последние 30 дней
         month_ago = datetime.utcnow() - timedelta(days=30)
-        recent_referrals = session.query(Referral).filter(
-            Referral.referrer_id == user_id,
-            Referral.registered_at >= month_ago
-        ).count()
 
-        session.close()
+        async with nullcontext(session) if session is not None else self.db.async_session() as session:
+            # Все рефералы, активные (совершившие платеж), вознаграждение
+            # и рефералы за последние 30 дней одним запросом
+            total_referrals, active_referrals, total_reward, recent_referrals = (await session.execute(select(
+                func.count(Referral.id),
+                func.coalesce(func.sum(case((Referral.has_made_payment == True, 1), else_=0)), 0),
+                func.coalesce(func.sum(Referral.total_referral_reward), 0),
+                func.coalesce(func.sum(case((Referral.registered_at >= month_ago, 1), else_=0)), 0)
+            ).where(
+                Referral.referrer_id == user_id
+            ))).one()
 
         return {
             "total_referrals": total_referrals,
@@ -250,21 +317,19 @@ class ReferralSystem:
             "recent_referrals": recent_referrals
         }
 
-    def get_referral_links(self, user_id: int) -> list:
+    async def get_referral_links(self, user_id: int, session: Optional[AsyncSession] = None) -> list:
         """Получение реферальных ссылок пользователя
 
         Args:
             user_id (int): ID пользователя
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
         Returns:
             list: Список реферальных ссылок
         """
-        session = self.db.get_session()
-
-        links = session.query(ReferralLink).filter(
-            ReferralLink.user_id == user_id
-        ).order_by(ReferralLink.created_at.desc()).all()
-
-        session.close()
+        async with nullcontext(session) if session is not None else self.db.async_session() as session:
+            links = (await session.execute(select(ReferralLink).where(
+                ReferralLink.user_id == user_id
+            ).order_by(ReferralLink.created_at.desc()))).scalars().all()
 
         return links
@@ -3,14 +3,55 @@
 """
 
 import asyncio
-from datetime import datetime, timedelta
+import logging
+import random
+from contextlib import nullcontext
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 from typing import Optional
 
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Enum as SQLEnum
+import msgspec
+from aiogram.exceptions import TelegramAPIError
+from redis.exceptions import RedisError
+from sqlalchemy import (
+    Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Index, Enum as SQLEnum,
+    bindparam, case, insert, select, text, update
+)
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship
 
-from database import db, Base
+from cache import acquire_once, cache_delete, cache_get, cache_set, redis_client
+from database import db, Base, Payment, User
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_QUEUE_SIZE = 1024  # Размер очереди уведомлений пользователям
+NOTIFY_WORKERS = 8  # Количество воркеров, отправляющих уведомления
+RENEWAL_BATCH_SIZE = 500  # Подписок в одной пачке продления
+
+# Повтор продления пачки при временных ошибках соединения с БД
+RENEWAL_RETRY_ATTEMPTS = 3
+RENEWAL_RETRY_BASE_DELAY = 1  # секунды, удваивается с каждой попыткой
+RENEWAL_RETRY_ERRORS = (OperationalError, ConnectionError, asyncio.TimeoutError)
+
+# Планы подписок меняются редко и кэшируются в Redis
+PLAN_CACHE_KEY = "subscription_plan:{plan_id}"
+PLAN_CACHE_TTL = 300  # секунды
+
+# Фоновая задача просыпается по событию истечения ключа-будильника в Redis
+# к дате списания или окончания подписки; опрос остается страховкой на случай
+# потерянного события (уведомления Redis доставляются не более одного раза)
+ALARM_KEY_PREFIX = "subscription_alarm:"
+SWEEP_INTERVAL = 300  # секунды
+SWEEP_JITTER = 5  # Случайная задержка прохода, чтобы процессы не обращались к БД одновременно, секунды
+WORKER_RESTART_DELAY = 10  # Пауза перед перезапуском упавшей фоновой задачи, секунды
+
+# Событие истечения будильника получают все процессы бота одновременно, поэтому проход
+# выполняет только процесс, захвативший блокировку. TTL освобождает ее, если процесс упал
+SWEEP_LOCK_KEY = "subscription_sweep_lock"
+SWEEP_LOCK_TTL = SWEEP_INTERVAL  # секунды
 
 
 class SubscriptionStatus(Enum):
@@ -45,6 +86,24 @@ class UserSubscription(Base):
     """Модель подписки пользователя"""
 
     __tablename__ = 'user_subscriptions'
+    __table_args__ = (
+        # Подписки с наступившей датой списания: в индекс попадают только подписки
+        # с сохраненным методом оплаты, остальные автоплатеж не обрабатывает
+        Index(
+            'ix_sub_due', 'status', 'next_billing_date',
+            postgresql_where=text("payment_method_id IS NOT NULL"),
+            sqlite_where=text("payment_method_id IS NOT NULL")
+        ),
+        # Поиск истекших подписок
+        Index('ix_sub_expiring', 'status', 'end_date'),
+        # Не больше одной активной подписки на пользователя; Enum хранится по имени.
+        # В существующих базах индекс создается при запуске (database.migrate_schema)
+        Index(
+            'uq_active_sub', 'user_id', unique=True,
+            postgresql_where=text("status = 'ACTIVE'"),
+            sqlite_where=text("status = 'ACTIVE'")
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False, index=True)
@@ -65,6 +124,39 @@ class UserSubscription(Base):
     plan = relationship("SubscriptionPlan")
 
 
+@dataclass(frozen=True)
+class CachedPlan:
+    """Данные плана подписки, нужные для продления"""
+
+    id: int
+    name: str
+    price: float
+    currency: str
+    billing_cycle_days: int
+    is_active: bool
+
+
+# Декодер сразу собирает CachedPlan из JSON без промежуточного словаря
+plan_decoder = msgspec.json.Decoder(CachedPlan)
+
+# Запросы фоновых проходов строятся один раз: при каждом проходе меняется только
+# параметр now, а скомпилированный SQL берется из кэша запросов SQLAlchemy
+DUE_SUBSCRIPTIONS_QUERY = select(UserSubscription).where(
+    UserSubscription.status == SubscriptionStatus.ACTIVE,
+    UserSubscription.auto_renewal == True,
+    UserSubscription.next_billing_date <= bindparam("now"),
+    UserSubscription.payment_method_id.isnot(None)
+).execution_options(yield_per=RENEWAL_BATCH_SIZE)
+
+EXPIRE_SUBSCRIPTIONS_QUERY = update(UserSubscription).where(
+    UserSubscription.status == SubscriptionStatus.ACTIVE,
+    UserSubscription.end_date <= bindparam("now")
+).values(
+    status=SubscriptionStatus.EXPIRED,
+    updated_at=bindparam("now")
+).returning(UserSubscription.user_id).execution_options(synchronize_session=False)
+
+
 class SubscriptionSystem:
     """Класс для управления подписками"""
 
@@ -72,6 +164,12 @@ class SubscriptionSystem:
         self.db = db
         self.bot = bot
         self._task = None
+        self._alarm_task = None
+        self._wakeup = asyncio.Event()
+
+        # Уведомления отправляются воркерами, чтобы обработка подписок не ждала Telegram
+        self._notifications: asyncio.Queue = asyncio.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        self._notify_tasks = []
 
     def create_subscription_plan(self, name: str, description: str, price: float,
                                  billing_cycle_days: int, **kwargs) -> SubscriptionPlan:
@@ -103,297 +201,572 @@ class SubscriptionSystem:
         )
 
         session.add(plan)
+        session.flush()
         session.commit()
-        session.refresh(plan)
         session.close()
 
         return plan
 
-    def subscribe_user(self, user_id: int, plan_id: int,
-                       payment_method_id: str = None) -> Optional[UserSubscription]:
+    async def subscribe_user(self, user_id: int, plan_id: int, payment_method_id: str = None,
+                             session: Optional[AsyncSession] = None) -> Optional[UserSubscription]:
         """Оформление подписки пользователем
 
         Args:
             user_id (int): ID пользователя
             plan_id (int): ID плана подписки
             payment_method_id (str, optional): ID метода оплаты. По умолчанию None.
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
         Returns:
             Optional[UserSubscription]: Объект подписки или None в случае ошибки
         """
-        session = self.db.get_session()
-
-        # Получаем план подписки
-        plan = session.query(SubscriptionPlan).filter(
-            SubscriptionPlan.id == plan_id,
-            SubscriptionPlan.is_active == True
-        ).first()
-
-        if not plan:
-            session.close()
-            return None
+        async with nullcontext(session) if session is not None else self.db.async_session() as session:
+            # Получаем план подписки
+            plan = (await session.execute(select(SubscriptionPlan).where(
+                SubscriptionPlan.id == plan_id,
+                SubscriptionPlan.is_active == True
+            ))).scalars().first()
+
+            if not plan:
+                return None
+
+            # Рассчитываем даты
+            now = datetime.utcnow()
+            cycle = timedelta(days=plan.billing_cycle_days)
+
+            # Если есть пробный период, цикл оплаты начинается после него
+            if plan.trial_period_days > 0:
+                trial_end_date = now + timedelta(days=plan.trial_period_days)
+                end_date = trial_end_date + cycle
+                next_billing_date = trial_end_date
+            else:
+                trial_end_date = None
+                end_date = now + cycle
+                next_billing_date = end_date
+
+            # Создаем подписку; план привязывается объектом, чтобы обработчики могли
+            # обращаться к subscription.plan после закрытия сессии без повторного запроса
+            subscription = UserSubscription(
+                user_id=user_id,
+                plan=plan,
+                start_date=now,
+                end_date=end_date,
+                next_billing_date=next_billing_date,
+                trial_end_date=trial_end_date,
+                auto_renewal=plan.auto_renewal,
+                payment_method_id=payment_method_id
+            )
+
+            # Уникальный индекс uq_active_sub не дает оформить вторую активную подписку,
+            # в том числе при одновременных запросах
+            session.add(subscription)
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                return None
 
-        # Проверяем, нет ли у пользователя активной подписки
-        existing_subscription = session.query(UserSubscription).filter(
-            UserSubscription.user_id == user_id,
-            UserSubscription.status == SubscriptionStatus.ACTIVE
-        ).first()
+        return subscription
 
-        if existing_subscription:
-            session.close()
-            return None
+    async def _update_subscription(self, stmt, session: Optional[AsyncSession] = None) -> bool:
+        """Выполнение UPDATE одной подписки пользователя
 
-        # Рассчитываем даты
-        now = datetime.utcnow()
-        end_date = now + timedelta(days=plan.billing_cycle_days)
-        next_billing_date = end_date
-
-        # Если есть пробный период
-        trial_end_date = None
-        if plan.trial_period_days > 0:
-            trial_end_date = now + timedelta(days=plan.trial_period_days)
-            end_date = trial_end_date + timedelta(days=plan.billing_cycle_days)
-            next_billing_date = trial_end_date
-
-        # Создаем подписку
-        subscription = UserSubscription(
-            user_id=user_id,
-            plan_id=plan_id,
-            start_date=now,
-            end_date=end_date,
-            next_billing_date=next_billing_date,
-            trial_end_date=trial_end_date,
-            auto_renewal=plan.auto_renewal,
-            payment_method_id=payment_method_id
-        )
+        Args:
+            stmt (Update): Запрос обновления подписки
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
-        session.add(subscription)
-        session.commit()
-        session.refresh(subscription)
-        session.close()
+        Returns:
+            bool: True, если подписка обновлена
+        """
+        async with nullcontext(session) if session is not None else self.db.async_session() as session:
+            try:
+                result = await session.execute(stmt.execution_options(synchronize_session=False))
+                await session.commit()
+            except IntegrityError:
+                # Возобновление подписки, когда у пользователя уже есть новая активная (uq_active_sub)
+                await session.rollback()
+                return False
 
-        return subscription
+        return result.rowcount > 0
 
-    def cancel_subscription(self, user_id: int, subscription_id: int) -> bool:
+    async def cancel_subscription(self, user_id: int, subscription_id: int,
+                                  session: Optional[AsyncSession] = None) -> bool:
         """Отмена подписки пользователем
 
+        Лимит отмен плана проверяется в том же UPDATE через подзапрос.
+
         Args:
             user_id (int): ID пользователя
             subscription_id (int): ID подписки
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
         Returns:
             bool: Успешность отмены
         """
-        session = self.db.get_session()
-
-        subscription = session.query(UserSubscription).filter(
-            UserSubscription.id == subscription_id,
-            UserSubscription.user_id == user_id
-        ).first()
-
-        if not subscription:
-            session.close()
-            return False
-
-        plan = session.query(SubscriptionPlan).filter(
-            SubscriptionPlan.id == subscription.plan_id
-        ).first()
-
-        if not plan:
-            session.close()
-            return False
-
-        # Проверяем лимит отмен
-        if subscription.cancellation_count >= plan.max_cancellations:
-            session.close()
-            return False
-
-        # Отменяем подписку
-        subscription.status = SubscriptionStatus.CANCELLED
-        subscription.auto_renewal = False
-        subscription.cancellation_count += 1
-        subscription.updated_at = datetime.utcnow()
-
-        session.commit()
-        session.close()
-
-        return True
+        max_cancellations = select(SubscriptionPlan.max_cancellations).where(
+            SubscriptionPlan.id == UserSubscription.plan_id
+        ).scalar_subquery()
+
+        return await self._update_subscription(
+            update(UserSubscription)
+            .where(
+                UserSubscription.id == subscription_id,
+                UserSubscription.user_id == user_id,
+                UserSubscription.cancellation_count < max_cancellations
+            )
+            .values(
+                status=SubscriptionStatus.CANCELLED,
+                auto_renewal=False,
+                cancellation_count=UserSubscription.cancellation_count + 1,
+                updated_at=datetime.utcnow()
+            ),
+            session
+        )
 
-    def pause_subscription(self, user_id: int, subscription_id: int) -> bool:
+    async def pause_subscription(self, user_id: int, subscription_id: int,
+                                 session: Optional[AsyncSession] = None) -> bool:
         """Приостановка подписки
 
         Args:
             user_id (int): ID пользователя
             subscription_id (int): ID подписки
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
         Returns:
             bool: Успешность приостановки
         """
-        session = self.db.get_session()
-
-        subscription = session.query(UserSubscription).filter(
-            UserSubscription.id == subscription_id,
-            UserSubscription.user_id == user_id,
-            UserSubscription.status == SubscriptionStatus.ACTIVE
-        ).first()
-
-        if not subscription:
-            session.close()
-            return False
-
-        subscription.status = SubscriptionStatus.PAUSED
-        subscription.updated_at = datetime.utcnow()
-
-        session.commit()
-        session.close()
-
-        return True
+        return await self._update_subscription(
+            update(UserSubscription)
+            .where(
+                UserSubscription.id == subscription_id,
+                UserSubscription.user_id == user_id,
+                UserSubscription.status == SubscriptionStatus.ACTIVE
+            )
+            .values(status=SubscriptionStatus.PAUSED, updated_at=datetime.utcnow()),
+            session
+        )
 
-    def resume_subscription(self, user_id: int, subscription_id: int) -> bool:
+    async def resume_subscription(self, user_id: int, subscription_id: int,
+                                  session: Optional[AsyncSession] = None) -> bool:
         """Возобновление подписки
 
         Args:
             user_id (int): ID пользователя
             subscription_id (int): ID подписки
+            session (AsyncSession, optional): Сессия обработчика. По умолчанию открывается новая.
 
         Returns:
             bool: Успешность возобновления
         """
-        session = self.db.get_session()
+        return await self._update_subscription(
+            update(UserSubscription)
+            .where(
+                UserSubscription.id == subscription_id,
+                UserSubscription.user_id == user_id,
+                UserSubscription.status == SubscriptionStatus.PAUSED
+            )
+            .values(status=SubscriptionStatus.ACTIVE, updated_at=datetime.utcnow()),
+            session
+        )
+
+    async def get_plan(self, plan_id: int) -> Optional[CachedPlan]:
+        """Получение плана подписки из кэша Redis или базы данных
+
+        Args:
+            plan_id (int): ID плана подписки
 
-        subscription = session.query(UserSubscription).filter(
-            UserSubscription.id == subscription_id,
-            UserSubscription.user_id == user_id,
-            UserSubscription.status == SubscriptionStatus.PAUSED
-        ).first()
+        Returns:
+            Optional[CachedPlan]: Данные плана или None, если план не найден
+        """
+        cache_key = PLAN_CACHE_KEY.format(plan_id=plan_id)
+        cached = await cache_get(cache_key)
+        if cached is not None:
+            return plan_decoder.decode(cached)
 
-        if not subscription:
-            session.close()
-            return False
+        async with self.db.async_session() as session:
+            plan = await session.get(SubscriptionPlan, plan_id)
 
-        subscription.status = SubscriptionStatus.ACTIVE
-        subscription.updated_at = datetime.utcnow()
+        # Отсутствующий план не кэшируется: созданный позже план сразу станет доступен
+        if plan is None:
+            return None
 
-        session.commit()
-        session.close()
+        cached_plan = CachedPlan(
+            id=plan.id,
+            name=plan.name,
+            price=plan.price,
+            currency=plan.currency,
+            billing_cycle_days=plan.billing_cycle_days,
+            is_active=bool(plan.is_active)
+        )
+        await cache_set(cache_key, msgspec.json.encode(cached_plan), PLAN_CACHE_TTL)
 
-        return True
+        return cached_plan
 
     async def process_recurring_payments(self):
-        """Обработка регулярных платежей для подписок"""
-        session = self.db.get_session()
+        """Обработка регулярных платежей для подписок
 
-        now = datetime.utcnow()
+        Подписки, у которых наступила дата списания, читаются потоком пачками по
+        RENEWAL_BATCH_SIZE. Подписки пачки захватываются одним условным UPDATE, платежи
+        за захваченные вставляются одним executemany INSERT, а ссылки на них записываются
+        одним executemany UPDATE по первичному ключу. Запросы выполняются через
+        асинхронную сессию и не блокируют event loop.
+        """
+        # Одно время UTC (без часового пояса, как в колонках) на весь проход
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
 
-        # Находим подписки, у которых наступила дата следующего платежа
-        subscriptions = session.query(UserSubscription).filter(
-            UserSubscription.status == SubscriptionStatus.ACTIVE,
-            UserSubscription.auto_renewal == True,
-            UserSubscription.next_billing_date <= now,
-            UserSubscription.payment_method_id.isnot(None)
-        ).all()
+        # Планы берутся из кэша, по одному запросу на каждый различный план
+        plans = {}
 
-        for subscription in subscriptions:
-            try:
-                # Получаем план подписки
-                plan = session.query(SubscriptionPlan).filter(
-                    SubscriptionPlan.id == subscription.plan_id
-                ).first()
-
-                if not plan or not plan.is_active:
-                    continue
-
-                # Создаем платеж
-                from database import Payment
-                payment = Payment(
-                    user_id=subscription.user_id,
-                    amount=plan.price,
-                    currency=plan.currency,
-                    status="pending",
-                    payment_provider="subscription",
-                    invoice_payload=f"Автоплатеж за подписку: {plan.name}"
-                )
+        async with self.db.async_session() as session:
+            # Находим подписки, у которых наступила дата следующего платежа
+            result = await session.stream_scalars(DUE_SUBSCRIPTIONS_QUERY, {"now": now})
 
-                session.add(payment)
-                session.commit()
+            async for subscriptions in result.partitions():
+                for plan_id in {subscription.plan_id for subscription in subscriptions} - plans.keys():
+                    plans[plan_id] = await self.get_plan(plan_id)
 
-                # Здесь должна быть логика списания средств через платежную систему
-                # В реальном приложении используйте сохраненный payment_method_id
+                due = [
+                    (subscription, plans[subscription.plan_id]) for subscription in subscriptions
+                    if plans[subscription.plan_id] and plans[subscription.plan_id].is_active
+                ]
 
-                # Для демонстрации считаем платеж успешным
-                payment.status = "completed"
-                payment.completed_at = now
+                if due:
+                    await self._process_renewal_batch(due, now)
 
-                # Обновляем подписку
-                subscription.last_payment_id = payment.id
-                subscription.total_paid += plan.price
+    async def _process_renewal_batch(self, due: list, now: datetime):
+        """Продление пачки подписок и уведомление пользователей
 
-                # Обновляем даты
-                subscription.next_billing_date = subscription.next_billing_date + timedelta(
-                    days=plan.billing_cycle_days)
-                subscription.end_date = subscription.next_billing_date
-                subscription.updated_at = now
+        Пачка записывается в отдельной сессии: фиксация транзакции не закрывает
+        серверный курсор, из которого читаются следующие пачки. Повторяются только
+        попытки, упавшие до фиксации: их транзакция откатывается целиком. Ошибку при
+        самой фиксации не повторяем, так как платежи могли быть уже записаны, и
+        повторная попытка списала бы их второй раз.
 
-                # Отправляем уведомление пользователю
-                if self.bot:
+        Args:
+            due (list): Пары (подписка, данные плана) для продления
+            now (datetime): Время обработки
+        """
+        last_attempt = RENEWAL_RETRY_ATTEMPTS - 1
+        for attempt in range(RENEWAL_RETRY_ATTEMPTS):
+            # Каждая попытка получает новую сессию и соединение из пула
+            async with self.db.async_session() as session:
+                try:
+                    renewed = await self._renew_subscriptions(session, due, now)
+                except RENEWAL_RETRY_ERRORS:
+                    await session.rollback()
+                    if attempt == last_attempt:
+                        logger.exception(f"Ошибка обработки регулярных платежей для {len(due)} подписок")
+                        return
+                except SQLAlchemyError:
+                    await session.rollback()
+                    logger.exception(f"Ошибка обработки регулярных платежей для {len(due)} подписок")
+                    return
+                else:
                     try:
-                        await self.bot.send_message(
-                            subscription.user_id,
-                            f"✅ Произведен автоплатеж за подписку '{plan.name}' на сумму {plan.price:.2f} {plan.currency}\n"
-                            f"Следующий платеж: {subscription.next_billing_date.strftime('%d.%m.%Y')}"
+                        await session.commit()
+                    except (SQLAlchemyError, ConnectionError, asyncio.TimeoutError):
+                        logger.exception(
+                            f"Ошибка фиксации регулярных платежей для {len(due)} подписок, "
+                            f"пачка не повторяется: проверьте платежи за {now:%d.%m.%Y %H:%M}"
                         )
-                    except:
-                        pass
+                        return
+                    break
 
-                session.commit()
+            await asyncio.sleep(RENEWAL_RETRY_BASE_DELAY * 2 ** attempt)
 
-            except Exception as e:
-                print(f"Ошибка обработки регулярного платежа для подписки {subscription.id}: {e}")
-                continue
+        await self.schedule_alarms([
+            (subscription.id, next_billing_date) for subscription, plan, next_billing_date in renewed
+        ])
 
-        session.close()
+        # Уведомления отправляются только после фиксации платежей
+        await self._notify_users([(
+            subscription.user_id,
+            f"✅ Произведен автоплатеж за подписку '{plan.name}' на сумму {plan.price:.2f} {plan.currency}\n"
+            f"Следующий платеж: {next_billing_date.strftime('%d.%m.%Y')}"
+        ) for subscription, plan, next_billing_date in renewed])
+
+    async def _renew_subscriptions(self, session, due: list, now: datetime):
+        """Запись платежей и продление подписок одной транзакцией
+
+        Сначала подписки захватываются одним условным UPDATE: дата списания сдвигается,
+        только если она не изменилась с момента чтения. Подписки, которые уже продлил
+        другой проход или которые отменили, не захватываются, и платежи создаются
+        только для захваченных. Транзакция не фиксируется: commit выполняет вызывающий код.
+
+        Args:
+            session (AsyncSession): Асинхронная сессия базы данных
+            due (list): Пары (подписка, данные плана) для продления
+            now (datetime): Время обработки
+
+        Returns:
+            list: Тройки (подписка, данные плана, новая дата списания) продленных подписок
+        """
+        next_billing_dates = {
+            subscription.id: subscription.next_billing_date + timedelta(days=plan.billing_cycle_days)
+            for subscription, plan in due
+        }
+        new_billing_date = case(next_billing_dates, value=UserSubscription.id)
+
+        claimed_ids = set((await session.execute(
+            update(UserSubscription)
+            .where(
+                UserSubscription.id.in_(next_billing_dates),
+                UserSubscription.status == SubscriptionStatus.ACTIVE,
+                UserSubscription.next_billing_date == case(
+                    {subscription.id: subscription.next_billing_date for subscription, plan in due},
+                    value=UserSubscription.id
+                )
+            )
+            .values(
+                next_billing_date=new_billing_date,
+                end_date=new_billing_date,
+                # Сумма увеличивается в БД, а не пересчитывается из прочитанного значения
+                total_paid=UserSubscription.total_paid + case(
+                    {subscription.id: plan.price for subscription, plan in due}, value=UserSubscription.id
+                ),
+                updated_at=now
+            )
+            .returning(UserSubscription.id)
+            .execution_options(synchronize_session=False)
+        )).scalars())
+
+        renewed = [(subscription, plan) for subscription, plan in due if subscription.id in claimed_ids]
+        if not renewed:
+            return []
+
+        # Здесь должна быть логика списания средств через платежную систему
+        # В реальном приложении используйте сохраненный payment_method_id
+
+        # Для демонстрации считаем платежи успешными
+        payment_rows = [{
+            "user_id": subscription.user_id,
+            "amount": plan.price,
+            "currency": plan.currency,
+            "status": "completed",
+            "payment_provider": "subscription",
+            "invoice_payload": f"Автоплатеж за подписку: {plan.name}",
+            # Время задано явно, чтобы значение по умолчанию колонки не вычислялось для каждой строки
+            "created_at": now,
+            "completed_at": now
+        } for subscription, plan in renewed]
+
+        # ID платежей возвращаются в порядке строк, чтобы связать их с подписками
+        payment_ids = (await session.scalars(
+            insert(Payment).returning(Payment.id, sort_by_parameter_order=True),
+            payment_rows
+        )).all()
+
+        await session.execute(update(UserSubscription), [
+            {"id": subscription.id, "last_payment_id": payment_id, "updated_at": now}
+            for (subscription, plan), payment_id in zip(renewed, payment_ids)
+        ])
+
+        return [
+            (subscription, plan, next_billing_dates[subscription.id]) for subscription, plan in renewed
+        ]
+
+    async def _notify_users(self, messages: list):
+        """Постановка уведомлений пользователям подписок в очередь
+
+        Подписки хранят внутренний ID пользователя (User.id), а сообщение отправляется
+        в чат по Telegram ID: идентификаторы получаются одним запросом на все уведомления.
+
+        Args:
+            messages (list): Пары (ID пользователя, текст уведомления)
+        """
+        if not self.bot or not messages:
+            return
+
+        try:
+            async with self.db.async_session() as session:
+                telegram_ids = dict((await session.execute(
+                    select(User.id, User.telegram_id).where(User.id.in_({user_id for user_id, message_text in messages}))
+                )).all())
+        except SQLAlchemyError:
+            logger.exception(f"Не удалось получить Telegram ID для {len(messages)} уведомлений")
+            return
+
+        for user_id, message_text in messages:
+            telegram_id = telegram_ids.get(user_id)
+            if telegram_id is not None:
+                self._notify(telegram_id, message_text)
+
+    def _notify(self, chat_id: int, text: str):
+        """Постановка уведомления пользователю в очередь
+
+        Args:
+            chat_id (int): Telegram ID пользователя
+            text (str): Текст уведомления
+        """
+        if not self.bot:
+            return
+
+        try:
+            self._notifications.put_nowait({'chat_id': chat_id, 'text': text})
+        except asyncio.QueueFull:
+            logger.warning(f"Очередь уведомлений переполнена, уведомление для {chat_id} пропущено")
+
+    async def _notify_worker(self):
+        """Воркер, отправляющий уведомления из очереди"""
+        while True:
+            message = await self._notifications.get()
+            try:
+                await self.bot.send_message(**message)
+            except TelegramAPIError as e:
+                logger.warning(f"Не удалось отправить уведомление {message['chat_id']}: {e}")
+            finally:
+                self._notifications.task_done()
+
+    async def schedule_alarms(self, alarms: list):
+        """Установка будильников к датам списания и окончания подписок
+
+        Ключ истекает в указанный момент, и Redis присылает событие, по которому
+        фоновая задача сразу обрабатывает подписки.
+
+        Args:
+            alarms (list): Пары (ID подписки, время UTC)
+        """
+        if not alarms:
+            return
+
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for subscription_id, moment in alarms:
+                    # Даты в БД хранятся в UTC без часового пояса
+                    timestamp = int(moment.replace(tzinfo=timezone.utc).timestamp())
+                    pipe.set(f"{ALARM_KEY_PREFIX}{subscription_id}:{timestamp}", subscription_id, exat=timestamp)
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Не удалось установить будильники подписок: {e}")
+
+    async def _enable_expired_events(self):
+        """Включение уведомлений Redis об истечении ключей, если они выключены
+
+        Управляемые Redis часто запрещают CONFIG GET/SET, хотя уведомления на сервере
+        уже настроены, поэтому ошибка только логируется и подписка на события продолжается.
+        """
+        try:
+            flags = (await redis_client.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+            # Нужны флаги E (keyevent-канал) и x (истечение ключей); A включает x
+            missing = "".join(flag for flag in "Ex" if flag not in flags and not (flag == "x" and "A" in flags))
+            if missing:
+                await redis_client.config_set("notify-keyspace-events", flags + missing)
+        except RedisError as e:
+            logger.warning(
+                f"Не удалось проверить notify-keyspace-events ({e}); если флаги Ex не включены "
+                f"на сервере, подписки обрабатываются только по опросу"
+            )
+
+    async def _alarm_listener(self):
+        """Фоновая задача, будящая обработку подписок по истечении ключей-будильников"""
+        db_index = redis_client.connection_pool.connection_kwargs.get("db", 0)
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await self._enable_expired_events()
+            await pubsub.subscribe(f"__keyevent@{db_index}__:expired")
+            async for message in pubsub.listen():
+                if message["data"].startswith(ALARM_KEY_PREFIX):
+                    self._wakeup.set()
+        except RedisError as e:
+            logger.warning(f"События истечения ключей Redis недоступны, подписки обрабатываются по опросу: {e}")
+        finally:
+            await pubsub.aclose()
+
+    @staticmethod
+    def _report_task_exit(task: asyncio.Task):
+        """Сообщение о фоновой задаче, завершившейся с ошибкой
+
+        Args:
+            task (asyncio.Task): Завершенная задача
+        """
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Фоновая задача {task.get_name()} завершилась с ошибкой", exc_info=task.exception())
+
+    async def _supervised_worker(self):
+        """Обработка подписок с перезапуском после непредвиденной ошибки"""
+        while True:
+            try:
+                await self._subscription_worker()
+            except Exception:
+                logger.exception(f"Фоновая задача подписок упала, перезапуск через {WORKER_RESTART_DELAY} с")
+                await asyncio.sleep(WORKER_RESTART_DELAY)
 
     async def start_background_tasks(self):
         """Запуск фоновых задач для обработки подписок"""
-        self._task = asyncio.create_task(self._subscription_worker())
+        self._task = asyncio.create_task(self._supervised_worker(), name="subscription_worker")
+        self._alarm_task = asyncio.create_task(self._alarm_listener(), name="subscription_alarms")
+        if self.bot:
+            self._notify_tasks = [
+                asyncio.create_task(self._notify_worker(), name=f"subscription_notify_{i}")
+                for i in range(NOTIFY_WORKERS)
+            ]
+
+        # Ни одна фоновая задача не завершится незаметно
+        for task in [self._task, self._alarm_task, *self._notify_tasks]:
+            task.add_done_callback(self._report_task_exit)
+
+    def stop_background_tasks(self):
+        """Остановка фоновых задач и воркеров уведомлений"""
+        for task in [self._task, self._alarm_task, *self._notify_tasks]:
+            if task:
+                task.cancel()
+        self._notify_tasks = []
 
     async def _subscription_worker(self):
         """Фоновая задача для обработки подписок"""
+        # Проходы привязаны к сетке монотонного времени цикла: длительность обработки
+        # не сдвигает следующие проходы
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+
         while True:
+            # Событие, пришедшее во время обработки, запустит следующий проход сразу
+            self._wakeup.clear()
             try:
-                await self.process_recurring_payments()
-                await self.check_expired_subscriptions()
-            except Exception as e:
-                print(f"Ошибка в фоновой задаче подписок: {e}")
+                await self._sweep()
+            except Exception:
+                logger.exception("Ошибка в фоновой задаче подписок")
 
-            # Проверяем каждые 5 минут
-            await asyncio.sleep(300)
+            # Пропущенные из-за долгой обработки проходы не наверстываются
+            while next_tick <= loop.time():
+                next_tick += SWEEP_INTERVAL
 
-    async def check_expired_subscriptions(self):
-        """Проверка истекающих подписок"""
-        session = self.db.get_session()
+            # Ждем будильника, но не дольше следующего прохода страховочного опроса
+            timeout = next_tick - loop.time() + random.uniform(0, SWEEP_JITTER)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _sweep(self):
+        """Проход обработки подписок под межпроцессной блокировкой
 
-        now = datetime.utcnow()
+        Если проход уже выполняет другой процесс, текущий его пропускает: тот процесс
+        тоже получил событие будильника и повторит проход после текущего.
+        """
+        if not await acquire_once(SWEEP_LOCK_KEY, SWEEP_LOCK_TTL):
+            return
 
-        # Находим подписки, которые истекли
-        expired_subscriptions = session.query(UserSubscription).filter(
-            UserSubscription.status == SubscriptionStatus.ACTIVE,
-            UserSubscription.end_date <= now
-        ).all()
+        try:
+            await self.process_recurring_payments()
+            await self.check_expired_subscriptions()
+        finally:
+            await cache_delete(SWEEP_LOCK_KEY)
 
-        for subscription in expired_subscriptions:
-            subscription.status = SubscriptionStatus.EXPIRED
-            subscription.updated_at = now
+    async def check_expired_subscriptions(self):
+        """Проверка истекающих подписок"""
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
 
-            # Отправляем уведомление
-            if self.bot:
-                try:
-                    await self.bot.send_message(
-                        subscription.user_id,
-                        f"⚠️ Ваша подписка истекла. Продлите ее, чтобы продолжить пользоваться услугами."
-                    )
-                except:
-                    pass
+        async with self.db.async_session() as session:
+            # Истекшие подписки переводятся в EXPIRED одним UPDATE, RETURNING отдает
+            # пользователей для уведомлений без загрузки объектов подписок
+            result = await session.execute(EXPIRE_SUBSCRIPTIONS_QUERY, {"now": now})
+            expired_user_ids = result.scalars().all()
 
-        session.commit()
-        session.close()
+            await session.commit()
+
+        # Отправляем уведомления
+        await self._notify_users([(
+            user_id,
+            f"⚠️ Ваша подписка истекла. Продлите ее, чтобы продолжить пользоваться услугами."
+        ) for user_id in expired_user_ids])